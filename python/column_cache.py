@@ -0,0 +1,168 @@
+# Columnar on-disk cache of FITS and CSV tables, so analysis scripts only parse each input once
+
+import os
+import errno
+import json
+import hashlib
+
+import numpy as np
+
+'''
+The first time a table is read, every column is written to {cachedir}/col{i:04}.npy along
+with a manifest.json recording the source file's modification time and size. Later reads
+check the manifest against the source and memory-map only the columns that are asked for;
+if the source has changed, the cache is rebuilt from it. The manifest is written last, so
+an interrupted build is never mistaken for a complete one.
+
+By default the cache lives next to the source, in column_cache/{basename of the source}.
+'''
+
+class ColumnTable(object):
+
+    '''
+    Read-only table backed by a column cache. Columns are loaded the first time they are
+    used, and are memory-mapped unless they hold Python objects (strings from a CSV).
+
+        table['col']            column as an array
+        table[['col1','col2']]  2-D array with one column per name
+        table[mask]             rows selected by a boolean mask or index array, as another table
+        table.columns           column names, in the order of the source
+    '''
+
+    def __init__(self,cachedir,manifest,rows=None,loaded=None):
+
+        self.cachedir = cachedir
+        self.manifest = manifest
+        self.columns = manifest['columns']
+        self.rows = rows
+        # Shared between a table and the selections made from it
+        self.loaded = {} if loaded is None else loaded
+
+        self.lookup = dict((name,i) for i,name in enumerate(self.columns))
+        if manifest['case_insensitive']:
+            for i,name in enumerate(self.columns):
+                self.lookup.setdefault(name.lower(),i)
+
+    def __len__(self):
+
+        return self.manifest['nrows'] if self.rows is None else len(self.rows)
+
+    def column(self,name):
+
+        i = self.lookup.get(name)
+        if i is None and self.manifest['case_insensitive']:
+            i = self.lookup.get(name.lower())
+        if i is None:
+            raise KeyError("Key '{0}' does not exist.".format(name))
+
+        if i not in self.loaded:
+            pickled = self.manifest['pickled'][i]
+            arr = np.load(os.path.join(self.cachedir,self.manifest['files'][i]),
+                          mmap_mode=None if pickled else 'r',allow_pickle=pickled)
+            self.loaded[i] = np.asarray(arr)
+
+        arr = self.loaded[i]
+        return arr if self.rows is None else arr[self.rows]
+
+    def __getitem__(self,key):
+
+        if isinstance(key,basestring):
+            return self.column(key)
+        if isinstance(key,(list,tuple)) and len(key) > 0 and all(isinstance(k,basestring) for k in key):
+            return np.column_stack([self.column(k) for k in key])
+
+        selected = np.arange(len(self))[key]
+        rows = selected if self.rows is None else self.rows[selected]
+        return ColumnTable(self.cachedir,self.manifest,rows=rows,loaded=self.loaded)
+
+def default_cachedir(filename,tag=None):
+
+    basename = os.path.basename(filename) if tag is None else '{0}.{1}'.format(os.path.basename(filename),tag)
+    return os.path.join(os.path.dirname(os.path.abspath(filename)),'column_cache',basename)
+
+def source_stamp(filename):
+
+    # Modification time and size of a source table; IOError if it doesn't exist, like the readers it replaces
+
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        raise IOError(e.errno,e.strerror,filename)
+    return st.st_mtime,st.st_size
+
+def read_manifest(cachedir,stamp):
+
+    # Manifest of an up-to-date cache, or None if it is missing or stale
+
+    try:
+        with open(os.path.join(cachedir,'manifest.json')) as f:
+            manifest = json.load(f)
+    except (IOError,ValueError):
+        return None
+
+    if (manifest.get('source_mtime'),manifest.get('source_size')) != stamp:
+        return None
+    return manifest
+
+def write_cache(cachedir,stamp,names,arrays,case_insensitive=False):
+
+    try:
+        os.makedirs(cachedir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    files,pickled = [],[]
+    for i,arr in enumerate(arrays):
+        fn = 'col{0:04}.npy'.format(i)
+        partname = os.path.join(cachedir,'{0}.{1}.part'.format(fn,os.getpid()))
+        with open(partname,'wb') as f:
+            np.save(f,arr,allow_pickle=True)
+        os.rename(partname,os.path.join(cachedir,fn))
+        files.append(fn)
+        pickled.append(arr.dtype.hasobject)
+
+    manifest = {'source_mtime':stamp[0],
+                'source_size':stamp[1],
+                'nrows':len(arrays[0]) if len(arrays) else 0,
+                'columns':list(names),
+                'files':files,
+                'pickled':pickled,
+                'case_insensitive':case_insensitive}
+
+    partname = os.path.join(cachedir,'manifest.json.{0}.part'.format(os.getpid()))
+    with open(partname,'w') as f:
+        json.dump(manifest,f)
+    os.rename(partname,os.path.join(cachedir,'manifest.json'))
+
+    return manifest
+
+def fits_columns(filename,ext=1,cachedir=None):
+
+    # Columns of a FITS binary table; names are matched case-insensitively, as with fits.getdata
+
+    cachedir = default_cachedir(filename,None if ext == 1 else 'hdu{0}'.format(ext)) if cachedir is None else cachedir
+    stamp = source_stamp(filename)
+    manifest = read_manifest(cachedir,stamp)
+    if manifest is None:
+        from astropy.io import fits
+        data = fits.getdata(filename,ext)
+        names = data.columns.names
+        manifest = write_cache(cachedir,stamp,names,[np.array(data[name]) for name in names],case_insensitive=True)
+
+    return ColumnTable(cachedir,manifest)
+
+def csv_columns(filename,names=None,cachedir=None):
+
+    # Columns of a CSV file, parsed by pandas. names is passed on to read_csv for files without a header line.
+
+    tag = None if names is None else hashlib.sha1('\n'.join(names)).hexdigest()[:12]
+    cachedir = default_cachedir(filename,tag) if cachedir is None else cachedir
+    stamp = source_stamp(filename)
+    manifest = read_manifest(cachedir,stamp)
+    if manifest is None:
+        import pandas as pd
+        data = pd.read_csv(filename,names=names)
+        manifest = write_cache(cachedir,stamp,[str(c) for c in data.columns],[data[c].values for c in data.columns])
+
+    return ColumnTable(cachedir,manifest)
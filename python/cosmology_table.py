@@ -0,0 +1,87 @@
+# Interpolation tables for the distance modulus and angular scale, shared by the metadata and analysis scripts
+
+from __future__ import division
+import numpy as np
+
+from astropy.cosmology import WMAP9
+from astropy import units as u
+
+# Covers the NSA, which stops at z = 0.15; redshifts outside the table fall back to astropy
+nsa_zmax = 0.2
+
+class CosmologyTable(object):
+
+    '''
+    distmod(z) and kpc_per_arcsec(z) for a cosmology, interpolated from a table built once
+    instead of integrated by astropy for every redshift. Both return plain floats (magnitudes,
+    and proper kpc per arcsec) rather than astropy quantities.
+
+    Near z = 0 the distance modulus goes as 5 log10(z) and the angular scale as z, so the
+    table holds distmod - 5 log10(z) and scale / z, which are smooth down to z = 0, and
+    interpolates those linearly. The grid is doubled until the error at the midpoints between
+    nodes, where linear interpolation is worst, is below distmod_tol (mag) and scale_rtol
+    (fractional). The errors reached are kept as max_distmod_error and max_scale_error.
+    '''
+
+    def __init__(self,cosmo=WMAP9,zmax=nsa_zmax,distmod_tol=1e-4,scale_rtol=1e-5,npoints=256):
+
+        self.cosmo = cosmo
+        self.zmax = zmax
+
+        while True:
+            z = np.linspace(0,zmax,npoints)
+            self.z = z
+            self.distmod_smooth,self.scale_smooth = self.smooth(z)
+            zmid = (z[1:] + z[:-1]) / 2.
+            dm,sc = self.smooth(zmid)
+            self.max_distmod_error = np.abs(np.interp(zmid,z,self.distmod_smooth) - dm).max()
+            self.max_scale_error = np.abs(np.interp(zmid,z,self.scale_smooth) / sc - 1).max()
+            if (self.max_distmod_error < distmod_tol and self.max_scale_error < scale_rtol) or npoints >= 2**16:
+                break
+            npoints = 2*(npoints - 1) + 1
+
+    def exact_distmod(self,z):
+
+        with np.errstate(divide='ignore'):
+            return self.cosmo.distmod(z).value
+
+    def exact_kpc_per_arcsec(self,z):
+
+        return self.cosmo.kpc_proper_per_arcmin(z).to(u.kpc/u.arcsec).value
+
+    def smooth(self,z):
+
+        # Tabulated functions; z = 0 itself is evaluated just above it, where they have already converged
+
+        z = np.maximum(z,1e-9)
+        return self.exact_distmod(z) - 5*np.log10(z),self.exact_kpc_per_arcsec(z) / z
+
+    def lookup(self,z,table,exact,combine):
+
+        z = np.asarray(z,dtype=float)
+        out = np.empty(z.shape)
+        inside = (z >= 0) & (z <= self.zmax)
+        with np.errstate(divide='ignore'):
+            out[inside] = combine(np.interp(z[inside],self.z,table),z[inside])
+        if not inside.all():
+            out[~inside] = exact(z[~inside])
+        return out[()]
+
+    def distmod(self,z):
+
+        return self.lookup(z,self.distmod_smooth,self.exact_distmod,lambda t,z: t + 5*np.log10(z))
+
+    def kpc_per_arcsec(self,z):
+
+        return self.lookup(z,self.scale_smooth,self.exact_kpc_per_arcsec,lambda t,z: t * z)
+
+cosmology_tables = {}
+
+def cosmology_table(cosmo=WMAP9,zmax=nsa_zmax):
+
+    # Table for a cosmology, built on first use
+
+    key = (cosmo.name,zmax)
+    if key not in cosmology_tables:
+        cosmology_tables[key] = CosmologyTable(cosmo,zmax)
+    return cosmology_tables[key]
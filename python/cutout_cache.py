@@ -0,0 +1,171 @@
+# On-disk cache of skyserver cutouts, addressed by a hash of the full request
+
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+class CutoutCache(object):
+
+    '''
+    Cutouts are stored as {cachedir}/{key[:2]}/{key}.fits, where key is the SHA-1 of the
+    request URL including all of its parameters (position, pixel scale, size and data release).
+    Any two requests for the same cutout share one file, whatever galaxy name they are saved under.
+    link() puts that file at the galaxy's own filename as a hard link, so a cutout is only written
+    to disk once (it is copied where the filesystem has no hard links, eg across devices).
+
+    *cachedir*   directory holding the cache
+    *max_bytes*  total size the cache may grow to before least recently used entries are evicted
+                 (None for no limit)
+    '''
+
+    def __init__(self,cachedir,max_bytes=None):
+
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Rebuild the LRU order from file modification times, which are refreshed on every hit
+        entries = []
+        if os.path.isdir(cachedir):
+            for subdir in os.listdir(cachedir):
+                subpath = os.path.join(cachedir,subdir)
+                if not os.path.isdir(subpath):
+                    continue
+                for fn in os.listdir(subpath):
+                    if fn.endswith('.fits'):
+                        st = os.stat(os.path.join(subpath,fn))
+                        entries.append((st.st_mtime,fn[:-5],st.st_size))
+        entries.sort()
+
+        self.entries = OrderedDict((key,size) for mtime,key,size in entries)
+        self.nbytes = sum(self.entries.values())
+
+    def key(self,url):
+
+        return hashlib.sha1(url).hexdigest()
+
+    def path(self,key):
+
+        return os.path.join(self.cachedir,key[:2],'{0}.fits'.format(key))
+
+    def get(self,url):
+
+        # Cutout contents for url, or None on a miss
+
+        key = self.key(url)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+
+        path = self.path(key)
+        try:
+            with open(path,'rb') as f:
+                content = f.read()
+            os.utime(path,None)
+        except (IOError,OSError):
+            # Removed from disk behind our back; treat it as a miss
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+                self.nbytes -= self.entries.pop(key,0)
+            return None
+
+        return content
+
+    def put(self,url,content):
+
+        key = self.key(url)
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+
+        partname = '{0}.{1}.part'.format(path,threading.current_thread().ident)
+        with open(partname,'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partname,path)
+
+        with self.lock:
+            self.nbytes += len(content) - self.entries.pop(key,0)
+            self.entries[key] = len(content)
+            self._evict()
+
+        return None
+
+    def link(self,url,filename):
+
+        # Put the cached cutout for url at filename without writing it out again.
+        # Returns False if url is not in the cache. Does not count as a hit or miss.
+
+        key = self.key(url)
+        with self.lock:
+            if key not in self.entries:
+                return False
+
+        path = self.path(key)
+        try:
+            if os.path.exists(filename) and os.path.samefile(path,filename):
+                return True
+            partname = '{0}.{1}.part'.format(filename,threading.current_thread().ident)
+            if os.path.exists(partname):
+                os.remove(partname)
+            try:
+                os.link(path,partname)
+            except OSError:
+                # No hard links on this filesystem, or the cache is on another device
+                shutil.copyfile(path,partname)
+        except (IOError,OSError):
+            if os.path.exists(path):
+                raise
+            # Evicted or removed from disk behind our back
+            with self.lock:
+                self.nbytes -= self.entries.pop(key,0)
+            return False
+        os.rename(partname,filename)
+
+        return True
+
+    def _evict(self):
+
+        # Drop least recently used entries until the cache fits in max_bytes. Call with the lock held.
+
+        if self.max_bytes is None:
+            return None
+
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key,size = self.entries.popitem(last=False)
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self.nbytes -= size
+            self.evictions += 1
+
+        return None
+
+    def stats(self):
+
+        with self.lock:
+            total = self.hits + self.misses
+            stats = {'hits':self.hits,
+                     'misses':self.misses,
+                     'hit_rate':self.hits / float(total) if total else 0.,
+                     'evictions':self.evictions,
+                     'entries':len(self.entries),
+                     'bytes':self.nbytes}
+
+        return stats
@@ -0,0 +1,346 @@
+# Download FITS cutouts from the Legacy Survey skyserver over pooled, keep-alive HTTP connections
+
+from __future__ import division
+import os
+import sys
+import traceback
+import urllib
+import threading
+import Queue
+import time
+import random
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+from requests.adapters import HTTPAdapter
+
+min_pixelscale = 0.10
+
+cutout_urls = {'1':"http://imagine.legacysurvey.org/fits-cutout-decals-dr1",
+               '2':"http://legacysurvey.org/viewer/fits-cutout-decals-dr2"}
+
+# HTTP status codes worth retrying: rate limiting and transient server/gateway errors
+retry_statuses = (429,500,502,503,504)
+
+def cutout_params(gal,size=424):
+
+    # Request parameters for a galaxy cutout; pixel scale is set by the Petrosian radii
+
+    params = {'ra':gal['RA'],
+              'dec':gal['DEC'],
+              'pixscale':max(min(gal['PETROTH50']*0.04,gal['PETROTH90']*0.02),min_pixelscale),
+              'size':size}
+
+    return params
+
+def write_atomic(filename,content):
+
+    # Write to a temporary file and rename it into place, so filename is either complete or absent
+
+    partname = '{0}.part'.format(filename)
+    with open(partname,'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(partname,filename)
+
+    return None
+
+def retry_after(response):
+
+    # Seconds requested by a Retry-After header (either delay-seconds or an HTTP date), or None if absent
+
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(float(value),0.)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(mktime_tz(date) - time.time(),0.)
+
+def check_length(response):
+
+    # requests only notices a truncated body when it is chunked; one with a Content-Length that
+    # stops short is returned as it is. Raise ChunkedEncodingError for those too, so they are retried.
+    # An encoded (eg gzipped) body is decoded to a different length, so it can't be checked this way.
+
+    expected = response.headers.get('Content-Length')
+    if expected is None or response.headers.get('Content-Encoding','identity') != 'identity':
+        return None
+    if len(response.content) < int(expected):
+        raise requests.exceptions.ChunkedEncodingError(
+            'Response ended after {0} of {1} bytes'.format(len(response.content),expected),response=response)
+
+    return None
+
+class TokenBucket(object):
+
+    '''
+    Rate limiter shared by all worker threads.
+
+    Tokens refill at *rate* per second up to *burst*; each request takes one token
+    and waits if none are available.
+    '''
+
+    def __init__(self,rate,burst=1):
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+
+        now = time.time()
+        self.tokens = min(self.burst,self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return None
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def hold(self,seconds):
+
+        # Stop handing out tokens to every thread for the given number of seconds, eg after a 429
+
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens,1 - seconds * self.rate)
+
+        return None
+
+class CutoutDownloader(object):
+
+    '''
+    Fetch cutouts through a single requests.Session shared by all worker threads.
+
+    Connections to the skyserver are kept alive and reused between galaxies instead of
+    opening a new TCP connection per request, as urllib.urlretrieve does.
+
+    *concurrency*   number of worker threads the caller should run against this downloader
+    *max_per_host*  maximum number of open connections to any one host. Workers block
+                    until a pooled connection is free. Defaults to *concurrency*.
+    *timeout*       seconds to wait for the server to connect or send data
+    *baseurl*       override the skyserver URL for every data release, eg to point at a
+                    local stand-in server serving synthetic cutouts
+
+    Connection errors, timeouts, truncated bodies and the statuses in retry_statuses are
+    retried up to *max_retries* times, with exponential backoff starting at *backoff* seconds
+    and capped at *max_backoff*, using full jitter. A Retry-After header from the server is
+    used as the delay instead (also capped at *max_backoff*) and pauses all other threads.
+
+    *rate*          maximum requests per second across all threads (None for no limit)
+    *burst*         number of requests that can be made at once before the rate applies
+
+    *cache*         optional cutout_cache.CutoutCache; requests already in the cache are
+                    served from disk without contacting the skyserver. Saved cutouts are
+                    hard links to the cache entries, so each is only written once.
+    '''
+
+    def __init__(self,concurrency=8,max_per_host=None,timeout=60,baseurl=None,
+                 max_retries=5,backoff=1.,max_backoff=60.,rate=None,burst=1,cache=None):
+
+        self.concurrency = concurrency
+        self.max_per_host = concurrency if max_per_host is None else max_per_host
+        self.timeout = timeout
+        self.baseurl = baseurl
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ratelimit = None if rate is None else TokenBucket(rate,burst)
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(cutout_urls),
+                              pool_maxsize=self.max_per_host,
+                              pool_block=True)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+
+    def params_url(self,params,dr='2'):
+
+        # Parameters are sorted so the same request always gives the same URL (and cache key)
+
+        baseurl = cutout_urls[dr] if self.baseurl is None else self.baseurl
+
+        return "{0}?{1}".format(baseurl,urllib.urlencode(sorted(params.items())))
+
+    def url(self,gal,dr='2'):
+
+        return self.params_url(cutout_params(gal),dr)
+
+    def delay(self,attempt):
+
+        # Exponential backoff with full jitter for the given (0-based) retry attempt
+
+        return random.uniform(0,min(self.max_backoff,self.backoff * 2**attempt))
+
+    def get(self,url):
+
+        # Return the body of a cutout request, retrying transient failures.
+        # Once retries are exhausted this raises requests.RequestException, a subclass of IOError.
+
+        attempt = 0
+        while True:
+            if self.ratelimit is not None:
+                self.ratelimit.acquire()
+
+            try:
+                response = self.session.get(url,timeout=self.timeout)
+                if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    check_length(response)
+                    return response.content
+            except (requests.ConnectionError,requests.Timeout,requests.exceptions.ChunkedEncodingError):
+                # ChunkedEncodingError: the connection dropped partway through the body
+                if attempt >= self.max_retries:
+                    raise
+                wait = self.delay(attempt)
+            else:
+                wait = retry_after(response)
+                if wait is None:
+                    wait = self.delay(attempt)
+                else:
+                    wait = min(wait,self.max_backoff)
+                    if self.ratelimit is not None:
+                        self.ratelimit.hold(wait)
+                response.close()
+
+            attempt += 1
+            time.sleep(wait)
+
+    def content(self,url):
+
+        # Raw bytes of the cutout at url, from the cache if possible
+
+        content = None if self.cache is None else self.cache.get(url)
+        if content is None:
+            content = self.get(url)
+            if self.cache is not None:
+                self.cache.put(url,content)
+
+        return content
+
+    def download(self,gal,dr='2'):
+
+        # Raw bytes of the multi-plane FITS cutout for a galaxy, without saving it
+
+        return self.content(self.url(gal,dr))
+
+    def fetch_url(self,url,filename):
+
+        # Save the cutout at url to filename
+
+        content = self.content(url)
+        if self.cache is None or not self.cache.link(url,filename):
+            write_atomic(filename,content)
+
+        return None
+
+    def fetch_params(self,params,filename,dr='2'):
+
+        # Save a cutout with explicit request parameters (ra, dec, pixscale, size) to filename
+
+        return self.fetch_url(self.params_url(params,dr),filename)
+
+    def fetch(self,gal,filename,dr='2'):
+
+        # Download the multi-plane FITS cutout for a galaxy to filename
+
+        return self.fetch_url(self.url(gal,dr),filename)
+
+    def close(self):
+
+        self.session.close()
+
+class BackgroundWriter(object):
+
+    '''
+    Save files on separate threads so workers can go on to render a cutout while it is written.
+
+    Files are written with write_atomic. Once a write finishes, callback(None) is called, or
+    callback(exception) if it failed, so that a manifest is only updated when the file is on
+    disk. Exceptions raised by a callback are printed and the writer carries on.
+    At most *maxsize* files wait in memory before write() blocks.
+
+    *cache*     optional cutout_cache.CutoutCache the contents were downloaded through; a write
+                given the request url is linked to the cache entry instead of written again
+    '''
+
+    def __init__(self,nthreads=1,maxsize=64,cache=None):
+
+        self.cache = cache
+        self.queue = Queue.Queue(maxsize)
+        self.threads = [threading.Thread(target=self._run) for i in range(nthreads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return None
+            filename,content,callback,url = item
+            try:
+                try:
+                    if self.cache is None or url is None or not self.cache.link(url,filename):
+                        write_atomic(filename,content)
+                    error = None
+                except Exception as e:
+                    error = e
+                if callback is not None:
+                    callback(error)
+            except Exception:
+                # A failing callback must not kill the thread, or close() would wait forever
+                sys.stderr.write('BackgroundWriter: callback for {0} failed\n'.format(filename))
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def write(self,filename,content,callback=None,url=None):
+
+        self.queue.put((filename,content,callback,url))
+
+        return None
+
+    def close(self):
+
+        # Finish all pending writes and stop the writer threads
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        return None
+
+_default_downloader = None
+_default_lock = threading.Lock()
+
+def default_downloader(**kwargs):
+
+    # Shared downloader for the module-level get_skyserver_fits functions; keyword arguments only apply on first use
+
+    global _default_downloader
+
+    with _default_lock:
+        if _default_downloader is None:
+            _default_downloader = CutoutDownloader(**kwargs)
+
+    return _default_downloader
@@ -0,0 +1,63 @@
+# Bad-pixel quality cut for multi-plane DECaLS cutouts
+
+from __future__ import division
+import numpy as np
+
+# 20% is a good cut on whether the image is suitable
+badpix_threshold = 0.2
+
+def bad_fraction(images):
+
+    # Fraction of pixels that are zero or NaN, over the last two axes of an image or a stack of images
+
+    '''
+    abs(x) > 0 is False for both 0 and NaN, so a single comparison counts the two together.
+    '''
+
+    npix = images.shape[-2] * images.shape[-1]
+    flat = images.reshape(images.shape[:-2] + (npix,))
+    with np.errstate(invalid='ignore'):
+        ngood = np.count_nonzero(np.abs(flat) > 0,axis=-1)
+
+    return (npix - ngood) / npix
+
+def quality_gate(cube,threshold=badpix_threshold,early_exit=True):
+
+    # Check the bad-pixel fraction in every band of a (3,H,W) cutout, or of a stack of (N,3,H,W) cutouts
+
+    '''
+    Bands are checked in order. With early_exit, a cutout stops being checked as soon as one
+    band reaches the threshold; its remaining bands are reported as NaN.
+
+    Returns a dictionary with
+        fracbad  bad-pixel fraction per band, shape (3,) or (N,3)
+        badmax   worst band, scalar or (N,)
+        good     badmax < threshold, bool or (N,)
+    '''
+
+    cube = np.asarray(cube)
+    single = (cube.ndim == 3)
+    if single:
+        cube = cube[np.newaxis,:,:,:]
+
+    ncube,nband = cube.shape[:2]
+    fracbad = np.zeros((ncube,nband)) + np.nan
+    checking = np.arange(ncube)
+
+    for j in range(nband):
+        if len(checking) == 0:
+            break
+        if len(checking) == ncube:
+            fracbad[:,j] = bad_fraction(cube[:,j,:,:])
+        else:
+            fracbad[checking,j] = bad_fraction(cube[checking,j,:,:])
+        if early_exit:
+            checking = checking[fracbad[checking,j] < threshold]
+
+    badmax = np.nanmax(fracbad,axis=1)
+    good = badmax < threshold
+
+    if single:
+        return {'fracbad':fracbad[0],'badmax':badmax[0],'good':bool(good[0])}
+    else:
+        return {'fracbad':fracbad,'badmax':badmax,'good':good}
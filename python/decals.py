@@ -16,6 +16,10 @@ from StringIO import StringIO
 
 import nw
 import trilogy
+import cutout_download
+import fits_bands
+import cutout_quality
+from rgb_render import dstn_rgb, save_jpeg, dr2_scales, dr2_mnmx
 from copy import deepcopy
 
 gzpath = '/Users/willettk/Astronomy/Research/GalaxyZoo'
@@ -120,10 +124,11 @@ def run_all_bricks(nsa,bricks):
     assert len(nsa_decals) == len(bricks_indices), \
         "Length of nsa_decals (%i) and bricks_indices (%i) must match" % (len(nsa_decals),len(bricks_indices))
 
+    # Gather the matched brick rows for each column in a single pass
+
+    bricks_indices = np.asarray(bricks_indices,dtype=int)
     for bc in bricks.columns:
-        nsa_decals[bc.name] = np.array(len(nsa_decals),dtype=bricks[bc.name].dtype)
-        for ii in range(len(nsa_decals)):
-            nsa_decals[ii][bc.name] = bricks[bricks_indices[ii]][bc.name]
+        nsa_decals[bc.name] = bricks[bc.name][bricks_indices]
 
     # Write to file
 
@@ -259,9 +264,8 @@ def imageserver_fits(ra=114.5970,dec=21.5681,pixscale=2.,size=424):
 
     # Saves as default to file named `decals.fits'
 
-    params = urllib.urlencode({'ra':ra,'dec':dec,'pixscale':pixscale,'size':size})
-    url = "http://imagine.legacysurvey.org/fits-cutout-decals-dr1?%s" % params
-    urllib.urlretrieve(url, "%s/decals/fits/%s.fits" % (gzpath,'decals'))
+    params = {'ra':ra,'dec':dec,'pixscale':pixscale,'size':size}
+    cutout_download.default_downloader().fetch_params(params, "%s/decals/fits/%s.fits" % (gzpath,'decals'), dr='1')
 
     return None
 
@@ -278,35 +282,26 @@ def check_fits_badpixels():
     for gal in galaxies:
         ra,dec = gal['RA'],gal['DEC']
         pixscale = max(gal['PETROTH90']*0.02,min_pixelscale)
-        params = urllib.urlencode({'ra':ra,'dec':dec,'pixscale':pixscale,'size':424})
-        url = "http://imagine.legacysurvey.org/fits-cutout-decals-dr1?%s" % (params)
-        urllib.urlretrieve(url, "%s/decals/fits/%s.fits" % (gzpath,"decals"))
+        params = {'ra':ra,'dec':dec,'pixscale':pixscale,'size':424}
+        cutout_download.default_downloader().fetch_params(params, "%s/decals/fits/%s.fits" % (gzpath,"decals"), dr='1')
 
     # Import into Python
 
         try:
             img,hdr = fits.getdata("%s/decals/fits/%s.fits" % (gzpath,"decals"),0,header=True)
 
-            # Check to see what fraction have zero or NaN pixels
-
-            badmax = 0.
-            for i in range(img.shape[0]):
-                band = img[i,:,:]
-                nbad = (band == 0.).sum() + np.isnan(band).sum()
-                total_pix = np.prod(band.shape)
-                fracbad = nbad / total_pix
+            # Check to see what fraction have zero or NaN pixels; look at every band to report the worst
 
-                #print "%.1f percent bad pixels for %s in band %s" % (fracbad*100,gal['IAUNAME'],hdr['BAND%i' % i])
-                badmax = max(badmax,fracbad)
+            quality = cutout_quality.quality_gate(img,early_exit=False)
 
-            print "Worst band in galaxy %s has %i percent bad pixels" % (gal['IAUNAME'],badmax*100)
+            print "Worst band in galaxy %s has %i percent bad pixels" % (gal['IAUNAME'],quality['badmax']*100)
 
             # 20% is a good cut on whether the image is suitable. 
             # Remaining issues:
             # - high noise levels & saturated colors at outer edges
             # - play with Trilogy and see if I can bring that down
 
-            if badmax < 0.2:
+            if quality['good']:
                 img = imageserver_jpeg(ra,dec,pixscale,424)
                 img.show()
 
@@ -369,19 +364,11 @@ def make_test_images(random_samp=False,public=False):
 
             # Check to see what fraction have zero or NaN pixels
 
-            badmax = 0.
-            for i in range(img.shape[0]):
-                band = img[i,:,:]
-                nbad = (band == 0.).sum() + np.isnan(band).sum()
-                total_pix = np.prod(band.shape)
-                fracbad = nbad / total_pix
-
-                #print "%.1f percent bad pixels for %s in band %s" % (fracbad*100,gal['IAUNAME'],hdr['BAND%i' % i])
-                badmax = max(badmax,fracbad)
+            quality = cutout_quality.quality_gate(img)
 
             firstgoodone = 0
             # 20% cut on whether the image is suitable. 
-            if badmax < 0.2:
+            if quality['good']:
 
                 # Does Skyserver JPEG image exist in test directory?
                 jpeg_filename_test = '%s/decals/imagetests/jpeg_skyserver/%s.jpeg' % (gzpath,gal['IAUNAME'])
@@ -405,8 +392,8 @@ def make_test_images(random_samp=False,public=False):
                 # Does the JPEG image made with Dustin's RGB technique exist?
                 jpeg_filename_dstn = '%s/decals/imagetests/jpeg_dstn/%s.jpeg' % (gzpath,gal['IAUNAME'])
                 if os.path.exists(jpeg_filename_dstn) == False:
-                    rgb_img = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=(-0.5,100.), arcsinh=1., scales=None, desaturate=True)
-                    plt.imsave(jpeg_filename_dstn, rgb_img, origin='lower')
+                    rgb_img = dstn_rgb(img, 'grz', mnmx=(-0.5,100.), arcsinh=1., scales=None, desaturate=True)
+                    save_jpeg(jpeg_filename_dstn, rgb_img)
 
                 # Add to HTML comparison page
                 f.write('  <div class="container">\n')
@@ -463,60 +450,36 @@ def make_test_images(random_samp=False,public=False):
 
     return None
 
-def get_skyserver_fits(gal,fitspath='%s/decals/fits/nsa' % gzpath,remove_multi_fits=True):
+def get_skyserver_fits(gal,fitspath='%s/decals/fits/nsa' % gzpath,remove_multi_fits=True,split=None):
 
     # Get FITS
 
     galname = gal['IAUNAME']
-    params = urllib.urlencode({'ra':gal['RA'],'dec':gal['DEC'],'pixscale':max(min(gal['PETROTH50']*0.04,gal['PETROTH90']*0.02),min_pixelscale),'size':424})
-    url = "http://imagine.legacysurvey.org/fits-cutout-decals-dr1?%s" % (params)
-    urllib.urlretrieve(url, "%s/%s.fits" % (fitspath,galname))
+    fits_filename = "%s/%s.fits" % (fitspath,galname)
+    cutout_download.default_downloader().fetch(gal, fits_filename, dr='1')
 
-    # Write multi-plane FITS images to separate files for each band
+    # Only write separate files for each band if asked to, or if the multi-plane file is being removed.
+    # Otherwise consumers read bands from the cube (fits_bands.get_band) or split it when they need to.
 
-    data,hdr = fits.getdata("%s/%s.fits" % (fitspath,galname),0,header=True)
-    for idx,plane in enumerate('grz'):
-        hdr_copy = hdr.copy()
-        hdr_copy['NAXIS'] = 2
-        hdr_copy['FILTER'] = '%s       ' % plane
-        for badfield in ('BANDS','BAND0','BAND1','BAND2','NAXIS3'):
-            hdr_copy.remove(badfield)
-        fits.writeto("%s/%s_%s.fits" % (fitspath,galname,plane),data[idx,:,:],hdr_copy,clobber=True)
+    if split is None:
+        split = remove_multi_fits
 
+    if split:
+        fits_bands.split_bands(fits_filename,overwrite=True)
 
     if remove_multi_fits:
-        os.remove("%s/%s.fits" % (fitspath,galname))
-    del data,hdr
+        os.remove(fits_filename)
 
     return None
 
 def trilogy_jpeg(galname="J000123.73-005106.9",noiselum=0.15,samplesize=200):
 
-    # Set the Trilogy parameters explicitly for a multi-plane FITS image
-
-    # Create input file for Trilogy
-
-    infile = "%s/decals/imagetests/trilogy.in" % gzpath
-    with open(infile,"w") as f:
-        f.write("B\n")
-        f.write("%s_g.fits\n\n" % galname)
-        f.write("G\n")
-        f.write("%s_r.fits\n\n" % galname)
-        f.write("R\n")
-        f.write("%s_z.fits\n\n" % galname)
-        f.write("indir %s/decals/imagetests/fits/\n" % gzpath) 
-        f.write("outdir %s/decals/imagetests/\n" % gzpath) 
-        f.write("outname %s/decals/imagetests/jpeg_trilogy/%s\n" % (gzpath,galname))
-        f.write("noiselum %.2f\n" % noiselum)
-        f.write("samplesize %i\n" % samplesize)
-        f.write("sampledx 0\n")
-        f.write("sampledy 0\n")
-        f.write("show 0\n")
-        f.write("verbose 0\n")
-        f.write("legend 1\n")
-        f.write("testfirst 0\n")
-
-    trilogy.Trilogy(infile, images=None, **trilogy.params_cl()).run()
+    # Render the multi-plane FITS image with Trilogy, straight from the (g,r,z) cube
+
+    data = fits.getdata("%s/decals/imagetests/fits/%s.fits" % (gzpath,galname),0)
+    params = trilogy.renderparams(noiselum=noiselum,samplesize=samplesize,sampledx=0,sampledy=0,legend=1)
+    im = trilogy.renderimage(data,params,imagesorder='BGR',filters='grz')
+    im.save("%s/decals/imagetests/jpeg_trilogy/%s.png" % (gzpath,galname))
 
     return None
     
@@ -543,14 +506,12 @@ def make_gzh_jpeg(galname,color_scheme='grz',desaturate=True,show_img=True):
 
     ascales,anonlinearity,npix_final,apedestal = get_image_defaults(color_scheme=color_scheme)
 
-    # Load FITS data from original DECaLS files
+    # Load FITS data for each band straight from the original multi-plane DECaLS file
 
-    with fits.open('%s/decals/imagetests/fits/%s_%s.fits' % (gzpath,galname,'g')) as f:
-        img_g_cut = f[0].data
-    with fits.open('%s/decals/imagetests/fits/%s_%s.fits' % (gzpath,galname,'r')) as f:
-        img_r_cut = f[0].data
-    with fits.open('%s/decals/imagetests/fits/%s_%s.fits' % (gzpath,galname,'z')) as f:
-        img_z_cut = f[0].data
+    fits_filename = '%s/decals/imagetests/fits/%s.fits' % (gzpath,galname)
+    img_g_cut = fits_bands.get_band(fits_filename,'g')
+    img_r_cut = fits_bands.get_band(fits_filename,'r')
+    img_z_cut = fits_bands.get_band(fits_filename,'z')
 
     # Check that all image sizes and shapes match
     # If all images don't exist, return assertion error
@@ -643,89 +604,6 @@ def make_gzh_jpeg(galname,color_scheme='grz',desaturate=True,show_img=True):
 
     return img,pdata
 
-def dstn_rgb(imgs, bands, mnmx=None, arcsinh=None, scales=None, desaturate=False):
-
-    '''
-    Given a list of images in the given bands, returns a scaled RGB
-    image.
-
-    *imgs*  a list of numpy arrays, all the same size, in nanomaggies
-    *bands* a list of strings, eg, ['g','r','z']
-    *mnmx*  = (min,max), values that will become black/white *after* scaling.
-           Default is (-3,10)
-    *arcsinh* use nonlinear scaling as in SDSS
-    *scales*
-
-    Returns a (H,W,3) numpy array with values between 0 and 1.
-    '''
-    bands = ''.join(bands)
-
-    grzscales = dict(g = (2, 0.0066),
-                      r = (1, 0.01385),
-                      z = (0, 0.025),
-                      )
-
-    if scales is None:
-        if bands == 'grz':
-            scales = grzscales
-        elif bands == 'urz':
-            scales = dict(u = (2, 0.0066),
-                          r = (1, 0.01),
-                          z = (0, 0.025),
-                          )
-        elif bands == 'gri':
-            scales = dict(g = (2, 0.002),
-                          r = (1, 0.004),
-                          i = (0, 0.005),
-                          )
-        else:
-            scales = grzscales
-        
-    h,w = imgs[0].shape
-    rgb = np.zeros((h,w,3), np.float32)
-    # Convert to ~ sigmas
-    for im,band in zip(imgs, bands):
-        plane,scale = scales[band]
-        rgb[:,:,plane] = (im / scale).astype(np.float32)
-        #print 'rgb: plane', plane, 'range', rgb[:,:,plane].min(), rgb[:,:,plane].max()
-
-    if mnmx is None:
-        mn,mx = -3, 10
-    else:
-        mn,mx = mnmx
-
-    if arcsinh is not None:
-        def nlmap(x):
-            return np.arcsinh(x * arcsinh) / np.sqrt(arcsinh)
-        rgb = nlmap(rgb)
-        mn = nlmap(mn)
-        mx = nlmap(mx)
-
-    rgb = (rgb - mn) / (mx - mn)
-
-    if desaturate:
-        # optionally desaturate pixels that are dominated by a single
-        # colour to avoid colourful speckled sky
-
-        RGBim = np.array([rgb[:,:,0],rgb[:,:,1],rgb[:,:,2]])
-        a = RGBim.mean(axis=0)
-        np.putmask(a, a == 0.0, 1.0)
-        acube = np.resize(a,(3,h,w))
-        bcube = (RGBim / acube) / 2.5
-        mask = np.array(bcube)
-        wt = np.max(mask,axis=0)
-        np.putmask(wt, wt > 1.0, 1.0)
-        wt = 1 - wt
-        wt = np.sin(wt*np.pi/2.0)
-        temp = RGBim * wt + a*(1-wt) + a*(1-wt)**2 * RGBim
-        rgb = np.zeros((h,w,3), np.float32)
-        for idx,im in enumerate((temp[0,:,:],temp[1,:,:],temp[2,:,:])):
-            rgb[:,:,idx] = im
-
-    clipped = np.clip(rgb, 0., 1.)
-
-    return clipped
- 
 def run_tractor(cutdata):
 
     # Try this with a different brick
@@ -756,8 +634,8 @@ def run_nsa(nsa_decals_full,random_samp=True,force_fits=False):
 
     # Set new parameters
 
-    _scales = dict(g = (2, 0.008), r = (1, 0.014), z = (0, 0.019))
-    _mnmx = (-0.5,300)
+    _scales = dr2_scales
+    _mnmx = dr2_mnmx
 
     for i,gal in enumerate(galaxies):
 
@@ -779,16 +657,9 @@ def run_nsa(nsa_decals_full,random_samp=True,force_fits=False):
             try:
                 img,hdr = fits.getdata(fits_filename,0,header=True)
 
-                badmax = 0.
-                for j in range(img.shape[0]):
-                    band = img[j,:,:]
-                    nbad = (band == 0.).sum() + np.isnan(band).sum()
-                    fracbad = nbad / np.prod(band.shape)
-                    badmax = max(badmax,fracbad)
-
-                if badmax < 0.2:
-                    rgbimg = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=_mnmx, arcsinh=1., scales=_scales, desaturate=True)
-                    plt.imsave(jpeg_filename, rgbimg, origin='lower')
+                if cutout_quality.quality_gate(img)['good']:
+                    rgbimg = dstn_rgb(img, 'grz', mnmx=_mnmx, arcsinh=1., scales=_scales, desaturate=True)
+                    save_jpeg(jpeg_filename, rgbimg)
             except IOError:
                 print "Couldn't find image for %s" % fits_filename
 
@@ -842,18 +713,11 @@ def test_images_etgs(public=False):
 
             # Check to see what fraction have zero or NaN pixels
 
-            badmax = 0.
-            for i in range(img.shape[0]):
-                band = img[i,:,:]
-                nbad = (band == 0.).sum() + np.isnan(band).sum()
-                total_pix = np.prod(band.shape)
-                fracbad = nbad / total_pix
-
-                badmax = max(badmax,fracbad)
+            quality = cutout_quality.quality_gate(img)
 
             firstgoodone = 0
             # 20% cut on whether the image is suitable. 
-            if badmax < 0.2:
+            if quality['good']:
 
                 # Does Skyserver JPEG image exist in test directory?
                 jpeg_filename_test = '%s/decals/imagetests/jpeg_skyserver/%s.jpeg' % (gzpath,gal['IAUNAME'])
@@ -877,8 +741,8 @@ def test_images_etgs(public=False):
                 # Does the JPEG image made with Dustin's RGB technique exist?
                 jpeg_filename_dstn = '%s/decals/imagetests/jpeg_dstn/%s.jpeg' % (gzpath,gal['IAUNAME'])
                 #if os.path.exists(jpeg_filename_dstn) == False:
-                rgb_img = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=(_min,_max), arcsinh=1., scales=myscales, desaturate=True)
-                plt.imsave(jpeg_filename_dstn, rgb_img, origin='lower')
+                rgb_img = dstn_rgb(img, 'grz', mnmx=(_min,_max), arcsinh=1., scales=myscales, desaturate=True)
+                save_jpeg(jpeg_filename_dstn, rgb_img)
 
                 # Add to HTML comparison page
                 f.write('  <div class="container">\n')
@@ -979,8 +843,8 @@ def colortests():
                 # Does the JPEG image made with Dustin's RGB technique exist?
                 filename = "%s_%.3fg_%.3fr_%.3fz.jpeg" % (IAUNAME,g,r,z)
                 jpeg_filename = '%s/decals/imagetests/colortests/%s' % (gzpath,filename)
-                rgb_img = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=(-0.5,100.), arcsinh=1., scales=myscales, desaturate=True)
-                plt.imsave(jpeg_filename, rgb_img, origin='lower')
+                rgb_img = dstn_rgb(img, 'grz', mnmx=(-0.5,100.), arcsinh=1., scales=myscales, desaturate=True)
+                save_jpeg(jpeg_filename, rgb_img)
 
                 # Add to HTML comparison page
                 imsize = 250
@@ -998,8 +862,8 @@ def colortests():
         for _max in maxarr:
             filename = "%s_min%.3f_max%.3f.jpg" % (IAUNAME,_min,_max)
             jpeg_filename = '%s/decals/imagetests/colortests/%s' % (gzpath,filename)
-            rgb_img = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=(_min,_max), arcsinh=1., scales=myscales, desaturate=True)
-            plt.imsave(jpeg_filename, rgb_img, origin='lower')
+            rgb_img = dstn_rgb(img, 'grz', mnmx=(_min,_max), arcsinh=1., scales=myscales, desaturate=True)
+            save_jpeg(jpeg_filename, rgb_img)
             
             imsize = 250
             
@@ -1,7 +1,6 @@
 # Do some preliminary analysis on the results of the DECaLS-Galaxy Zoo data. 
 
 from astropy.io import fits
-from astropy.cosmology import WMAP9
 
 from matplotlib import pyplot as plt
 from matplotlib import cm
@@ -10,9 +9,10 @@ from matplotlib.colors import LogNorm
 from collections import Counter
 import numpy as np
 import re
-import pandas as pd
 
-from gz_class import plurality
+from gz_class import plurality_batch
+from column_cache import fits_columns, csv_columns
+from cosmology_table import cosmology_table
 
 gzpath = '/Users/willettk/Astronomy/Research/GalaxyZoo'
 decals_path = '{0}/decals'.format(gzpath)
@@ -31,9 +31,11 @@ Kyle Willett (UMN) - 10 Dec 2015
 
 def load_data():
 
-    mgs = fits.getdata('{0}/matched/gz2_main.fits'.format(decals_path),1)
-    s82 = fits.getdata('{0}/matched/gz2_s82_coadd1.fits'.format(decals_path),1)
-    decals = fits.getdata('{0}/matched/decals_dr1.fits'.format(decals_path),1)
+    # Columns are parsed from the FITS files once, then read from the column cache as the plots need them
+
+    mgs = fits_columns('{0}/matched/gz2_main.fits'.format(decals_path))
+    s82 = fits_columns('{0}/matched/gz2_s82_coadd1.fits'.format(decals_path))
+    decals = fits_columns('{0}/matched/decals_dr1.fits'.format(decals_path))
 
     return mgs,s82,decals
 
@@ -54,7 +56,7 @@ def color_mag_plots(mgs,s82,decals,savefig=False):
     fig,axarr = plt.subplots(num=1,nrows=3,ncols=3,figsize=(12,10))
 
     for z,ax in zip(redshifts,axarr.ravel()):
-        absmag_lim = appmag_lim - WMAP9.distmod(z).value
+        absmag_lim = appmag_lim - cosmology_table().distmod(z)
         maglim = (mgs['PETROMAG_MR'] < absmag_lim) & (mgs['REDSHIFT'] <= z)
         spiral = mgs['t01_smooth_or_features_a02_features_or_disk_weighted_fraction'] >= 0.8
         elliptical = mgs['t01_smooth_or_features_a01_smooth_weighted_fraction'] >= 0.8
@@ -70,7 +72,7 @@ def color_mag_plots(mgs,s82,decals,savefig=False):
 
     s82_lim = 17.77
     for z,ax in zip(redshifts,axarr.ravel()[3:6]):
-        absmag_lim = s82_lim - WMAP9.distmod(z).value
+        absmag_lim = s82_lim - cosmology_table().distmod(z)
         maglim = (s82['PETROMAG_MR'] < absmag_lim) & (s82['REDSHIFT'] <= z)
         spiral = s82['t01_smooth_or_features_a02_features_or_disk_weighted_fraction'] >= 0.8
         elliptical = s82['t01_smooth_or_features_a01_smooth_weighted_fraction'] >= 0.8
@@ -83,7 +85,7 @@ def color_mag_plots(mgs,s82,decals,savefig=False):
 
     decals_lim = 17.77
     for z,ax in zip(redshifts,axarr.ravel()[6:]):
-        absmag_lim = decals_lim - WMAP9.distmod(z).value
+        absmag_lim = decals_lim - cosmology_table().distmod(z)
         maglim = (decals['metadata.mag.abs_r'] < absmag_lim) & (decals['metadata.redshift'] <= z)
         spiral = decals['t00_smooth_or_features_a1_features_frac'] >= 0.8
         elliptical = decals['t00_smooth_or_features_a0_smooth_frac'] >= 0.8
@@ -143,7 +145,7 @@ def color_mag_ratio(mgs,s82,decal,savefig=False):
 
     for ax,d in zip(axarr.ravel(),datasets):
         for z,ls in zip(redshifts,linestyles):
-            absmag_lim = d['appmag'] - WMAP9.distmod(z).value
+            absmag_lim = d['appmag'] - cosmology_table().distmod(z)
             maglim = (d['data'][d['absr']] < absmag_lim) & (d['data'][d['redshift']] <= z)
             spiral = d['data'][d['sp']] >= 0.8
             elliptical = d['data'][d['el']] >= 0.8
@@ -175,7 +177,7 @@ def feature_comparison(savefig=False):
 
     filename = '{0}/fits/decals_gz2_union.fits'.format(decals_path)
 
-    data = fits.getdata(filename,1)
+    data = fits_columns(filename)
 
     # Map the columns
     matched_cols = [{'title':'smooth',                   'gz2':"gz2_t01_smooth_or_features_a01_smooth_fraction",             "decals":"decals_t00_smooth_or_features_a0_smooth_frac"},
@@ -214,25 +216,18 @@ def feature_comparison(savefig=False):
     columns = data.columns
 
     decals_fraccols,gz2_fraccols = [],[]
-    for c in columns:
-        colname = c.name
+    for colname in columns:
         if len(colname) > 6:
             if colname[-4:] == 'frac' and colname[:6] == 'decals':
-                decals_fraccols.append(c)
+                decals_fraccols.append(colname)
         if len(colname) > 17:
             if colname[-8:] == 'fraction' and colname[-17:] != "weighted_fraction" and colname[:3] == 'gz2':
-                gz2_fraccols.append(c)
+                gz2_fraccols.append(colname)
 
-    decals_votearr = data.from_columns(decals_fraccols)
-    gz2_votearr = data.from_columns(gz2_fraccols)
-
-    decals_tasks,gz2_tasks = [],[]
-    for v in decals_votearr:
-        e_decals,a_decals = plurality(np.array(list(v)),'decals') 
-        decals_tasks.append(e_decals)
-    for v in gz2_votearr:
-        e_gz2,a_gz2 = plurality(np.array(list(v)),'gz2') 
-        gz2_tasks.append(e_gz2)
+    decals_votes = data[decals_fraccols]
+    gz2_votes = data[gz2_fraccols]
+    decals_tasks,a_decals = plurality_batch(decals_votes,'decals')
+    gz2_tasks,a_gz2 = plurality_batch(gz2_votes,'gz2')
 
 
     fig,axarr = plt.subplots(num=1,nrows=4,ncols=8,figsize=(16,10))
@@ -325,7 +320,7 @@ def morphology_distribution(survey='decals'):
     
     try:
         collation_file = "{0}/gz_reduction_sandbox/data/decals_unweighted_classifications_00.csv".format(gzpath)
-        collated = pd.read_csv(collation_file)
+        collated = csv_columns(collation_file)
     except IOError:
         print "Collation file for {0:} does not exist. Aborting.".format(survey)
         return None
@@ -362,14 +357,7 @@ def morphology_distribution(survey='decals'):
     # Make pie charts of the plurality votes
 
     votearr = np.array(collated[fraccols])
-    class_arr,task_arr,task_ans = [],[],[]
-    for v in votearr:
-        e,a = plurality(v,survey) 
-        task_arr.append(e)
-        task_ans.append(a)
-
-    task_arr = np.array(task_arr)
-    task_ans = np.array(task_ans)
+    task_arr,task_ans = plurality_batch(votearr,survey)
 
     fig,axarr = plt.subplots(nrows=nrows,ncols=ncols,figsize=(15,12))
 
@@ -422,13 +410,13 @@ def morph_table_gz2():
                 collation_file = "{0}/decals/csv/decals_gz2_stripe82c1.csv".format(gzpath)
             elif survey == 'decals':
                 collation_file = "{0}/decals/csv/decals_gz2_union.csv".format(gzpath)
-            collated = pd.read_csv(collation_file)
+            collated = csv_columns(collation_file)
         else:
             if survey == 'gz2':
                 collation_file = "{0}/dr10/dr10_gz2_main_specz.csv".format(gzpath)
             elif survey == 'stripe82':
                 collation_file = "{0}/dr10/dr10_gz2_stripe82_coadd1.csv".format(gzpath)
-            collated = pd.read_csv(collation_file,names=colnames)
+            collated = csv_columns(collation_file,names=colnames)
     except IOError:
         print "Collation file for {0:} does not exist. Aborting.".format(survey)
         return None
@@ -477,14 +465,7 @@ def morph_table_gz2():
     # Make pie charts of the plurality votes
 
     votearr = np.array(collated[fraccols])
-    class_arr,task_arr,task_ans = [],[],[]
-    for v in votearr:
-        e,a = plurality(v,survey) 
-        task_arr.append(e)
-        task_ans.append(a)
-
-    task_arr = np.array(task_arr)
-    task_ans = np.array(task_ans)
+    task_arr,task_ans = plurality_batch(votearr,survey)
 
     fig,axarr = plt.subplots(nrows=nrows,ncols=ncols,figsize=(15,12))
 
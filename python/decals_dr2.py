@@ -4,7 +4,6 @@ from __future__ import division
 from astropy.io import fits
 from astropy.table import Table
 import numpy as np
-from matplotlib import pyplot as plt
 import progressbar as pb
 
 import requests
@@ -14,6 +13,13 @@ import os,urllib
 import errno
 import subprocess
 
+import cutout_download
+import fits_bands
+from cutout_quality import quality_gate
+from download_manifest import DownloadManifest
+from cutout_cache import CutoutCache
+from rgb_render import dstn_rgb, save_jpegs, dr2_scales, dr2_mnmx
+
 min_pixelscale = 0.10
 
 def get_nsa_images(nsa_version):
@@ -87,7 +93,107 @@ def find_matching_brick(gal,bricks):
 
     return nmatch,coomatch
 
-def run_all_bricks(nsa,bricks,dr,nsa_version,run_to=-1):
+def build_brick_index(bricks,cellsize=0.25):
+
+    # Build a regular RA/dec grid over the DECaLS bricks so galaxies can be matched without scanning every brick
+
+    '''
+    Each brick is registered in every grid cell its (ra1,ra2] x (dec1,dec2] footprint touches.
+    The (cell, brick) pairs are sorted by cell and then by brick row, so the candidates for any
+    cell are a contiguous slice in ascending brick order. Build this once per data release
+    and pass it to match_bricks for every set of galaxies.
+    '''
+
+    ra1 = np.asarray(bricks['ra1'],dtype=np.float64)
+    ra2 = np.asarray(bricks['ra2'],dtype=np.float64)
+    dec1 = np.asarray(bricks['dec1'],dtype=np.float64)
+    dec2 = np.asarray(bricks['dec2'],dtype=np.float64)
+
+    # Bricks with an empty footprint can never satisfy the matching criteria; leave them out of the grid
+    valid = (ra2 > ra1) & (dec2 > dec1)
+
+    ra0 = ra1[valid].min()
+    dec0 = dec1[valid].min()
+
+    i1 = np.floor((ra1 - ra0) / cellsize).astype(np.int64)
+    i2 = np.floor((ra2 - ra0) / cellsize).astype(np.int64)
+    j1 = np.floor((dec1 - dec0) / cellsize).astype(np.int64)
+    j2 = np.floor((dec2 - dec0) / cellsize).astype(np.int64)
+
+    nra = i2[valid].max() + 1
+    ndec = j2[valid].max() + 1
+
+    ni = np.where(valid,i2 - i1 + 1,0)
+    nj = np.where(valid,j2 - j1 + 1,0)
+    ncells = ni * nj
+
+    # Expand every brick into the list of grid cells it covers
+    brick_id = np.repeat(np.arange(len(ra1)),ncells)
+    k = np.arange(len(brick_id)) - np.repeat(np.cumsum(ncells) - ncells,ncells)
+    cell = (j1[brick_id] + k // ni[brick_id]) * nra + (i1[brick_id] + k % ni[brick_id])
+
+    order = np.lexsort((brick_id,cell))
+
+    index = {'cellsize':cellsize,
+             'ra0':ra0,
+             'dec0':dec0,
+             'nra':nra,
+             'ndec':ndec,
+             'cells':cell[order],
+             'bricks':brick_id[order],
+             'ra1':ra1,
+             'ra2':ra2,
+             'dec1':dec1,
+             'dec2':dec2}
+
+    return index
+
+def match_bricks(ra,dec,index):
+
+    # Vectorized version of find_matching_brick for an entire array of (RA,dec) positions
+
+    '''
+    Uses the same criteria as find_matching_brick: ra1 < RA <= ra2 and dec1 < dec <= dec2.
+
+    Returns
+        nmatch: number of bricks covering each position
+        first:  row in the brick table of the first covering brick (same as coomatch.argmax()),
+                or -1 if there is no match
+    '''
+
+    ra = np.asarray(ra,dtype=np.float64)
+    dec = np.asarray(dec,dtype=np.float64)
+
+    nmatch = np.zeros(len(ra),dtype=int)
+    first = np.zeros(len(ra),dtype=int) - 1
+
+    finite = np.isfinite(ra) & np.isfinite(dec)
+    ii = np.zeros(len(ra),dtype=np.int64) - 1
+    jj = np.zeros(len(ra),dtype=np.int64) - 1
+    ii[finite] = np.floor((ra[finite] - index['ra0']) / index['cellsize'])
+    jj[finite] = np.floor((dec[finite] - index['dec0']) / index['cellsize'])
+    ingrid = finite & (ii >= 0) & (ii < index['nra']) & (jj >= 0) & (jj < index['ndec'])
+
+    qcell = jj * index['nra'] + ii
+    start = np.searchsorted(index['cells'],qcell,side='left')
+    depth = np.searchsorted(index['cells'],qcell,side='right') - start
+    depth[~ingrid] = 0
+
+    # Step through the candidate bricks of every cell in parallel; cells hold only a handful of bricks
+    for k in range(depth.max() if len(depth) > 0 else 0):
+        rows = np.flatnonzero(depth > k)
+        b = index['bricks'][start[rows] + k]
+        r,d = ra[rows],dec[rows]
+        hit = (index['ra1'][b] < r) & (index['ra2'][b] >= r) & (index['dec1'][b] < d) & (index['dec2'][b] >= d)
+        rows,b = rows[hit],b[hit]
+        nmatch[rows] += 1
+        # Candidates are in ascending brick order, so the first hit is the lowest-numbered brick
+        unset = first[rows] < 0
+        first[rows[unset]] = b[unset]
+
+    return nmatch,first
+
+def run_all_bricks(nsa,bricks,dr,nsa_version,run_to=-1,brick_index=None,verbose=False):
 
     # Create a matched catalogue of all NSA sources that have grz imaging in DECaLS and match the galaxy selection criteria
 
@@ -115,41 +221,48 @@ def run_all_bricks(nsa,bricks,dr,nsa_version,run_to=-1):
     ralim = ((nsa['RA'] > 7/24. * 360) & (nsa['RA'] < 18/24. * 360)) | (nsa['RA'] < 3/24. * 360) | (nsa['RA'] > 21/24. * 360)
     declim = (nsa['DEC'] >= brick_mindec) & (nsa['DEC'] <= brick_maxdec)
 
-    total_matches = 0
-    multi_matches = 0
+    # Match every candidate galaxy at once against a spatial index of the bricks
+
+    if brick_index is None:
+        brick_index = build_brick_index(bricks)
+
+    searched = np.zeros(len(nsa),dtype=bool)
+    searched[np.arange(len(nsa))[:run_to]] = True
+    searched &= (declim & ralim)
+
+    nm,first = match_bricks(nsa['RA'][searched],nsa['DEC'][searched],brick_index)
+
     decals_indices = np.zeros(len(nsa),dtype=bool)
-    bricks_indices = []
+    decals_indices[np.flatnonzero(searched)[nm > 0]] = True
+    bricks_indices = first[nm > 0]
 
-    widgets = ['Matching: ', pb.Percentage(), ' ', pb.Bar(marker='0',left='[',right=']'), ' ', pb.ETA()]
-    pbar = pb.ProgressBar(widgets=widgets, maxval=len(nsa[:run_to]))
-    pbar.start()
-    for idx,gal in enumerate(nsa[:run_to]):
-        if (declim & ralim)[idx]:
-            nm,coomatch = find_matching_brick(gal,bricks)
-            if nm > 0:
-                total_matches += 1
-                decals_indices[idx] = True
-                bricks_indices.append(coomatch.argmax())
-            if nm > 1:
-                multi_matches += 1
-        pbar.update(idx + 1)
-        #if idx % 100 == 0 and idx > 0:
-        #    print '{0:6d} galaxies searched, {1:6d} matches so far'.format(idx,total_matches)
-    pbar.finish()
+    total_matches = (nm > 0).sum()
+    multi_matches = (nm > 1).sum()
 
     print '{0:6d} total matches between NASA-Sloan Atlas and DECaLS DR{1}'.format(total_matches, dr)
     print '{0:6d} galaxies had matches in more than one brick'.format(multi_matches)
 
+    # Should only be 1 brick per galaxy max; with verbose, list the bricks covering any that match more
+
+    if verbose:
+        for idx in np.flatnonzero(searched)[nm > 1]:
+            gal = nsa[idx]
+            nmatch,coomatch = find_matching_brick(gal,bricks)
+            print 'Attention: {0:d} matches for NSA {1} ({2:.3f},{3:.3f})'.format(nmatch,gal['IAUNAME'],gal['RA'],gal['DEC'])
+            for ib,brick in enumerate(bricks[coomatch]):
+                print '\tBrick #{0:d}: RA from {1:.3f} to {2:.3f}, dec from {3:.3f} to {4:.3f}'.format(ib,brick['ra1'],brick['ra2'],brick['dec1'],brick['dec2'])
+
     nsa_table = Table(nsa)
     nsa_decals = nsa_table[decals_indices]
 
     assert len(nsa_decals) == len(bricks_indices), \
         "Length of nsa_decals ({0}) and bricks_indices ({1}) must match".format(len(nsa_decals),len(bricks_indices))
 
+    # Gather the matched brick rows for each column in a single pass
+
+    bricks_indices = np.asarray(bricks_indices,dtype=int)
     for bc in bricks.columns:
-        nsa_decals[bc.name] = np.array(len(nsa_decals),dtype=bricks[bc.name].dtype)
-        for ii in range(len(nsa_decals)):
-            nsa_decals[ii][bc.name] = bricks[bricks_indices[ii]][bc.name]
+        nsa_decals[bc.name] = bricks[bc.name][bricks_indices]
 
     # Write to file
     # Check what version of the NSA is being used and set string variable below
@@ -159,125 +272,33 @@ def run_all_bricks(nsa,bricks,dr,nsa_version,run_to=-1):
 
     return nsa_decals
 
-def get_skyserver_fits(gal,fitspath,dr='1',remove_multi_fits=True):
+def get_skyserver_fits(gal,fitspath,dr='1',remove_multi_fits=True,downloader=None,split=None):
 
     # Download a multi-plane FITS image from the DECaLS skyserver
 
-    # Get FITS
+    # Get FITS over the shared keep-alive connection pool
+
+    if downloader is None:
+        downloader = cutout_download.default_downloader()
 
     galname = gal['IAUNAME']
-    params = urllib.urlencode({'ra':gal['RA'],'dec':gal['DEC'],'pixscale':max(min(gal['PETROTH50']*0.04,gal['PETROTH90']*0.02),min_pixelscale),'size':424})
-    if dr == '1':
-        url = "http://imagine.legacysurvey.org/fits-cutout-decals-dr1?{0}".format(params)
-    elif dr == '2':
-        url = "http://legacysurvey.org/viewer/fits-cutout-decals-dr2?{0}".format(params)
-    #sp = subprocess.call(['curl', '-o', '{0}/{1}.fits'.format(fitspath, galname), url])
-    #sp = subprocess.call(['wget', '-O', '{0}/{1}.fits'.format(fitspath, galname), url])
-    urllib.urlretrieve(url, "{0}/{1}.fits".format(fitspath,galname))
+    fits_filename = "{0}/{1}.fits".format(fitspath,galname)
+    downloader.fetch(gal,fits_filename,dr)
 
-    # Write multi-plane FITS images to separate files for each band
+    # Only write separate files for each band if asked to, or if the multi-plane file is being removed.
+    # Otherwise consumers read bands from the cube (fits_bands.get_band) or split it when they need to.
 
-    data,hdr = fits.getdata("{0}/{1}.fits".format(fitspath,galname),0,header=True)
-    for idx,plane in enumerate('grz'):
-        hdr_copy = hdr.copy()
-        hdr_copy['NAXIS'] = 2
-        hdr_copy['FILTER'] = '{0}       '.format(plane)
-        for badfield in ('BANDS','BAND0','BAND1','BAND2','NAXIS3'):
-            hdr_copy.remove(badfield)
-        fits.writeto("{0}/{1}_{2}.fits".format(fitspath,galname,plane),data[idx,:,:],hdr_copy,clobber=True)
+    if split is None:
+        split = remove_multi_fits
 
+    if split:
+        fits_bands.split_bands(fits_filename,overwrite=True)
 
     if remove_multi_fits:
-        os.remove("{0}/{1}.fits".format(fitspath,galname))
-    del data,hdr
+        os.remove(fits_filename)
 
     return None
 
-def dstn_rgb(imgs, bands, mnmx=None, arcsinh=None, scales=None, desaturate=False):
-
-    # Create an RGB jpeg from a FITS image using Dustin Lang's technique
-
-    '''
-    Given a list of images in the given bands, returns a scaled RGB
-    image.
-
-    *imgs*  a list of numpy arrays, all the same size, in nanomaggies
-    *bands* a list of strings, eg, ['g','r','z']
-    *mnmx*  = (min,max), values that will become black/white *after* scaling.
-           Default is (-3,10)
-    *arcsinh* use nonlinear scaling as in SDSS
-    *scales*
-
-    Returns a (H,W,3) numpy array with values between 0 and 1.
-    '''
-    bands = ''.join(bands)
-
-    grzscales = dict(g = (2, 0.0066),
-                      r = (1, 0.01385),
-                      z = (0, 0.025),
-                      )
-
-    if scales is None:
-        if bands == 'grz':
-            scales = grzscales
-        elif bands == 'urz':
-            scales = dict(u = (2, 0.0066),
-                          r = (1, 0.01),
-                          z = (0, 0.025),
-                          )
-        elif bands == 'gri':
-            scales = dict(g = (2, 0.002),
-                          r = (1, 0.004),
-                          i = (0, 0.005),
-                          )
-        else:
-            scales = grzscales
-
-    h,w = imgs[0].shape
-    rgb = np.zeros((h,w,3), np.float32)
-    # Convert to ~ sigmas
-    for im,band in zip(imgs, bands):
-        plane,scale = scales[band]
-        rgb[:,:,plane] = (im / scale).astype(np.float32)
-        #print 'rgb: plane', plane, 'range', rgb[:,:,plane].min(), rgb[:,:,plane].max()
-
-    if mnmx is None:
-        mn,mx = -3, 10
-    else:
-        mn,mx = mnmx
-
-    if arcsinh is not None:
-        def nlmap(x):
-            return np.arcsinh(x * arcsinh) / np.sqrt(arcsinh)
-        rgb = nlmap(rgb)
-        mn = nlmap(mn)
-        mx = nlmap(mx)
-
-    rgb = (rgb - mn) / (mx - mn)
-
-    if desaturate:
-        # optionally desaturate pixels that are dominated by a single
-        # colour to avoid colourful speckled sky
-
-        RGBim = np.array([rgb[:,:,0],rgb[:,:,1],rgb[:,:,2]])
-        a = RGBim.mean(axis=0)
-        np.putmask(a, a == 0.0, 1.0)
-        acube = np.resize(a,(3,h,w))
-        bcube = (RGBim / acube) / 2.5
-        mask = np.array(bcube)
-        wt = np.max(mask,axis=0)
-        np.putmask(wt, wt > 1.0, 1.0)
-        wt = 1 - wt
-        wt = np.sin(wt*np.pi/2.0)
-        temp = RGBim * wt + a*(1-wt) + a*(1-wt)**2 * RGBim
-        rgb = np.zeros((h,w,3), np.float32)
-        for idx,im in enumerate((temp[0,:,:],temp[1,:,:],temp[2,:,:])):
-            rgb[:,:,idx] = im
-
-    clipped = np.clip(rgb, 0., 1.)
-
-    return clipped
-
 def make_sure_path_exists(path):
 
     # Check if a local path exists; if not, create it.
@@ -288,9 +309,10 @@ def make_sure_path_exists(path):
         if e.errno != errno.EEXIST:
             raise
 
-def run_nsa(nsa_decals,dr='2',nsa_version = '1_0_0',random_samp=True,force_fits=False):
+def run_nsa(nsa_decals,dr='2',nsa_version = '1_0_0',random_samp=True,force_fits=False,inverted=True,thumbnail=True):
 
     # For galaxies with coverage in the DECaLS bricks, download FITS images and make JPGs
+    # (standard, plus optionally inverted and thumbnail versions made from the same render)
 
     if random_samp:
         N = 101
@@ -300,8 +322,8 @@ def run_nsa(nsa_decals,dr='2',nsa_version = '1_0_0',random_samp=True,force_fits=
 
     # Set new parameters
 
-    _scales = dict(g = (2, 0.008), r = (1, 0.014), z = (0, 0.019))
-    _mnmx = (-0.5,300)
+    _scales = dr2_scales
+    _mnmx = dr2_mnmx
 
     good_images = np.zeros(len(galaxies),dtype=bool)
 
@@ -313,8 +335,18 @@ def run_nsa(nsa_decals,dr='2',nsa_version = '1_0_0',random_samp=True,force_fits=
     jpegpath = '../jpeg/dr2'
     make_sure_path_exists(jpegpath)
 
-    logfile = "../failed_fits_downloads.log"
-    flog = open(logfile,'w')
+    inverted_path = '../jpeg/dr2_inverted' if inverted else None
+    thumbnail_path = '../jpeg/dr2_thumbnail' if thumbnail else None
+    for path in (inverted_path,thumbnail_path):
+        if path is not None:
+            make_sure_path_exists(path)
+
+    # Per-galaxy progress is kept in a persistent manifest so restarts skip finished galaxies
+
+    manifest = DownloadManifest('../fits/nsa_v{0}_decals_dr{1}_manifest.db'.format(nsa_version,dr))
+    jpegpaths = [path for path in (jpegpath,inverted_path,thumbnail_path) if path is not None]
+    manifest.queue(galaxies,dr,force=force_fits,fitspath=fitspath,jpegpaths=jpegpaths)
+    states = manifest.states()
     timed_out = np.zeros(len(galaxies),dtype=bool)
 
     widgets = ['Downloads: ', pb.Percentage(), ' ', pb.Bar(marker='0',left='[',right=']'), ' ', pb.ETA()]
@@ -322,52 +354,54 @@ def run_nsa(nsa_decals,dr='2',nsa_version = '1_0_0',random_samp=True,force_fits=
     pbar.start()
     for i,gal in enumerate(galaxies):
 
-        # Check if FITS image already exists
+        galname = gal['IAUNAME']
+        state = states[galname]
 
-        fits_filename = '{0}/{1}.fits'.format(fitspath,gal['IAUNAME'])
-        if os.path.exists(fits_filename) == False or force_fits:
+        # Download the FITS image unless the manifest already has it
+
+        fits_filename = '{0}/{1}.fits'.format(fitspath,galname)
+        if state in ('queued','failed'):
             try:
                 get_skyserver_fits(gal,fitspath,dr,remove_multi_fits=False)
-            except IOError:
-                print "IOError downloading {0}".format(gal['IAUNAME'])
+                state = 'downloaded'
+                manifest.set_state(galname,state)
+            except (IOError,OSError) as e:
+                print "IOError downloading {0}".format(galname)
                 timed_out[i] = True
-                print >> flog,gal['IAUNAME']
+                manifest.failed(galname,'download: {0!r}'.format(e))
 
-        # Check if new JPEG image already exists
+        # Make the JPEG unless the manifest already has it rendered (or rejected for bad pixels)
 
-        jpeg_filename = '{0}/{1}.jpeg'.format(jpegpath,gal['IAUNAME'])
-        if os.path.exists(jpeg_filename) == False:
+        jpeg_filenames = ['{0}/{1}.jpeg'.format(path,galname) if path is not None else None for path in (jpegpath,inverted_path,thumbnail_path)]
+        if state == 'downloaded':
             if os.path.exists(fits_filename):
                 try:
                     img,hdr = fits.getdata(fits_filename,0,header=True)
 
-                    badmax = 0.
-                    for j in range(img.shape[0]):
-                        band = img[j,:,:]
-                        nbad = (band == 0.).sum() + np.isnan(band).sum()
-                        fracbad = nbad / np.prod(band.shape)
-                        badmax = max(badmax,fracbad)
+                    quality = quality_gate(img)
 
-                    if badmax < 0.2:
-                        rgbimg = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=_mnmx, arcsinh=1., scales=_scales, desaturate=True)
-                        plt.imsave(jpeg_filename, rgbimg, origin='lower')
+                    if quality['good']:
+                        rgbimg = dstn_rgb(img, 'grz', mnmx=_mnmx, arcsinh=1., scales=_scales, desaturate=True)
+                        save_jpegs(rgbimg, *jpeg_filenames)
+                        manifest.set_state(galname,'rendered',fracbad=quality['fracbad'])
                         good_images[i] = True
-                except:
-                    print "Other download error for {0}".format(gal['IAUNAME'])
+                    else:
+                        manifest.set_state(galname,'rejected','bad pixel fraction {0:.3f}'.format(quality['badmax']),quality['fracbad'])
+                except Exception as e:
+                    print "Other download error for {0}".format(galname)
                     timed_out[i] = True
-                    print >> flog,gal['IAUNAME']
+                    manifest.failed(galname,'render: {0!r}'.format(e))
             else:
                 print "Could not find FITS file for {0}".format(fits_filename)
-        else:
-            # JPEG file already exists, so it's assumed to be a good image
+                manifest.failed(galname,'missing FITS file {0}'.format(fits_filename))
+        elif state == 'rendered':
             good_images[i] = True
         pbar.update(i + 1)
         #if not i % 10 and i > 0:
         #    print '{0:5d}/{1:5d} galaxies completed; {2}'.format(i,len(galaxies),datetime.datetime.now().strftime("%H:%M:%S"))
     pbar.finish()
 
-    # Close logging file for timed-out errors from server
-    flog.close()
+    manifest.close()
     galaxies[timed_out].write('../fits/nsa_v{0}_decals_dr{1}_timedout.fits'.format(nsa_version,dr),overwrite=True)
 
     # Write good images to file
@@ -380,6 +414,10 @@ def run_nsa(nsa_decals,dr='2',nsa_version = '1_0_0',random_samp=True,force_fits=
     print "{0} galaxies with bad pixels".format(len(galaxies) - sum(good_images))
     print "{0} galaxies timed out downloading data from Legacy Skyserver".format(sum(timed_out))
 
+    cache = cutout_download.default_downloader().cache
+    if cache is not None:
+        print "Cutout cache: {hits} hits, {misses} misses, {evictions} evicted, {bytes} bytes in {entries} cutouts".format(**cache.stats())
+
     return None
 
 if __name__ == "__main__":
@@ -392,4 +430,7 @@ if __name__ == "__main__":
     #bricks = get_decals_bricks(dr)
     #nsa_decals = run_all_bricks(nsa,bricks,dr,nsa_version,run_to=-1)
     nsa_decals = Table(fits.getdata('../fits/nsa_v{0}_decals_dr{1}_after_cuts.fits'.format(nsa_version, dr), 1))
+
+    # Reuse cutouts already downloaded with identical request parameters (up to 100 GB on disk)
+    cutout_download.default_downloader(cache=CutoutCache('../fits/cutout_cache', max_bytes=100e9))
     run_nsa(nsa_decals,dr,random_samp=False,force_fits=False)
@@ -1,18 +1,24 @@
 from __future__ import division
 from astropy.io import fits
 from astropy.table import Table
-from matplotlib import pyplot as plt
 import numpy as np
-from decals_dr2 import dstn_rgb
+from rgb_render import dstn_rgb, save_jpegs, dr2_scales, dr2_mnmx
+from cutout_download import default_downloader, BackgroundWriter
+from cutout_cache import CutoutCache
+import fits_bands
+from cutout_quality import quality_gate
+from download_manifest import DownloadManifest, finished_states
 import progressbar as pb
 
-import os,urllib
+import os
 from multiprocessing.dummy import Pool as ThreadPool
 from multiprocessing import Value, Lock
 
 widgets = ['Downloads: ', pb.Percentage(), ' ', pb.Bar(marker='0',left='[',right=']'), ' ', pb.ETA()]
 cdx = 0
 pbar = 0
+manifest = 0
+writer = 0
 class Counter(object):
     def __init__(self, initval=0):
         self.val = Value('i', initval)
@@ -27,76 +33,91 @@ class Counter(object):
         with self.lock:
             return self.val.value
 
-min_pixelscale = 0.10
 def get_skyserver_fits(gal,fitspath='../fits/nsa',dr='2',remove_multi_fits=False):
     timed_out = False
     good_images = False
     # Download a multi-plane FITS image from the DECaLS skyserver
 
-    # Get FITS
+    # Get FITS unless the manifest already has it downloaded
     galname = gal['IAUNAME']
     fits_filename = "{0}/{1}.fits".format(fitspath, galname)
-    if os.path.exists(fits_filename) == False:
-        params = urllib.urlencode({'ra':gal['RA'],'dec':gal['DEC'],'pixscale':max(min(gal['PETROTH50']*0.04,gal['PETROTH90']*0.02),min_pixelscale),'size':424})
-        if dr == '1':
-            url = "http://imagine.legacysurvey.org/fits-cutout-decals-dr1?{0}".format(params)
-        elif dr == '2':
-            url = "http://legacysurvey.org/viewer/fits-cutout-decals-dr2?{0}".format(params)
+    if manifest.state(galname) in ('queued','failed'):
         try:
-            urllib.urlretrieve(url, fits_filename)
-
-            # Write multi-plane FITS images to separate files for each band
-
-            data,hdr = fits.getdata(fits_filename,0,header=True)
-            for idx,plane in enumerate('grz'):
-                hdr_copy = hdr.copy()
-                hdr_copy['NAXIS'] = 2
-                hdr_copy['FILTER'] = '{0}       '.format(plane)
-                for badfield in ('BANDS','BAND0','BAND1','BAND2','NAXIS3'):
-                    hdr_copy.remove(badfield)
-                fits.writeto("{0}_{1}.fits".format(fits_filename,plane),data[idx,:,:],hdr_copy,clobber=True)
+            # Decode the response once in memory; the JPEG is rendered from this array
+            url = default_downloader().url(gal, dr)
+            content = default_downloader().content(url)
+            img,hdr = fits_bands.cube_from_bytes(content)
+        except Exception as e:
+            manifest.failed(galname, 'download: {0!r}'.format(e))
+            timed_out = True
+        else:
+            state, reason, fracbad = render(gal, img)
+            timed_out = (state == 'failed')
+            good_images = (state == 'rendered')
 
+            # The manifest is only updated once the cutout is safely on disk
             if remove_multi_fits:
-                os.remove(fits_filename)
-            del data,hdr
-            timed_out, good_images = makejpeg(gal, fits_filename)
-        except:
-            timed_out = True
-            cdx.increment()
-            pbar.update(cdx.value())
+                fits_bands.split_bands(fits_filename, overwrite=True, data=img, hdr=hdr)
+                manifest.set_state(galname, state, reason, fracbad)
+            else:
+                writer.write(fits_filename, content, saved_callback(galname, state, reason, fracbad), url)
+            del img,hdr,content
+        cdx.increment()
+        pbar.update(cdx.value())
     else:
         timed_out, good_images = makejpeg(gal, fits_filename)
     return [timed_out, good_images]
 
+def saved_callback(galname, state, reason, fracbad):
+    # Record the render result for a galaxy once the background writer has saved its cutout
+    def callback(error):
+        if error is None:
+            manifest.set_state(galname, state, reason, fracbad)
+        else:
+            manifest.failed(galname, 'write: {0!r}'.format(error))
+    return callback
+
+def render(gal, img, jpegpath="../jpeg/dr2", inverted_path="../jpeg/dr2_inverted", thumbnail_path="../jpeg/dr2_thumbnail"):
+    # Check an in-memory (3,H,W) cutout for bad pixels and render it to JPEG
+    # The inverted and thumbnail JPEGs are written from the same render; pass None for a path to skip one
+    # Returns the new manifest state, the reason and the per-band bad-pixel fractions
+    jpeg_filenames = ['{0}/{1}.jpeg'.format(path,gal['IAUNAME']) if path is not None else None for path in (jpegpath,inverted_path,thumbnail_path)]
+    fracbad = None
+    try:
+        quality = quality_gate(img)
+        fracbad = quality['fracbad']
+
+        if quality['good']:
+            rgbimg = dstn_rgb(img, 'grz', mnmx=dr2_mnmx, arcsinh=1., scales=dr2_scales, desaturate=True)
+            save_jpegs(rgbimg, *jpeg_filenames)
+            return 'rendered', None, fracbad
+        else:
+            return 'rejected', 'bad pixel fraction {0:.3f}'.format(quality['badmax']), fracbad
+    except Exception as e:
+        return 'failed', 'render: {0!r}'.format(e), fracbad
+
 def makejpeg(gal, fits_filename, jpegpath="../jpeg/dr2"):
+    # Render a cutout that is already on disk from an earlier run
     good_image = False
     timed_out = False
-    _scales = dict(g = (2, 0.008), r = (1, 0.014), z = (0, 0.019))
-    _mnmx = (-0.5,300)
-    jpeg_filename = '{0}/{1}.jpeg'.format(jpegpath,gal['IAUNAME'])
-    if os.path.exists(jpeg_filename) == False:
+    galname = gal['IAUNAME']
+    state = manifest.state(galname)
+    if state not in finished_states:
         if os.path.exists(fits_filename):
             try:
-                img,hdr = fits.getdata(fits_filename,0,header=True)
-
-                badmax = 0.
-                for j in range(img.shape[0]):
-                    band = img[j,:,:]
-                    nbad = (band == 0.).sum() + np.isnan(band).sum()
-                    fracbad = nbad / np.prod(band.shape)
-                    badmax = max(badmax,fracbad)
-
-                if badmax < 0.2:
-                    rgbimg = dstn_rgb((img[0,:,:],img[1,:,:],img[2,:,:]), 'grz', mnmx=_mnmx, arcsinh=1., scales=_scales, desaturate=True)
-                    plt.imsave(jpeg_filename, rgbimg, origin='lower')
-                    good_image = True
-            except:
-                timed_out = True
+                img = fits.getdata(fits_filename,0)
+                state, reason, fracbad = render(gal, img, jpegpath)
+            except Exception as e:
+                state, reason, fracbad = 'failed', 'read: {0!r}'.format(e), None
+            manifest.set_state(galname, state, reason, fracbad)
+            timed_out = (state == 'failed')
+            good_image = (state == 'rendered')
         else:
+            manifest.failed(galname, 'missing FITS file {0}'.format(fits_filename))
             timed_out = True
     else:
-        # JPEG file already exists, so it's assumed to be a good image
-        good_image = True
+        # Manifest records the JPEG as rendered or the image as rejected
+        good_image = (state == 'rendered')
     cdx.increment()
     pbar.update(cdx.value())
     return [timed_out, good_image]
@@ -105,18 +126,40 @@ if __name__ == "__main__":
     dr = '2'
     nsa_version = '1_0_0'
     nsa_decals = Table(fits.getdata('../fits/nsa_v{0}_decals_dr{1}_after_cuts.fits'.format(nsa_version, dr), 1))
+
+    # Only galaxies without a finished entry in the manifest are processed
+    manifest = DownloadManifest('../fits/nsa_v{0}_decals_dr{1}_manifest.db'.format(nsa_version, dr))
+    manifest.queue(nsa_decals, dr, fitspath='../fits/nsa', jpegpaths=['../jpeg/dr2', '../jpeg/dr2_inverted', '../jpeg/dr2_thumbnail'])
+    todo = nsa_decals[manifest.pending(nsa_decals['IAUNAME'])]
+
+    for path in ("../jpeg/dr2", "../jpeg/dr2_inverted", "../jpeg/dr2_thumbnail"):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
     cdx=Counter(0)
-    pbar = pb.ProgressBar(widgets=widgets, maxval=len(nsa_decals))
-    pool=ThreadPool(8)
+    pbar = pb.ProgressBar(widgets=widgets, maxval=max(len(todo),1))
+    # One pooled connection per worker thread, reused for every galaxy that thread downloads.
+    # Transient failures are retried with backoff, and requests are capped at 10 per second overall.
+    # Cutouts already downloaded with identical request parameters are reused (up to 100 GB on disk).
+    downloader = default_downloader(concurrency=8, rate=10., burst=8,
+                                    cache=CutoutCache('../fits/cutout_cache', max_bytes=100e9))
+    pool=ThreadPool(downloader.concurrency)
+    writer = BackgroundWriter(nthreads=2, cache=downloader.cache)
     pbar.start()
-    results = pool.map(get_skyserver_fits, nsa_decals)
-    #results = map(get_skyserver_fits, nsa_decals)
+    results = pool.map(get_skyserver_fits, todo)
+    #results = map(get_skyserver_fits, todo)
     pbar.finish()
     pool.close()
     pool.join()
-    results = np.array(results)
-    timed_out = results[:,0]
-    good_images = results[:,1]
+    writer.close()
+    downloader.close()
+
+    # Summarize from the manifest, which covers galaxies finished in earlier runs as well
+    states = manifest.states()
+    manifest.close()
+    galstates = np.array([states[name] for name in nsa_decals['IAUNAME']])
+    timed_out = galstates == 'failed'
+    good_images = galstates == 'rendered'
 
     logfile = "../failed_fits_downloads.log"
     flog = open(logfile,'w')
@@ -128,7 +171,9 @@ if __name__ == "__main__":
     print >> ilog, "\n".join(nsa_decals['IAUNAME'][~good_images])
     ilog.close()
 
-    print "\n{0} total galaxies processed".format(len(nsa_decals))
+    print "\n{0} galaxies processed this run".format(len(todo))
+    print "{0} total galaxies".format(len(nsa_decals))
     print "{0} good images".format(sum(good_images))
-    print "{0} galaxies with bad pixels".format(len(nsa_decals) - sum(good_images))
+    print "{0} galaxies with bad pixels".format(sum(galstates == 'rejected'))
     print "{0} galaxies timed out downloading data from Legacy Skyserver".format(sum(timed_out))
+    print "Cutout cache: {hits} hits, {misses} misses, {evictions} evicted, {bytes} bytes in {entries} cutouts".format(**downloader.cache.stats())
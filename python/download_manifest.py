@@ -0,0 +1,189 @@
+# Persistent record of the download/render state of every galaxy in a cutout run
+
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from astropy.io import fits
+
+import cutout_download
+
+'''
+Galaxies move through the states
+
+    queued -> downloaded -> rendered
+                         -> rejected    (image failed the bad-pixel cut)
+
+and can drop to `failed' (with a reason) from any step. Galaxies that are `rendered' or
+`rejected' are finished; everything else is picked up again on the next run.
+
+Galaxies new to the manifest whose files are already on disk from an earlier run (before
+the manifest, or with it deleted) start out as `downloaded' or `rendered' rather than `queued',
+as long as the files are complete.
+'''
+
+states = ('queued','downloaded','rendered','rejected','failed')
+finished_states = ('rendered','rejected')
+
+# Per-band bad-pixel fractions from cutout_quality.quality_gate
+quality_columns = ('fracbad_g','fracbad_r','fracbad_z')
+
+def complete_fits(filename):
+
+    # A multi-plane cutout that can be opened, holding all the data its header declares
+
+    try:
+        with fits.open(filename,memmap=True) as hdulist:
+            if hdulist[0].header.get('NAXIS') != 3:
+                return False
+            info = hdulist.fileinfo(0)
+            return os.path.getsize(filename) >= info['datLoc'] + info['datSpan']
+    except (IOError,OSError,ValueError):
+        return False
+
+def complete_jpeg(filename):
+
+    # A JPEG file that runs through to its end-of-image marker
+
+    try:
+        with open(filename,'rb') as f:
+            if f.read(2) != '\xff\xd8':
+                return False
+            f.seek(-2,os.SEEK_END)
+            return f.read(2) == '\xff\xd9'
+    except (IOError,OSError):
+        return False
+
+def existing_state(iauname,fitspath=None,jpegpaths=()):
+
+    # State a galaxy has reached according to the files on disk: `rendered' if its JPEG exists in every
+    # one of jpegpaths (taken to be a good image, as before the manifest), `downloaded' if its FITS cutout does
+
+    if jpegpaths and all(complete_jpeg('{0}/{1}.jpeg'.format(path,iauname)) for path in jpegpaths):
+        return 'rendered'
+    if fitspath is not None and complete_fits('{0}/{1}.fits'.format(fitspath,iauname)):
+        return 'downloaded'
+    return 'queued'
+
+class DownloadManifest(object):
+
+    '''
+    SQLite table of per-galaxy state, keyed on IAUNAME and indexed on state.
+
+    Every update is committed immediately, so the manifest survives a crash at any point.
+    A state is only recorded after the step that produces it has completed, so a file
+    written by an interrupted step is never treated as complete. One manifest can be
+    shared between worker threads.
+    '''
+
+    def __init__(self,filename):
+
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename,check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS galaxies (
+                                     iauname TEXT PRIMARY KEY,
+                                     state TEXT NOT NULL,
+                                     reason TEXT,
+                                     dr TEXT,
+                                     ra REAL,
+                                     dec REAL,
+                                     pixscale REAL,
+                                     size INTEGER,
+                                     updated REAL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS galaxies_state ON galaxies (state)')
+
+            # Manifests from before the quality columns were added get them appended
+            existing = [row[1] for row in self.conn.execute('PRAGMA table_info(galaxies)')]
+            for col in quality_columns:
+                if col not in existing:
+                    self.conn.execute('ALTER TABLE galaxies ADD COLUMN {0} REAL'.format(col))
+
+    def queue(self,galaxies,dr='2',size=424,force=False,fitspath=None,jpegpaths=()):
+
+        # Add galaxies to the manifest along with their cutout parameters. With force, existing entries are reset to `queued'.
+        # Otherwise galaxies new to the manifest adopt complete files already in fitspath and jpegpaths (see existing_state),
+        # where jpegpaths holds the directory of every JPEG a render writes (standard, inverted, thumbnail).
+
+        pixscale = np.maximum(np.minimum(galaxies['PETROTH50']*0.04,galaxies['PETROTH90']*0.02),cutout_download.min_pixelscale)
+        known = set() if force else set(self.states())
+        now = time.time()
+        rows = []
+        for name,ra,dec,ps in zip(galaxies['IAUNAME'],galaxies['RA'],galaxies['DEC'],pixscale):
+            name = str(name)
+            if name in known:
+                continue
+            state = 'queued' if force else existing_state(name,fitspath,jpegpaths)
+            rows.append((name,state,None,dr,float(ra),float(dec),float(ps),size,now))
+
+        verb = 'INSERT OR REPLACE' if force else 'INSERT OR IGNORE'
+        with self.lock, self.conn:
+            self.conn.executemany('{0} INTO galaxies (iauname,state,reason,dr,ra,dec,pixscale,size,updated) VALUES (?,?,?,?,?,?,?,?,?)'.format(verb),rows)
+
+        return None
+
+    def set_state(self,iauname,state,reason=None,fracbad=None):
+
+        # Optionally also store the per-band bad-pixel fractions (in grz order) from the quality cut
+
+        assert state in states, "Unknown manifest state {0}".format(state)
+
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE galaxies SET state=?, reason=?, updated=? WHERE iauname=?',
+                              (state,reason,time.time(),str(iauname)))
+            if fracbad is not None:
+                values = [None if np.isnan(f) else float(f) for f in fracbad]
+                self.conn.execute('UPDATE galaxies SET {0} WHERE iauname=?'.format(', '.join('{0}=?'.format(col) for col in quality_columns)),
+                                  values + [str(iauname)])
+
+        return None
+
+    def failed(self,iauname,reason):
+
+        self.set_state(iauname,'failed',reason)
+
+        return None
+
+    def state(self,iauname):
+
+        # Current state of a galaxy, or None if it has never been queued
+
+        with self.lock:
+            row = self.conn.execute('SELECT state FROM galaxies WHERE iauname=?',(str(iauname),)).fetchone()
+
+        return None if row is None else row[0]
+
+    def states(self):
+
+        # Dictionary of IAUNAME -> state for every galaxy in the manifest
+
+        with self.lock:
+            rows = self.conn.execute('SELECT iauname,state FROM galaxies').fetchall()
+
+        return dict(rows)
+
+    def with_state(self,*wanted):
+
+        # Set of IAUNAMEs currently in any of the given states
+
+        with self.lock:
+            rows = self.conn.execute('SELECT iauname FROM galaxies WHERE state IN ({0})'.format(','.join('?'*len(wanted))),wanted).fetchall()
+
+        return set(r[0] for r in rows)
+
+    def pending(self,iaunames):
+
+        # Boolean mask over iaunames of galaxies that still have work to do
+
+        done = self.with_state(*finished_states)
+
+        return np.array([str(name) not in done for name in iaunames],dtype=bool)
+
+    def close(self):
+
+        with self.lock:
+            self.conn.close()
@@ -4,7 +4,9 @@ from astropy.io import fits
 import os
 import numpy as np 
 import decals
-from matplotlib import pyplot as plt
+import cutout_download
+from cutout_cache import CutoutCache
+import rgb_render
 
 def get_rgb(imgs, bands, mnmx=None, arcsinh=None, scales=None, imgname='test',desaturate=False):
     '''
@@ -20,81 +22,13 @@ def get_rgb(imgs, bands, mnmx=None, arcsinh=None, scales=None, imgname='test',de
 
     Returns a (H,W,3) numpy array with values between 0 and 1.
     '''
-    bands = ''.join(bands)
-
-    grzscales = dict(g = (2, 0.0066),
-                      r = (1, 0.01385),
-                      z = (0, 0.025),
-                      )
-
-    if scales is None:
-        if bands == 'grz':
-            scales = grzscales
-        elif bands == 'urz':
-            scales = dict(u = (2, 0.0066),
-                          r = (1, 0.01),
-                          z = (0, 0.025),
-                          )
-        elif bands == 'gri':
-            # scales = dict(g = (2, 0.004),
-            #               r = (1, 0.0066),
-            #               i = (0, 0.01),
-            #               )
-            scales = dict(g = (2, 0.002),
-                          r = (1, 0.004),
-                          i = (0, 0.005),
-                          )
-        else:
-            scales = grzscales
-        
-    h,w = imgs[0].shape
-    rgb = np.zeros((h,w,3), np.float32)
-    # Convert to ~ sigmas
-    for im,band in zip(imgs, bands):
-        plane,scale = scales[band]
-        rgb[:,:,plane] = (im / scale).astype(np.float32)
-        #print 'rgb: plane', plane, 'range', rgb[:,:,plane].min(), rgb[:,:,plane].max()
-
-    if mnmx is None:
-        mn,mx = -3, 10
-    else:
-        mn,mx = mnmx
-
-    if arcsinh is not None:
-        def nlmap(x):
-            return np.arcsinh(x * arcsinh) / np.sqrt(arcsinh)
-        rgb = nlmap(rgb)
-        mn = nlmap(mn)
-        mx = nlmap(mx)
-
-    rgb = (rgb - mn) / (mx - mn)
-
-    if desaturate:
-        # optionally desaturate pixels that are dominated by a single
-        # colour to avoid colourful speckled sky
-
-        RGBim = np.array([rgb[:,:,0],rgb[:,:,1],rgb[:,:,2]])
-        a = RGBim.mean(axis=0)
-        np.putmask(a, a == 0.0, 1.0)
-        acube = np.resize(a,(3,h,w))
-        bcube = (RGBim / acube) / 2.5
-        mask = np.array(bcube)
-        wt = np.max(mask,axis=0)
-        np.putmask(wt, wt > 1.0, 1.0)
-        wt = 1 - wt
-        wt = np.sin(wt*np.pi/2.0)
-        temp = RGBim * wt + a*(1-wt) + a*(1-wt)**2 * RGBim
-        rgb = np.zeros((h,w,3), np.float32)
-        for idx,im in enumerate((temp[0,:,:],temp[1,:,:],temp[2,:,:])):
-            rgb[:,:,idx] = im
-
-    clipped = np.clip(rgb, 0., 1.)
+    clipped = rgb_render.dstn_rgb(imgs, bands, mnmx=mnmx, arcsinh=arcsinh, scales=scales, desaturate=desaturate)
 
     # Save hardcopy as JPG
     #out_jpg  = '%s/decals/imagetests/dstn/test.jpeg'  % gzpath
     out_jpg  = '%s/decals/imagetests/sugata/%s.jpeg'  % (gzpath,imgname)
 
-    plt.imsave(out_jpg, clipped, origin='lower')
+    rgb_render.save_jpeg(out_jpg, clipped)
 
     return clipped
     
@@ -113,6 +47,9 @@ if __name__ == "__main__":
 
     galnames = ('J231817.76-010905.9', 'J225711.16-000815.9', 'J000000.80+004200.0')
 
+    # Share cutouts with other runs that requested the same position, pixel scale and size
+    cutout_download.default_downloader(cache=CutoutCache('/Volumes/3TB/gz4/DECaLS/fits/cutout_cache'))
+
     for galname in galnames:
 
         try:
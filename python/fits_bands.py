@@ -0,0 +1,71 @@
+# Single-band access to the multi-plane grz FITS cutouts from the DECaLS skyserver
+
+'''
+Cutouts are downloaded once as a (3,H,W) cube. Code that needs one band reads the plane
+straight from the cube with get_band; separate {IAUNAME}_{band}.fits files are only written
+by split_bands, for consumers (like Trilogy run from an input file) that have to be given one file per band.
+'''
+
+from astropy.io import fits
+import os
+import io
+
+def band_header(hdr,band):
+
+    # Header for a single plane of a multi-plane cutout
+
+    hdr_copy = hdr.copy()
+    hdr_copy['NAXIS'] = 2
+    hdr_copy['FILTER'] = '{0}       '.format(band)
+    for badfield in ('BANDS','BAND0','BAND1','BAND2','NAXIS3'):
+        hdr_copy.remove(badfield)
+
+    return hdr_copy
+
+def band_filename(fits_filename,band):
+
+    # {path}/{IAUNAME}.fits -> {path}/{IAUNAME}_{band}.fits
+
+    root = fits_filename[:-5] if fits_filename.endswith('.fits') else fits_filename
+
+    return '{0}_{1}.fits'.format(root,band)
+
+def get_band(fits_filename,band,bands='grz',header=False):
+
+    # Read one band from a multi-plane cutout without writing it out to its own file
+
+    with fits.open(fits_filename,memmap=True) as hdulist:
+        data = hdulist[0].data[bands.index(band),:,:].copy()
+        if header:
+            hdr = band_header(hdulist[0].header,band)
+
+    if header:
+        return data,hdr
+    else:
+        return data
+
+def cube_from_bytes(content):
+
+    # Decode a multi-plane cutout held in memory (eg the body of a skyserver response)
+
+    with fits.open(io.BytesIO(content)) as hdulist:
+        data = hdulist[0].data
+        hdr = hdulist[0].header.copy()
+
+    return data,hdr
+
+def split_bands(fits_filename,bands='grz',overwrite=False,data=None,hdr=None):
+
+    # Write each plane of a multi-plane cutout to its own FITS file, skipping bands that already have one.
+    # Pass data and hdr if the cube is already in memory; otherwise it is read from fits_filename.
+
+    filenames = [band_filename(fits_filename,band) for band in bands]
+    todo = [idx for idx,fn in enumerate(filenames) if overwrite or not os.path.exists(fn)]
+
+    if len(todo) > 0:
+        if data is None:
+            data,hdr = fits.getdata(fits_filename,0,header=True)
+        for idx in todo:
+            fits.writeto(filenames[idx],data[idx,:,:],band_header(hdr,bands[idx]),clobber=True)
+
+    return filenames
@@ -1,5 +1,8 @@
 # Adapted from galaxyzoo2.gz2string
 
+import numpy as np
+import operator
+
 def gal_string(datarow,survey='decals'):
 
     """ Determine a string for the consensus GZ2 classification of a
@@ -16,184 +19,437 @@ def gal_string(datarow,survey='decals'):
         the workflow/decision tree. Default is 'decals'. 
         Possible options should be:
             
-            'candels'
-            'candels_2epoch'
             'decals'
             'ferengi'
-            'goods_full'
-            'illustris'
-            'sloan',
-            'sloan_singleband'
-            'ukidss'
     
     Returns
     -------
     char: str
         String giving the plurality classification from GZ2
-        eg, '
+        eg, 'Er[]', 'SBc2m[MG](r)'
+    
+    task_eval, task_ans: list
+        As returned by plurality
     
     Notes
     -------
+    The label is built by walking the survey's tree in label_tasks, which
+    differs from the plurality tree in a few places (see label_tasks):
+    each task on its path adds its string from survey_labels.
     
     """
     
-    weights = datarow
-    
-    if survey in ('decals',):
-    
-        max_t1 = weights[:3].argmax()
-        
-        char = ''
-        task_eval = [0]*12
-        
-        task_eval[0] = 1
-        
-        # Smooth galaxies
-        if max_t1 == 0:
-            char += 'E'
-            # Roundness
-            char += ('r','i','c')[weights[23:26].argmax()]
-            task_eval[8] = 1
-        
-        # Features/disk galaxies
-        if max_t1 == 1:
-            char += 'S'
-            
-            task_eval[1] = 1
-            edgeon = weights[3:5]
-            # Edge-on disks
-            if edgeon[0] >= edgeon[1]:
-                char += 'e'
-                # Bulge shape
-                char += ('r','b','n')[weights[20:23].argmax()]
-                task_eval[7] = 1
-            # Not edge-on disks
+    tree = labelled_tree(survey)
+    task_eval,task_ans = tree.evaluate_row(datarow)
+    return tree.label_row(datarow,task_eval),task_eval,task_ans
+
+# Decision tree of each survey, one entry per task:
+#
+#   idx, len    offset of the task's first answer in a row of vote fractions, and its number of answers
+#   from        edges that lead to the task; it is asked if any one of them is followed. Tasks with no
+#               edges (the top-level question, discuss) are always asked.
+#   unless      edges that stop the task being asked, even if one of its 'from' edges is followed
+#   checkbox    checkbox question; only counts if its most popular answer is above check_threshold
+#   tie         'yes' for a two-answer task whose answers read as yes when they are equal
+#
+# An edge (parent, test) is followed if the parent task was asked and its answers pass the test: 'yes'
+# if the first answer beats the second, 'no' if it doesn't, or a comparison like '==0', '<2' or '>1'
+# against the index of the plurality answer. An edge (parent, test, task) tests the answers to another task.
+
+survey_tasks = {}
+
+survey_tasks['decals'] = { 0:{'idx': 0,'len':3},                                         # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                           1:{'idx': 3,'len':2,'from':[(0,'==1')]},                      # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                           2:{'idx': 5,'len':2,'from':[(1,'no')]},                       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
+                           3:{'idx': 7,'len':2,'from':[(1,'no')]},                       # "Is there any sign of a spiral arm pattern?"
+                           4:{'idx': 9,'len':3,'from':[(1,'no')]},                       # "How prominent is the central bulge, compared with the rest of the galaxy?" 
+                           5:{'idx':12,'len':3,'from':[(3,'yes')]},                      # "How tightly wound do the spiral arms appear?" 
+                           6:{'idx':15,'len':5,'from':[(3,'yes')]},                      # "How many spiral arms are there?" 
+                           7:{'idx':20,'len':3,'from':[(1,'yes')]},                      # "Does the galaxy have a bulge at its centre? If so, what shape?" 
+                           8:{'idx':23,'len':3,'from':[(0,'==0')]},                      # 'Round', 'How rounded is it?', ->
+                           9:{'idx':26,'len':4,'from':[(0,'<2')]},                       # "Is the galaxy currently merging or is there any sign of tidal debris?" 
+                          10:{'idx':31,'len':7,'from':[(0,'<2')],'checkbox':True},       # "Do you see any of these odd features in the image?"  
+                          11:{'idx':38,'len':2}}                                         # "Would you like to discuss this object?"
+
+survey_tasks['ferengi'] = { 0:{'idx':0  ,'len':3},                                           # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                            1:{'idx':3  ,'len':3,'from':[(0,'==0')]},                        # 'Round', 'How rounded is it?', leadsTo: 'Is there anything odd?', ->
+                            2:{'idx':6  ,'len':2,'from':[(0,'==1')]},                        # 'Clumps', 'Does the galaxy have a mostly clumpy appearance?', ->
+                            3:{'idx':8  ,'len':6,'from':[(2,'yes')]},                        # 'Clumps', 'How many clumps are there?', leadsTo: 'Do the clumps appear in a straight line, a chain, or a cluster?', ->
+                            4:{'idx':14 ,'len':4,'from':[(3,'>1')]},                         # 'Clumps', 'Do the clumps appear in a straight line, a chain, or a cluster?', leadsTo: 'Is there one clump which is clearly brighter than the others?', ->
+                            5:{'idx':18 ,'len':2,'from':[(3,'>0')]},                         # 'Clumps', 'Is there one clump which is clearly brighter than the others?', ->
+                            6:{'idx':20 ,'len':2,'from':[(5,'yes')]},                        # 'Clumps', 'Is the brightest clump central to the galaxy?', ->
+                            7:{'idx':22 ,'len':2,'from':[(3,'yes',6)]},                      # 'Symmetry', 'Does the galaxy appear symmetrical?', leadsTo: 'Do the clumps appear to be embedded within a larger object?', ->
+                            8:{'idx':24 ,'len':2,'from':[(3,'yes',6)]},                      # 'Clumps', 'Do the clumps appear to be embedded within a larger object?', leadsTo: 'Is there anything odd?', ->
+                            9:{'idx':26 ,'len':2,'from':[(2,'no')]},                         # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                           10:{'idx':28 ,'len':3,'from':[(9,'yes')]},                        # 'Bulge', 'Does the galaxy have a bulge at its center? If so, what shape?', leadsTo: 'Is there anything odd?', ->
+                           11:{'idx':31 ,'len':2,'from':[(9,'no')]},                         # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?', leadsTo: 'Is there any sign of a spiral arm pattern?', ->
+                           12:{'idx':33 ,'len':2,'from':[(9,'no')]},                         # 'Spiral', 'Is there any sign of a spiral arm pattern?', ->
+                           13:{'idx':35 ,'len':3,'from':[(12,'yes')]},                       # 'Spiral', 'How tightly wound do the spiral arms appear?', leadsTo: 'How many spiral arms are there?', ->
+                           14:{'idx':38 ,'len':6,'from':[(12,'yes')]},                       # 'Spiral', 'How many spiral arms are there?', leadsTo: 'How prominent is the central bulge, compared with the rest of the galaxy?', ->
+                           15:{'idx':44 ,'len':4,'from':[(9,'no')]},                         # 'Bulge', 'How prominent is the central bulge, compared with the rest of the galaxy?', leadsTo: 'Is there anything odd?', ->
+                           16:{'idx':48 ,'len':2},                                           # 'Discuss', 'Would you like to discuss this object?', ->
+                           17:{'idx':50 ,'len':2,'from':[(0,'<2')]},                         # 'Odd', 'Is there anything odd?', ->
+                           18:{'idx':53 ,'len':7,'from':[(17,'yes')],'checkbox':True}}       # 'Odd', 'What are the odd features?', ->             # Indexing here skips the a-0 answer.
+
+survey_tasks['goods_full'] = survey_tasks['ferengi']
+
+survey_tasks['gzh'] = { 0:{'len':3},                                                 # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                        1:{'len':2,'from':[(0,'==0')]},                              # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                        2:{'len':2,'from':[(0,'==1')]},                              # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?', leadsTo: 'Is there any sign of a spiral arm pattern?', ->
+                        3:{'len':2,'from':[(2,'yes')]},                              # 'Spiral', 'Is there any sign of a spiral arm pattern?', ->
+                        4:{'len':4,'from':[(3,'>1')]},                               # 'Bulge', 'How prominent is the central bulge, compared with the rest of the galaxy?', leadsTo: 'Is there anything odd?', ->
+                        5:{'len':2,'from':[(3,'>0')],'unless':[(4,'==3')]},          # 'Odd', 'Is there anything odd?', ->
+                        6:{'len':3,'from':[(5,'yes')],'unless':[(4,'==3')]},         # 'Round', 'How rounded is it?', leadsTo: 'Is there anything odd?', ->
+                        7:{'len':7,'from':[(3,'yes',6)],'unless':[(4,'==3')]},       # 'Odd', 'What are the odd features?', ->            Not a checkbox 
+                        8:{'len':3,'from':[(3,'yes',6)],'unless':[(4,'==3')]},       # 'Bulge', 'Does the galaxy have a bulge at its center? If so, what shape?', leadsTo: 'Is there anything odd?', ->
+                        9:{'len':3,'from':[(2,'no')]},                               # 'Spiral', 'How tightly wound do the spiral arms appear?', leadsTo: 'How many spiral arms are there?', ->
+                       10:{'len':6,'from':[(9,'yes')]},                              # 'Spiral', 'How many spiral arms are there?', leadsTo: 'How prominent is the central bulge, compared with the rest of the galaxy?', ->
+                       11:{'len':2,'from':[(4,'==3'),(9,'no')]},                     # 'Clumps', 'Does the galaxy have a mostly clumpy appearance?', ->
+                       12:{'len':6,'from':[(4,'==3'),(9,'no')]},                     # 'Clumps', 'How many clumps are there?', leadsTo: 'Do the clumps appear in a straight line, a chain, or a cluster?', ->
+                       13:{'len':2,'from':[(12,'yes')]},                             # 'Clumps', 'Is there one clump which is clearly brighter than the others?', ->
+                       14:{'len':2,'from':[(12,'yes')]},                             # 'Clumps', 'Is the brightest clump central to the galaxy?', ->
+                       15:{'len':4,'from':[(4,'==3'),(9,'no')]},                     # 'Clumps', 'Do the clumps appear in a straight line, a chain, or a cluster?', leadsTo: 'Is there one clump which is clearly brighter than the others?', ->
+                       16:{'len':2,'from':[(0,'<2')]},                               # 'Symmetry', 'Does the galaxy appear symmetrical?', leadsTo: 'Do the clumps appear to be embedded within a larger object?', ->
+                       17:{'len':2,'from':[(16,'yes')],'checkbox':True}}             # 'Clumps', 'Do the clumps appear to be embedded within a larger object?', leadsTo: 'Is there anything odd?', ->
+
+def _consecutive_offsets(tasks):
+    # Don't need to skip indices since there's no checkbox question
+    idx = 0
+    for i in range(len(tasks)):
+        tasks[i]['idx'] = idx
+        idx += tasks[i]['len']
+    return tasks
+
+_consecutive_offsets(survey_tasks['gzh'])
+
+survey_tasks['candels'] = { 0:{'idx':0 ,'len':3},                            # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                            1:{'idx':3 ,'len':3,'from':[(0,'==0')]},         # 'Round', 'How rounded is it?', leadsTo: 'Is there anything odd?', ->
+                            2:{'idx':6 ,'len':2,'from':[(0,'==1')]},         # 'Clumps', 'Does the galaxy have a mostly clumpy appearance?', ->
+                            3:{'idx':8 ,'len':6,'from':[(2,'yes')]},         # 'Clumps', 'How many clumps are there?', leadsTo: 'Do the clumps appear in a straight line, a chain, or a cluster?', ->
+                            4:{'idx':14,'len':4,'from':[(3,'>1')]},          # 'Clumps', 'Do the clumps appear in a straight line, a chain, or a cluster?', leadsTo: 'Is there one clump which is clearly brighter than the others?', ->
+                            5:{'idx':18,'len':2,'from':[(3,'>0')]},          # 'Clumps', 'Is there one clump which is clearly brighter than the others?', ->
+                            6:{'idx':20,'len':2,'from':[(5,'yes')]},         # 'Clumps', 'Is the brightest clump central to the galaxy?', ->
+                            7:{'idx':22,'len':2,'from':[(3,'yes',6)]},       # 'Symmetry', 'Does the galaxy appear symmetrical?', leadsTo: 'Do the clumps appear to be embedded within a larger object?', ->
+                            8:{'idx':24,'len':2,'from':[(3,'yes',6)]},       # 'Clumps', 'Do the clumps appear to be embedded within a larger object?', leadsTo: 'Is there anything odd?', ->
+                            9:{'idx':26,'len':2,'from':[(2,'no')]},          # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                           10:{'idx':28,'len':2,'from':[(9,'yes')]},         # 'Bulge', 'Does the galaxy have a bulge at its center?', leadsTo: 'Is there anything odd?', ->
+                           11:{'idx':30,'len':2,'from':[(9,'no')]},          # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?', leadsTo: 'Is there any sign of a spiral arm pattern?', ->
+                           12:{'idx':32,'len':2,'from':[(9,'no')]},          # 'Spiral', 'Is there any sign of a spiral arm pattern?', ->
+                           13:{'idx':34,'len':3,'from':[(12,'yes')]},        # 'Spiral', 'How tightly wound do the spiral arms appear?', leadsTo: 'How many spiral arms are there?', ->
+                           14:{'idx':37,'len':6,'from':[(12,'yes')]},        # 'Spiral', 'How many spiral arms are there?', leadsTo: 'How prominent is the central bulge, compared with the rest of the galaxy?', ->
+                           15:{'idx':43,'len':3,'from':[(9,'no')]},          # 'Bulge', 'How prominent is the central bulge, compared with the rest of the galaxy?', leadsTo: 'Is there anything odd?', ->
+                           16:{'idx':46,'len':4,'from':[(0,'<2')]},          #  Merging/tidal debris
+                           17:{'idx':50,'len':2}}                            #  Discuss
+
+survey_tasks['candels_2epoch'] = survey_tasks['candels']
+
+survey_tasks['illustris'] = { 0:{'idx': 0,'len':3},                                           # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                              1:{'idx': 3,'len':2,'from':[(0,'==1')]},                        # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                              2:{'idx': 5,'len':2,'from':[(1,'no')]},                         # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
+                              3:{'idx': 7,'len':2,'from':[(1,'no')]},                         # "Is there any sign of a spiral arm pattern?"
+                              4:{'idx': 9,'len':4,'from':[(1,'no')]},                         # "How prominent is the central bulge, compared with the rest of the galaxy?" 
+                              5:{'idx':14,'len':7,'from':[(10,'yes')],'checkbox':True},       # Odd features
+                              6:{'idx':21,'len':3,'from':[(0,'==0')]},                        # Round
+                              7:{'idx':24,'len':3,'from':[(1,'yes')]},                        # Bulge shape
+                              8:{'idx':27,'len':3,'from':[(3,'yes')]},                        # arms winding
+                              9:{'idx':30,'len':6,'from':[(3,'yes')]},                        # arms number
+                             10:{'idx':36,'len':2,'from':[(0,'<2')]},                         # Is there anything odd?
+                             11:{'idx':38,'len':2}}                                           # "Would you like to discuss this object?"
+
+survey_tasks['sloan'] = { 0:{'idx': 0,'len':3},                                          # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                          1:{'idx': 3,'len':2,'from':[(0,'==1')]},                       # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                          2:{'idx': 5,'len':2,'from':[(1,'no')]},                        # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
+                          3:{'idx': 7,'len':2,'from':[(1,'no')]},                        # "Is there any sign of a spiral arm pattern?"
+                          4:{'idx': 9,'len':4,'from':[(1,'no')]},                        # "How prominent is the central bulge, compared with the rest of the galaxy?" 
+                          5:{'idx':13,'len':2,'from':[(0,'<2')]},                        # Is there anything odd?
+                          6:{'idx':16,'len':7,'from':[(5,'yes')],'checkbox':True},       # Odd features
+                          7:{'idx':23,'len':3,'from':[(0,'==0')]},                       # Round
+                          8:{'idx':26,'len':3,'from':[(1,'yes')]},                       # Bulge shape
+                          9:{'idx':29,'len':3,'from':[(3,'yes')]},                       # arms winding
+                         10:{'idx':32,'len':6,'from':[(3,'yes')]},                       # arms number
+                         11:{'idx':38,'len':2}}                                          # "Would you like to discuss this object?"
+
+survey_tasks['sloan_singleband'] = survey_tasks['sloan']
+
+survey_tasks['ukidss'] = survey_tasks['sloan']
+
+survey_tasks['gz2'] = { 0:{'idx': 0,'len':3},                          # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
+                        1:{'idx': 3,'len':2,'from':[(0,'==1')]},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
+                        2:{'idx': 5,'len':2,'from':[(1,'no')]},        # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
+                        3:{'idx': 7,'len':2,'from':[(1,'no')]},        # "Is there any sign of a spiral arm pattern?"
+                        4:{'idx': 9,'len':4,'from':[(1,'no')]},        # "How prominent is the central bulge, compared with the rest of the galaxy?" 
+                        5:{'idx':13,'len':2,'from':[(0,'<2')]},        # Is there anything odd?
+                        6:{'idx':15,'len':3,'from':[(0,'==0')]},       # Round
+                        7:{'idx':18,'len':7,'from':[(5,'yes')]},       # Odd features
+                        8:{'idx':25,'len':3,'from':[(1,'yes')]},       # Bulge shape
+                        9:{'idx':28,'len':3,'from':[(3,'yes')]},       # arms winding
+                       10:{'idx':31,'len':6,'from':[(3,'yes')]}}       # arms number
+
+survey_tasks['stripe82'] = survey_tasks['gz2']
+
+# Decision tree gal_string walks for its label and task_eval. This is the decals tree as the consensus labels
+# have always been made, which is not quite the plurality tree: a tie on the edge-on question counts as edge-on,
+# mergers and discuss are evaluated on every path (artifacts included), and odd features are evaluated whenever
+# one of them is above 0.5, whatever the answer to the top-level question.
+
+label_tasks = {}
+
+label_tasks['decals'] = { 0:{'idx': 0,'len':3},                                  # Shape
+                          1:{'idx': 3,'len':2,'from':[(0,'==1')],'tie':'yes'},   # Edge-on
+                          2:{'idx': 5,'len':2,'from':[(1,'no')]},                # Bar
+                          3:{'idx': 7,'len':2,'from':[(1,'no')]},                # Spiral arms
+                          4:{'idx': 9,'len':3,'from':[(1,'no')]},                # Bulge prominence
+                          5:{'idx':12,'len':3,'from':[(3,'yes')]},               # Arms winding
+                          6:{'idx':15,'len':5,'from':[(3,'yes')]},               # Arms number
+                          7:{'idx':20,'len':3,'from':[(1,'yes')]},               # Bulge shape
+                          8:{'idx':23,'len':3,'from':[(0,'==0')]},               # Roundness
+                          9:{'idx':26,'len':4},                                  # Mergers/tidal debris
+                         10:{'idx':31,'len':7,'checkbox':True},                  # Odd features
+                         11:{'idx':38,'len':2}}                                  # Discuss
+
+# FERENGI labels are made with the decals layout
+label_tasks['ferengi'] = label_tasks['decals']
+
+# Consensus label of each survey: tasks in the order they are written, with the string for each of their answers.
+# A task on the path adds the string for its answer: the plurality answer, except that a two-answer task reads as
+# yes/no the same way the edges do. An entry (task, strings, edges) is only written if one of its edges is also
+# followed, so that mergers and odd features are left out of the label of an artifact, which is just 'A'.
+
+survey_labels = {}
+
+survey_labels['decals'] = [( 0,('E','S','A')),                                              # Smooth, features/disk, star/artifact
+                           ( 8,('r','i','c')),                                              # Roundness
+                           ( 1,('e','')),                                                   # Edge-on disk
+                           ( 7,('r','b','n')),                                              # Bulge shape
+                           ( 2,('B','')),                                                   # Bar
+                           ( 4,('c','b','a')),                                              # Bulge prominence
+                           ( 6,('1','2','3','4','+')),                                      # Arms number
+                           ( 5,('t','m','l')),                                              # Arms winding
+                           ( 9,('[MG]','[TD]','[MT]','[]'),[(0,'<2')]),                     # Mergers/tidal debris
+                           (10,('(n)','(r)','(l)','(d)','(i)','(o)','(v)'),[(0,'<2')])]     # Odd features
+
+survey_labels['ferengi'] = survey_labels['decals']
+
+def row_max(a):
+
+    # Largest answer in each row of a 2-D array, the same as the built-in max() of the row. A running
+    # comparison rather than a.max(axis=1), which would turn any row containing a NaN into NaN.
+
+    best = a[:,0]
+    with np.errstate(invalid='ignore'):
+        for j in range(1,a.shape[1]):
+            best = np.where(a[:,j] > best,a[:,j],best)
+    return best
+
+class CompiledTree(object):
+
+    # A survey's decision tree resolved once into answer slices and edges, in the order they are evaluated
+
+    comparisons = {'==':operator.eq,'<':operator.lt,'>':operator.gt}
+
+    def __init__(self,tasks,labels=None):
+
+        self.ntasks = len(tasks)
+        self.idx = [tasks[t]['idx'] for t in range(self.ntasks)]
+        self.stop = [tasks[t]['idx'] + tasks[t]['len'] for t in range(self.ntasks)]
+        self.checkbox = [tasks[t].get('checkbox',False) for t in range(self.ntasks)]
+        # How the first answer of a two-answer task is compared with the second to read it as yes
+        self.beats = [operator.ge if tasks[t].get('tie') == 'yes' else operator.gt for t in range(self.ntasks)]
+        self.edges = [[self.compile_edge(e) for e in tasks[t].get('from',[])] for t in range(self.ntasks)]
+        self.unless = [[self.compile_edge(e) for e in tasks[t].get('unless',[])] for t in range(self.ntasks)]
+
+        # Every task comes after all the tasks its edges depend on
+        self.order = []
+        while len(self.order) < self.ntasks:
+            ready = [t for t in range(self.ntasks) if t not in self.order and
+                     all(e[0] in self.order for e in self.edges[t] + self.unless[t])]
+            if len(ready) == 0:
+                raise ValueError("Decision tree has a loop through tasks {0}".format(
+                    sorted(set(range(self.ntasks)) - set(self.order))))
+            self.order.extend(ready)
+
+        self.labels = [] if labels is None else [(entry[0],tuple(entry[1]),[self.compile_edge(e) for e in (entry[2] if len(entry) > 2 else [])])
+                                                 for entry in labels]
+
+    def compile_edge(self,edge):
+
+        # (parent, test[, task]) -> (parent, task, comparison or None, value)
+
+        parent,test = edge[:2]
+        task = edge[2] if len(edge) > 2 else parent
+        if test in ('yes','no'):
+            return parent,task,None,test == 'yes'
+        op = test.rstrip('0123456789')
+        return parent,task,self.comparisons[op],int(test[len(op):])
+
+    def yes_row(self,weights,t):
+
+        # Whether a single galaxy's answers to a two-answer task read as yes
+
+        return self.beats[t](weights[self.idx[t]],weights[self.idx[t]+1])
+
+    def passes_row(self,weights,task,op,value,most=None):
+
+        # Whether a single galaxy's answers to task pass an edge's test; most holds any plurality answers already found
+
+        if op is None:
+            return self.yes_row(weights,task) == value
+        if most is None or most[task] is None:
+            return op(weights[self.idx[task]:self.stop[task]].argmax(),value)
+        return op(most[task],value)
+
+    def followed_row(self,weights,edges,task_eval,most=None):
+
+        # Whether a single galaxy follows any one of edges
+
+        for parent,task,op,value in edges:
+            if task_eval[parent] and self.passes_row(weights,task,op,value,most):
+                return True
+        return False
+
+    def evaluate_row(self,weights,check_threshold=0.50):
+
+        # Walk the tree for a single galaxy
+
+        idx,stop,edges,unless = self.idx,self.stop,self.edges,self.unless
+
+        # Plurality answer to every task, counted from its first answer; the comparison edges reuse these
+        most = [None]*self.ntasks
+        task_ans = [0]*self.ntasks
+        for t in range(self.ntasks):
+            try:
+                most[t] = weights[idx[t]:stop[t]].argmax()
+                task_ans[t] = most[t] + idx[t]
+            except ValueError:
+                print "ValueError in gz_class: {0:} categories, {1:} answers".format(len(weights),len(task_ans))
+
+        task_eval = [0]*self.ntasks
+        for t in self.order:
+            asked = len(edges[t]) == 0 or self.followed_row(weights,edges[t],task_eval,most)
+            if asked and self.followed_row(weights,unless[t],task_eval,most):
+                asked = False
+            # Only count a checkbox question if it's above some threshold
+            if asked and self.checkbox[t]:
+                asked = max(weights[idx[t]:stop[t]]) > check_threshold
+            task_eval[t] = int(asked)
+
+        return task_eval,task_ans
+
+    def evaluate(self,weights,check_threshold=0.50):
+
+        # Walk the tree for every row of an [N, n_answers] array at once; each task is a boolean mask over galaxies
+
+        n = len(weights)
+        tests = {}
+
+        def followed(edge):
+            parent,task,op,value = edge
+            return asked[parent] & self.passes(weights,task,op,value,tests)
+
+        def checked(t):
+            with np.errstate(invalid='ignore'):
+                return row_max(weights[:,self.idx[t]:self.stop[t]]) > check_threshold
+
+        asked = [None]*self.ntasks
+        for t in self.order:
+            mask = np.ones(n,dtype=bool) if len(self.edges[t]) == 0 else np.zeros(n,dtype=bool)
+            for e in self.edges[t]:
+                mask |= followed(e)
+            for e in self.unless[t]:
+                mask &= ~followed(e)
+            if self.checkbox[t]:
+                mask &= checked(t)
+            asked[t] = mask
+
+        task_eval = np.zeros((n,self.ntasks),dtype=int)
+        task_ans = np.zeros((n,self.ntasks),dtype=int)
+        for t in range(self.ntasks):
+            task_eval[:,t] = asked[t]
+            if weights[:,self.idx[t]:self.stop[t]].shape[1] > 0:
+                task_ans[:,t] = weights[:,self.idx[t]:self.stop[t]].argmax(axis=1) + self.idx[t]
             else:
-                task_eval[2] = 1
-                task_eval[3] = 1
-                task_eval[4] = 1
-                if weights[5] > weights[6]:
-                    # Barred galaxies
-                    char += 'B'
-                # Bulge prominence
-                char += ('c','b','a')[weights[9:12].argmax()]
-                if weights[7] > weights[8]:
-                    # Arms number
-                    char += ('1','2','3','4','+')[weights[15:20].argmax()]
-                    task_eval[6] = 1
-                    # Arms winding
-                    char += ('t','m','l')[weights[12:15].argmax()]
-                    task_eval[5] = 1
-        
-        # Mergers/tidal debris
-        char += '[%s]' % ('MG','TD','MT','')[weights[26:30].argmax()]
-        task_eval[9] = 1
-        
-        # Odd features
-        if max(weights[31:38]) > 0.50:
-            char += '(%s)' % ('n','r','l','d','i','o','v')[weights[31:38].argmax()]
-            task_eval[10] = 1
-        
-        # Star/artifact
-        if max_t1 == 2:
-            char = 'A'
-        
-        # Discuss
-        task_eval[11] = 1
-        
-        task_ans = [0]*12
-        task_ans[0]  = weights[ 0: 3].argmax()+0
-        task_ans[1]  = weights[ 3: 5].argmax()+3
-        task_ans[2]  = weights[ 5: 7].argmax()+5
-        task_ans[3]  = weights[ 7: 9].argmax()+7
-        task_ans[4]  = weights[ 9:12].argmax()+9
-        task_ans[5]  = weights[12:15].argmax()+12
-        task_ans[6]  = weights[15:20].argmax()+15
-        task_ans[7]  = weights[20:23].argmax()+20
-        task_ans[8]  = weights[23:26].argmax()+23
-        task_ans[9]  = weights[26:30].argmax()+26
-        task_ans[10] = weights[31:38].argmax()+31
-        task_ans[11] = weights[38:40].argmax()+38
-
-    if survey in ('ferengi'):
-    
-        # Top-level: elliptical, features/disk, artifact
-        
-        max_t1 = weights[:3].argmax()
-        
+                print "ValueError in gz_class: {0:} categories, {1:} answers".format(weights.shape[1],self.ntasks)
+
+        return task_eval,task_ans
+
+    def passes(self,weights,task,op,value,tests):
+
+        # Mask of the rows whose answers to task pass an edge's test; tests keeps the comparisons already made
+
+        key = task,op is None
+        if key not in tests:
+            if op is None:
+                with np.errstate(invalid='ignore'):
+                    tests[key] = self.beats[task](weights[:,self.idx[task]],weights[:,self.idx[task]+1])
+            else:
+                tests[key] = weights[:,self.idx[task]:self.stop[task]].argmax(axis=1)
+        if op is None:
+            return tests[key] if value else ~tests[key]
+        return op(tests[key],value)
+
+    def label_row(self,weights,task_eval):
+
+        # Consensus label of a single galaxy, from the tasks on its path
+
         char = ''
-        task_eval = [0]*12
-        
-        task_eval[0] = 1
-        
-        # Smooth galaxies
-        if max_t1 == 0:
-            char += 'E'
-            # Roundness
-            char += ('r','i','c')[weights[23:26].argmax()]
-            task_eval[8] = 1
-        
-        # Features/disk galaxies
-        if max_t1 == 1:
-            char += 'S'
-            
-            task_eval[1] = 1
-            edgeon = weights[3:5]
-            # Edge-on disks
-            if edgeon[0] >= edgeon[1]:
-                char += 'e'
-                # Bulge shape
-                char += ('r','b','n')[weights[20:23].argmax()]
-                task_eval[7] = 1
-            # Not edge-on disks
+        for t,strings,edges in self.labels:
+            if task_eval[t] and (len(edges) == 0 or self.followed_row(weights,edges,task_eval)):
+                if len(strings) == 2:
+                    char += strings[0 if self.yes_row(weights,t) else 1]
+                else:
+                    char += strings[weights[self.idx[t]:self.stop[t]].argmax()]
+        return char
+
+    def label(self,weights,task_eval):
+
+        # Labels for every row at once. Each row's answers to the label tasks are packed into an integer
+        # code, with 0 for a task off its path, and each distinct code is spelled out once at the end.
+
+        code = np.zeros(len(weights),dtype=np.int64)
+        tests = {}
+        for t,strings,edges in self.labels:
+            if len(strings) == 2:
+                answer = np.where(self.passes(weights,t,None,True,tests),0,1)
             else:
-                task_eval[2] = 1
-                task_eval[3] = 1
-                task_eval[4] = 1
-                if weights[5] > weights[6]:
-                    # Barred galaxies
-                    char += 'B'
-                # Bulge prominence
-                char += ('c','b','a')[weights[9:12].argmax()]
-                if weights[7] > weights[8]:
-                    # Arms number
-                    char += ('1','2','3','4','+')[weights[15:20].argmax()]
-                    task_eval[6] = 1
-                    # Arms winding
-                    char += ('t','m','l')[weights[12:15].argmax()]
-                    task_eval[5] = 1
-        
-        # Mergers/tidal debris
-        char += '[%s]' % ('MG','TD','MT','')[weights[26:30].argmax()]
-        task_eval[9] = 1
-        
-        # Odd features
-        if max(weights[31:38]) > 0.50:
-            char += '(%s)' % ('n','r','l','d','i','o','v')[weights[31:38].argmax()]
-            task_eval[10] = 1
-        
-        # Star/artifact
-        if max_t1 == 2:
-            char = 'A'
-        
-        # Discuss
-        task_eval[11] = 1
-        
-        task_ans = [0]*12
-        task_ans[0]  = weights[ 0: 3].argmax()+0
-        task_ans[1]  = weights[ 3: 5].argmax()+3
-        task_ans[2]  = weights[ 5: 7].argmax()+5
-        task_ans[3]  = weights[ 7: 9].argmax()+7
-        task_ans[4]  = weights[ 9:12].argmax()+9
-        task_ans[5]  = weights[12:15].argmax()+12
-        task_ans[6]  = weights[15:20].argmax()+15
-        task_ans[7]  = weights[20:23].argmax()+20
-        task_ans[8]  = weights[23:26].argmax()+23
-        task_ans[9]  = weights[26:30].argmax()+26
-        task_ans[10] = weights[31:38].argmax()+31
-        task_ans[11] = weights[38:40].argmax()+38
-
-    return char,task_eval,task_ans
+                answer = weights[:,self.idx[t]:self.stop[t]].argmax(axis=1)
+            written = task_eval[:,t].astype(bool)
+            if len(edges) > 0:
+                written &= np.any([task_eval[:,parent].astype(bool) & self.passes(weights,task,op,value,tests)
+                                   for parent,task,op,value in edges],axis=0)
+            code = code*(len(strings)+1) + np.where(written,answer+1,0)
+
+        codes,inverse = np.unique(code,return_inverse=True)
+        chars = []
+        for c in codes:
+            char = ''
+            for t,strings,edges in reversed(self.labels):
+                c,digit = divmod(c,len(strings)+1)
+                if digit:
+                    char = strings[digit-1] + char
+            chars.append(char)
+        return np.array(chars,dtype=str)[inverse]
+
+compiled_trees = {}
+
+def compile_tree(survey):
+
+    # Decision tree for a survey, compiled on first use
+
+    if survey not in compiled_trees:
+        compiled_trees[survey] = CompiledTree(survey_tasks[survey])
+    return compiled_trees[survey]
+
+labelled_trees = {}
+
+def labelled_tree(survey):
+
+    # Tree of label_tasks for a survey that has a consensus label, compiled with its labels on first use
+
+    if survey not in survey_labels:
+        raise ValueError("No consensus label is defined for survey '{0}'".format(survey))
+    if survey not in labelled_trees:
+        labelled_trees[survey] = CompiledTree(label_tasks[survey],survey_labels[survey])
+    return labelled_trees[survey]
 
 def plurality(datarow,survey='decals',check_threshold = 0.50):
 
@@ -238,513 +494,77 @@ def plurality(datarow,survey='decals',check_threshold = 0.50):
     
     """
     
-    weights = datarow
-    
-    if survey in ('decals',):
-        
-        d = { 0:{'idx': 0,'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'idx': 3,'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-              2:{'idx': 5,'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
-              3:{'idx': 7,'len':2},       # "Is there any sign of a spiral arm pattern?"
-              4:{'idx': 9,'len':3},       # "How prominent is the central bulge, compared with the rest of the galaxy?" 
-              5:{'idx':12,'len':3},       # "How tightly wound do the spiral arms appear?" 
-              6:{'idx':15,'len':5},       # "How many spiral arms are there?" 
-              7:{'idx':20,'len':3},       # "Does the galaxy have a bulge at its centre? If so, what shape?" 
-              8:{'idx':23,'len':3},       # 'Round', 'How rounded is it?', ->
-              9:{'idx':26,'len':4},       # "Is the galaxy currently merging or is there any sign of tidal debris?" 
-             10:{'idx':31,'len':7},       # "Do you see any of these odd features in the image?"  
-             11:{'idx':38,'len':2}}       # "Would you like to discuss this object?"
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[8] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                # Disk galaxies
-                task_eval[1] = 1
-
-                # Edge-on disks
-                if weights[d[1]['idx']] > weights[d[1]['idx']+1]:
-                    # Bulge shape
-                    task_eval[7] = 1
-                # Not edge-on disks
-                else:
-                    task_eval[2] = 1
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']] > weights[d[3]['idx']+1]:
-                        # Spirals
-                        task_eval[5] = 1
-                        task_eval[6] = 1
-                    task_eval[4] = 1
-            
-            # Merging/tidal debris
-            task_eval[9] = 1
-            
-            # Odd features - only count if it's above some threshold, since this is a checkbox question
-            if max(weights[d[10]['idx']:d[10]['idx'] + d[10]['len']]) > check_threshold:
-                task_eval[10] = 1
-        
-        # Discuss
-        task_eval[11] = 1
-        
-    if survey in ('ferengi','goods_full'):
-
-        d = { 0:{'idx':0  ,'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'idx':3  ,'len':3},       # 'Round', 'How rounded is it?', leadsTo: 'Is there anything odd?', ->
-              2:{'idx':6  ,'len':2},       # 'Clumps', 'Does the galaxy have a mostly clumpy appearance?', ->
-              3:{'idx':8  ,'len':6},       # 'Clumps', 'How many clumps are there?', leadsTo: 'Do the clumps appear in a straight line, a chain, or a cluster?', ->
-              4:{'idx':14 ,'len':4},       # 'Clumps', 'Do the clumps appear in a straight line, a chain, or a cluster?', leadsTo: 'Is there one clump which is clearly brighter than the others?', ->
-              5:{'idx':18 ,'len':2},       # 'Clumps', 'Is there one clump which is clearly brighter than the others?', ->
-              6:{'idx':20 ,'len':2},       # 'Clumps', 'Is the brightest clump central to the galaxy?', ->
-              7:{'idx':22 ,'len':2},       # 'Symmetry', 'Does the galaxy appear symmetrical?', leadsTo: 'Do the clumps appear to be embedded within a larger object?', ->
-              8:{'idx':24 ,'len':2},       # 'Clumps', 'Do the clumps appear to be embedded within a larger object?', leadsTo: 'Is there anything odd?', ->
-              9:{'idx':26 ,'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-             10:{'idx':28 ,'len':3},       # 'Bulge', 'Does the galaxy have a bulge at its center? If so, what shape?', leadsTo: 'Is there anything odd?', ->
-             11:{'idx':31 ,'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?', leadsTo: 'Is there any sign of a spiral arm pattern?', ->
-             12:{'idx':33 ,'len':2},       # 'Spiral', 'Is there any sign of a spiral arm pattern?', ->
-             13:{'idx':35 ,'len':3},       # 'Spiral', 'How tightly wound do the spiral arms appear?', leadsTo: 'How many spiral arms are there?', ->
-             14:{'idx':38 ,'len':6},       # 'Spiral', 'How many spiral arms are there?', leadsTo: 'How prominent is the central bulge, compared with the rest of the galaxy?', ->
-             15:{'idx':44 ,'len':4},       # 'Bulge', 'How prominent is the central bulge, compared with the rest of the galaxy?', leadsTo: 'Is there anything odd?', ->
-             16:{'idx':48 ,'len':2},       # 'Discuss', 'Would you like to discuss this object?', ->
-             17:{'idx':50 ,'len':2},       # 'Odd', 'Is there anything odd?', ->
-             18:{'idx':53 ,'len':7}}       # 'Odd', 'What are the odd features?', ->             # Indexing here skips the a-0 answer.
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[1] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                task_eval[2] = 1
-
-                # Clumpy question
-                if weights[d[2]['idx']] > weights[d[2]['idx']+1]:
-
-                    # Clumpy galaxies
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']:d[3]['idx'] + d[3]['len']].argmax() > 0:
-                        # Multiple clumps
-                        if weights[d[3]['idx']:d[3]['idx'] + d[3]['len']].argmax() > 1:
-                            # One bright clump
-                            task_eval[4] = 1
-                        task_eval[5] = 1
-                        if weights[d[5]['idx']] > weights[d[5]['idx']+1]:
-                            # Bright clump symmetrical
-                            task_eval[6] = 1
-                    if weights[d[6]['idx']] > weights[d[6]['idx']+1]:
-                        task_eval[7] = 1
-                        task_eval[8] = 1
+    return compile_tree(survey).evaluate_row(datarow,check_threshold)
 
-                else:
-                    # Disk galaxies
-                    task_eval[9] = 1
-                    # Edge-on disks
-                    if weights[d[9]['idx']] > weights[d[9]['idx']+1]:
-                        # Bulge shape
-                        task_eval[10] = 1
-                    # Not edge-on disks
-                    else:
-                        task_eval[11] = 1
-                        task_eval[12] = 1
-                        if weights[d[12]['idx']] > weights[d[12]['idx']+1]:
-                            # Spirals
-                            task_eval[13] = 1
-                            task_eval[14] = 1
-                        task_eval[15] = 1
-            
-            # Odd features
-            task_eval[17] = 1
-            if weights[d[17]['idx']] > weights[d[17]['idx']+1]:
-                # Only count if it's above some threshold, since this is a checkbox question
-                if max(weights[d[18]['idx']:d[18]['idx'] + d[18]['len']]) > check_threshold:
-                    task_eval[18] = 1
-        
-        # Discuss
-        task_eval[16] = 1
-        
-    if survey in ('gzh',):
-
-        d = { 0:{'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-              2:{'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?', leadsTo: 'Is there any sign of a spiral arm pattern?', ->
-              3:{'len':2},       # 'Spiral', 'Is there any sign of a spiral arm pattern?', ->
-              4:{'len':4},       # 'Bulge', 'How prominent is the central bulge, compared with the rest of the galaxy?', leadsTo: 'Is there anything odd?', ->
-              5:{'len':2},       # 'Odd', 'Is there anything odd?', ->
-              6:{'len':3},       # 'Round', 'How rounded is it?', leadsTo: 'Is there anything odd?', ->
-              7:{'len':7},       # 'Odd', 'What are the odd features?', ->            Not a checkbox 
-              8:{'len':3},       # 'Bulge', 'Does the galaxy have a bulge at its center? If so, what shape?', leadsTo: 'Is there anything odd?', ->
-              9:{'len':3},       # 'Spiral', 'How tightly wound do the spiral arms appear?', leadsTo: 'How many spiral arms are there?', ->
-             10:{'len':6},       # 'Spiral', 'How many spiral arms are there?', leadsTo: 'How prominent is the central bulge, compared with the rest of the galaxy?', ->
-             11:{'len':2},       # 'Clumps', 'Does the galaxy have a mostly clumpy appearance?', ->
-             12:{'len':6},       # 'Clumps', 'How many clumps are there?', leadsTo: 'Do the clumps appear in a straight line, a chain, or a cluster?', ->
-             13:{'len':2},       # 'Clumps', 'Is there one clump which is clearly brighter than the others?', ->
-             14:{'len':2},       # 'Clumps', 'Is the brightest clump central to the galaxy?', ->
-             15:{'len':4},       # 'Clumps', 'Do the clumps appear in a straight line, a chain, or a cluster?', leadsTo: 'Is there one clump which is clearly brighter than the others?', ->
-             16:{'len':2},       # 'Symmetry', 'Does the galaxy appear symmetrical?', leadsTo: 'Do the clumps appear to be embedded within a larger object?', ->
-             17:{'len':2}}       # 'Clumps', 'Do the clumps appear to be embedded within a larger object?', leadsTo: 'Is there anything odd?', ->
-
-        # Don't need to skip indices since there's no checkbox question
-        idx = 0
-        for i in range(len(d)):
-            d[i]['idx'] = idx
-            idx += d[i]['len']
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[1] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                task_eval[2] = 1
-
-                # Clumpy question
-                if weights[d[2]['idx']] > weights[d[2]['idx']+1]:
-
-                    # Clumpy galaxies
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']:d[3]['idx'] + d[3]['len']].argmax() > 0:
-                        # Multiple clumps
-                        if weights[d[3]['idx']:d[3]['idx'] + d[3]['len']].argmax() > 1:
-                            # Clump arrangement
-                            task_eval[4] = 1
-                            if weights[d[4]['idx']:d[4]['idx']+d[4]['len']].argmax() == 3:
-                                # Bar
-                                task_eval[11] = 1
-                                # Spiral structure
-                                task_eval[12] = 1
-                                if weights[d[12]['idx']] > weights[d[12]['idx']+1]:
-                                    # Spiral arms
-                                    task_eval[13] = 1
-                                    task_eval[14] = 1
-                                # Bulge prominence
-                                task_eval[15] = 1
-                        # One clump brighter than others
-                        task_eval[5] = 1
-                        if weights[d[5]['idx']] > weights[d[5]['idx']+1]:
-                            # Bright clump central
-                            task_eval[6] = 1
-                    if weights[d[6]['idx']] > weights[d[6]['idx']+1]:
-                        # Symmetrical clumps
-                        task_eval[7] = 1
-                        # Clumps embedded
-                        task_eval[8] = 1
+def plurality_batch(votes,survey='decals',check_threshold = 0.50):
 
-                else:
-                    # Disk galaxies
-                    task_eval[9] = 1
-                    # Edge-on disks
-                    if weights[d[9]['idx']] > weights[d[9]['idx']+1]:
-                        # Bulge shape
-                        task_eval[10] = 1
-                    # Not edge-on disks
-                    else:
-                        # Bar
-                        task_eval[11] = 1
-                        # Spiral
-                        task_eval[12] = 1
-                        if weights[d[12]['idx']] > weights[d[12]['idx']+1]:
-                            # Spiral arm numbers and winding
-                            task_eval[13] = 1
-                            task_eval[14] = 1
-                        # Bulge prominence
-                        task_eval[15] = 1
-            
-            # Odd features
-            task_eval[16] = 1
-            if weights[d[16]['idx']] > weights[d[16]['idx']+1]:
-                # Only count if it's above some threshold, since this is a checkbox question
-                if max(weights[d[17]['idx']:d[17]['idx'] + d[17]['len']]) > check_threshold:
-                    task_eval[17] = 1
-        
-        # Clumpy questions 5-8 not answered if they were organized in a spiral
-
-        if weights[d[4]['idx']:d[4]['idx']+d[4]['len']].argmax() == 3 and task_eval[4]:
-            task_eval[5] = 0
-            task_eval[6] = 0
-            task_eval[7] = 0
-            task_eval[8] = 0
-
-    if survey in ('candels','candels_2epoch'):
-        
-        d = { 0:{'idx':0 ,'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'idx':3 ,'len':3},       # 'Round', 'How rounded is it?', leadsTo: 'Is there anything odd?', ->
-              2:{'idx':6 ,'len':2},       # 'Clumps', 'Does the galaxy have a mostly clumpy appearance?', ->
-              3:{'idx':8 ,'len':6},       # 'Clumps', 'How many clumps are there?', leadsTo: 'Do the clumps appear in a straight line, a chain, or a cluster?', ->
-              4:{'idx':14,'len':4},       # 'Clumps', 'Do the clumps appear in a straight line, a chain, or a cluster?', leadsTo: 'Is there one clump which is clearly brighter than the others?', ->
-              5:{'idx':18,'len':2},       # 'Clumps', 'Is there one clump which is clearly brighter than the others?', ->
-              6:{'idx':20,'len':2},       # 'Clumps', 'Is the brightest clump central to the galaxy?', ->
-              7:{'idx':22,'len':2},       # 'Symmetry', 'Does the galaxy appear symmetrical?', leadsTo: 'Do the clumps appear to be embedded within a larger object?', ->
-              8:{'idx':24,'len':2},       # 'Clumps', 'Do the clumps appear to be embedded within a larger object?', leadsTo: 'Is there anything odd?', ->
-              9:{'idx':26,'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-             10:{'idx':28,'len':2},       # 'Bulge', 'Does the galaxy have a bulge at its center?', leadsTo: 'Is there anything odd?', ->
-             11:{'idx':30,'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?', leadsTo: 'Is there any sign of a spiral arm pattern?', ->
-             12:{'idx':32,'len':2},       # 'Spiral', 'Is there any sign of a spiral arm pattern?', ->
-             13:{'idx':34,'len':3},       # 'Spiral', 'How tightly wound do the spiral arms appear?', leadsTo: 'How many spiral arms are there?', ->
-             14:{'idx':37,'len':6},       # 'Spiral', 'How many spiral arms are there?', leadsTo: 'How prominent is the central bulge, compared with the rest of the galaxy?', ->
-             15:{'idx':43,'len':3},       # 'Bulge', 'How prominent is the central bulge, compared with the rest of the galaxy?', leadsTo: 'Is there anything odd?', ->
-             16:{'idx':46,'len':4},       #  Merging/tidal debris
-             17:{'idx':50,'len':2}}       #  Discuss
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[1] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                task_eval[2] = 1
-
-                # Clumpy question
-                if weights[d[2]['idx']] > weights[d[2]['idx']+1]:
-
-                    # Clumpy galaxies
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']:d[3]['idx'] + d[3]['len']].argmax() > 0:
-                        # Multiple clumps
-                        if weights[d[3]['idx']:d[3]['idx'] + d[3]['len']].argmax() > 1:
-                            # One bright clump
-                            task_eval[4] = 1
-                        task_eval[5] = 1
-                        if weights[d[5]['idx']] > weights[d[5]['idx']+1]:
-                            # Bright clump symmetrical
-                            task_eval[6] = 1
-                    if weights[d[6]['idx']] > weights[d[6]['idx']+1]:
-                        task_eval[7] = 1
-                        task_eval[8] = 1
-
-                else:
-                    # Disk galaxies
-                    task_eval[9] = 1
-                    # Edge-on disks
-                    if weights[d[9]['idx']] > weights[d[9]['idx']+1]:
-                        # Bulge shape
-                        task_eval[10] = 1
-                    # Not edge-on disks
-                    else:
-                        task_eval[11] = 1
-                        task_eval[12] = 1
-                        if weights[d[12]['idx']] > weights[d[12]['idx']+1]:
-                            # Spirals
-                            task_eval[13] = 1
-                            task_eval[14] = 1
-                        task_eval[15] = 1
-            
-            # Merging/tidal debris
-            task_eval[16] = 1
-
-        # Discuss
-        task_eval[17] = 1
-        
-    if survey in ('illustris',):
-        
-        d = { 0:{'idx': 0,'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'idx': 3,'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-              2:{'idx': 5,'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
-              3:{'idx': 7,'len':2},       # "Is there any sign of a spiral arm pattern?"
-              4:{'idx': 9,'len':4},       # "How prominent is the central bulge, compared with the rest of the galaxy?" 
-              5:{'idx':14,'len':7},       # Odd features
-              6:{'idx':21,'len':3},       # Round
-              7:{'idx':24,'len':3},       # Bulge shape
-              8:{'idx':27,'len':3},       # arms winding
-              9:{'idx':30,'len':6},       # arms number
-             10:{'idx':36,'len':2},       # Is there anything odd?
-             11:{'idx':38,'len':2}}       # "Would you like to discuss this object?"
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[6] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                # Disk galaxies
-                task_eval[1] = 1
-
-                # Edge-on disks
-                if weights[d[1]['idx']] > weights[d[1]['idx']+1]:
-                    # Bulge shape
-                    task_eval[7] = 1
-                # Not edge-on disks
-                else:
-                    task_eval[2] = 1
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']] > weights[d[3]['idx']+1]:
-                        # Spirals
-                        task_eval[8] = 1
-                        task_eval[9] = 1
-                    task_eval[4] = 1
-            
-
-            # Odd features
-            task_eval[10] = 1
-            if weights[d[10]['idx']] > weights[d[10]['idx']+1]:
-                # Only count if it's above some threshold, since this is a checkbox question
-                if max(weights[d[5]['idx']:d[5]['idx'] + d[5]['len']]) > check_threshold:
-                    task_eval[5] = 1
-        
-        # Discuss
-        task_eval[11] = 1
-        
-    if survey in ('sloan','sloan_singleband','ukidss'):
-        
-        d = { 0:{'idx': 0,'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'idx': 3,'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-              2:{'idx': 5,'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
-              3:{'idx': 7,'len':2},       # "Is there any sign of a spiral arm pattern?"
-              4:{'idx': 9,'len':4},       # "How prominent is the central bulge, compared with the rest of the galaxy?" 
-              5:{'idx':13,'len':2},       # Is there anything odd?
-              6:{'idx':16,'len':7},       # Odd features
-              7:{'idx':23,'len':3},       # Round
-              8:{'idx':26,'len':3},       # Bulge shape
-              9:{'idx':29,'len':3},       # arms winding
-             10:{'idx':32,'len':6},       # arms number
-             11:{'idx':38,'len':2}}       # "Would you like to discuss this object?"
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[7] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                # Disk galaxies
-                task_eval[1] = 1
-
-                # Edge-on disks
-                if weights[d[1]['idx']] > weights[d[1]['idx']+1]:
-                    # Bulge shape
-                    task_eval[8] = 1
-                # Not edge-on disks
-                else:
-                    task_eval[2] = 1
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']] > weights[d[3]['idx']+1]:
-                        # Spirals
-                        task_eval[9] = 1
-                        task_eval[10] = 1
-                    task_eval[4] = 1
-            
+    """ Vectorized plurality over a whole table of vote fractions at once.
+    
+    Parameters
+    ----------
+    votes : array [N, n_answers]
+        Vote fractions for N galaxies, in the same column order as
+        the rows passed to plurality
+    
+    survey : string indicating the survey group that defines
+        the workflow/decision tree. Same options as plurality.
 
-            # Odd features
-            task_eval[5] = 1
-            if weights[d[5]['idx']] > weights[d[5]['idx']+1]:
-                # Only count if it's above some threshold, since this is a checkbox question
-                if max(weights[d[6]['idx']:d[6]['idx'] + d[6]['len']]) > check_threshold:
-                    task_eval[6] = 1
-        
-        # Discuss
-        task_eval[11] = 1
-
-    if survey in ('gz2','stripe82',):
-        
-        d = { 0:{'idx': 0,'len':3},       # 'Shape', 'Is the galaxy simply smooth and rounded, with no sign of a disk?', ->
-              1:{'idx': 3,'len':2},       # 'Disk', 'Could this be a disk viewed edge-on?', ->
-              2:{'idx': 5,'len':2},       # 'Bar', 'Is there any sign of a bar feature through the centre of the galaxy?' ->
-              3:{'idx': 7,'len':2},       # "Is there any sign of a spiral arm pattern?"
-              4:{'idx': 9,'len':4},       # "How prominent is the central bulge, compared with the rest of the galaxy?" 
-              5:{'idx':13,'len':2},       # Is there anything odd?
-              6:{'idx':15,'len':3},       # Round
-              7:{'idx':18,'len':7},       # Odd features
-              8:{'idx':25,'len':3},       # Bulge shape
-              9:{'idx':28,'len':3},       # arms winding
-             10:{'idx':31,'len':6}}       # arms number
-
-        task_eval = [0]*len(d)
-        task_ans  = [0]*len(d)
-        
-        # Top-level: smooth/features/artifact
-        task_eval[0] = 1
-        
-        if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() < 2:
-
-            # Smooth galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 0:
-                # Roundness
-                task_eval[6] = 1
-
-            # Features/disk galaxies
-            if weights[d[0]['idx']:d[0]['idx']+d[0]['len']].argmax() == 1:
-                # Disk galaxies
-                task_eval[1] = 1
-
-                # Edge-on disks
-                if weights[d[1]['idx']] > weights[d[1]['idx']+1]:
-                    # Bulge shape
-                    task_eval[8] = 1
-                # Not edge-on disks
-                else:
-                    task_eval[2] = 1
-                    task_eval[3] = 1
-                    if weights[d[3]['idx']] > weights[d[3]['idx']+1]:
-                        # Spirals
-                        task_eval[9] = 1
-                        task_eval[10] = 1
-                    task_eval[4] = 1
-            
+    check_threshold: float indicating the threshold plurality level for
+        checkbox questions. If no questions meet this, don't select any answer.
+    
+    Returns
+    -------
+    task_eval: int array [N, n_tasks]
+        Row i is identical to the task_eval list from plurality(votes[i])
+    
+    task_ans: int array [N, n_tasks]
+        Row i is identical to the task_ans list from plurality(votes[i])
+    
+    Notes
+    -------
+    Runs the same compiled decision tree as plurality, with each task a
+    boolean mask over all galaxies instead of a walk per row.
+    
+    """
+    
+    return compile_tree(survey).evaluate(np.asarray(votes),check_threshold)
 
-            # Odd features
-            task_eval[5] = 1
-            if weights[d[5]['idx']] > weights[d[5]['idx']+1]:
-                task_eval[7] = 1
-        
-    # Assign the plurality task numbers
+def gal_string_batch(votes,survey='decals',check_threshold = 0.50):
 
-    for i,t in enumerate(task_ans):
-        try:
-            task_ans[i]  = weights[d[i]['idx']:d[i]['idx'] + d[i]['len']].argmax() + d[i]['idx']
-        except ValueError:
-            print "ValueError in gz_class: {0:} categories, {1:} answers".format(len(weights),len(task_ans))
+    """ Vectorized gal_string over a whole table of vote fractions at once.
+    
+    Parameters
+    ----------
+    votes : array [N, n_answers]
+        Vote fractions for N galaxies, in the same column order as
+        the rows passed to gal_string
+    
+    survey : string indicating the survey group that defines
+        the workflow/decision tree. Same options as gal_string.
 
-    return task_eval,task_ans
+    check_threshold: float indicating the threshold plurality level for
+        checkbox questions, as in plurality_batch.
+    
+    Returns
+    -------
+    char: string array [N]
+        Element i is identical to the string from gal_string(votes[i])
+    
+    task_eval: int array [N, n_tasks]
+        Row i is identical to the task_eval list from gal_string(votes[i])
+    
+    task_ans: int array [N, n_tasks]
+        Row i is identical to the task_ans list from gal_string(votes[i])
+    
+    Notes
+    -------
+    Evaluates the compiled tree as plurality_batch does. The answers that
+    go into each label are packed into an integer code, and each distinct
+    code is turned into its string once.
+    
+    """
+    
+    tree = labelled_tree(survey)
+    weights = np.asarray(votes)
+    task_eval,task_ans = tree.evaluate(weights,check_threshold)
+    return tree.label(weights,task_eval),task_eval,task_ans
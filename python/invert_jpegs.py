@@ -2,71 +2,91 @@ from PIL import Image
 import PIL.ImageOps
 import progressbar as pb
 import os
+import time
 
-from multiprocessing.dummy import Pool as ThreadPool
-from multiprocessing import Value, Lock
+from multiprocessing import Pool, cpu_count
+
+# os.scandir is Python 3.5+; the scandir package backports it. Without either, fall back to listdir and stat.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 widgets = ['Inverting: ', pb.Percentage(), ' ', pb.Bar(marker='0',left='[',right=']'), ' ', pb.ETA()]
-cdx = 0
-pbar = 0
-class Counter(object):
-    def __init__(self, initval=0):
-        self.val = Value('i', initval)
-        self.lock = Lock()
-    def change_value(self,v):
-        with self.lock:
-            self.val.value = v
-    def increment(self):
-        with self.lock:
-            self.val.value += 1
-    def value(self):
-        with self.lock:
-            return self.val.value
 
-def invert_jpegs(fn, base_dir, inverted_dir):
-    if '.jpeg' in fn:
-        in_file = '{0}/{1}'.format(base_dir, fn)
-        out_file = '{0}/{1}'.format(inverted_dir, fn)
-        if not os.path.isfile(out_file):
-            image = Image.open(in_file)
-            inverted_image = PIL.ImageOps.invert(image)
-            inverted_image.save(out_file)
-    cdx.increment()
-    pbar.update(cdx.value())
+def jpeg_mtimes(path):
+    # Modification time of every JPEG in a directory, from a single directory scan
+    mtimes = {}
+    if not os.path.isdir(path):
+        return mtimes
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.name.endswith('.jpeg') and entry.is_file():
+                mtimes[entry.name] = entry.stat().st_mtime
+    else:
+        for fn in os.listdir(path):
+            if fn.endswith('.jpeg'):
+                mtimes[fn] = os.stat(os.path.join(path, fn)).st_mtime
+    return mtimes
 
-class function_wrapper(object):
-    def __init__(self, f, args, kwargs):
-        self.f = f
-        self.args = args
-        self.kwargs = kwargs
-    def __call__(self, x):
-        return self.f(x, *self.args, **self.kwargs)
+def stale_jpegs(base_dir, inverted_dir):
+    # JPEGs whose inverted version is missing or older than the original
+    inverted = jpeg_mtimes(inverted_dir)
+    return sorted(fn for fn,mtime in jpeg_mtimes(base_dir).items() if inverted.get(fn, -1) < mtime)
 
-if __name__ == "__main__":
-    #dr2 images
-    print 'dr2'
-    file_names = os.listdir('../jpeg/dr2')
-    cdx=Counter(0)
+def invert_jpeg(args):
+    # Invert one JPEG; runs in a worker process. Returns the number of bytes read and written.
+    fn, base_dir, inverted_dir = args
+    in_file = '{0}/{1}'.format(base_dir, fn)
+    out_file = '{0}/{1}'.format(inverted_dir, fn)
+    # Written under a temporary name, so an interrupted write never looks newer than its original
+    part_file = '{0}.{1}.part'.format(out_file, os.getpid())
+    image = Image.open(in_file)
+    inverted_image = PIL.ImageOps.invert(image)
+    inverted_image.save(part_file, format='JPEG')
+    os.rename(part_file, out_file)
+    return os.path.getsize(in_file), os.path.getsize(out_file)
+
+def invert_jpegs(base_dir, inverted_dir, nprocesses=None):
+    # Invert every JPEG in base_dir that is new or has changed since it was last inverted, on all cores
+    if not os.path.isdir(inverted_dir):
+        os.makedirs(inverted_dir)
+    file_names = stale_jpegs(base_dir, inverted_dir)
+    print '{0} JPEGs to invert'.format(len(file_names))
+    if len(file_names) == 0:
+        return None
+
+    nprocesses = cpu_count() if nprocesses is None else nprocesses
+    pool = Pool(nprocesses)
     pbar = pb.ProgressBar(widgets=widgets, maxval=len(file_names))
-    invert_dr2 = function_wrapper(invert_jpegs, ['../jpeg/dr2', '../jpeg/dr2_inverted'], {})
-    pool=ThreadPool(4)
     pbar.start()
-    results = pool.map(invert_dr2, file_names)
+    start = time.time()
+    bytes_in = bytes_out = 0
+    # Progress is counted in this process as results come back, so workers share no counter
+    jobs = [(fn, base_dir, inverted_dir) for fn in file_names]
+    for i,(nin,nout) in enumerate(pool.imap_unordered(invert_jpeg, jobs, chunksize=16)):
+        bytes_in += nin
+        bytes_out += nout
+        pbar.update(i+1)
     pbar.finish()
     pool.close()
     pool.join()
+    elapsed = time.time() - start
+
+    print '{0} JPEGs inverted in {1:.1f} s on {2} processes: {3:.1f} images/s, {4:.1f} MB/s read, {5:.1f} MB/s written'.format(
+        len(file_names), elapsed, nprocesses, len(file_names) / elapsed, bytes_in / elapsed / 1e6, bytes_out / elapsed / 1e6)
+    return None
+
+if __name__ == "__main__":
+    #dr2 images
+    print 'dr2'
+    invert_jpegs('../jpeg/dr2', '../jpeg/dr2_inverted')
     print '==============='
 
     #nsa_not_gz images
     print 'nsa'
-    file_names = os.listdir('../jpeg/nsa_not_gz')
-    cdx=Counter(0)
-    pbar = pb.ProgressBar(widgets=widgets, maxval=len(file_names))
-    invert_nsa = function_wrapper(invert_jpegs, ['../jpeg/nsa_not_gz', '../jpeg/nsa_not_gz_inverted'], {})
-    pool=ThreadPool(4)
-    pbar.start()
-    results = pool.map(invert_nsa, file_names)
-    pbar.finish()
-    pool.close()
-    pool.join()
+    invert_jpegs('../jpeg/nsa_not_gz', '../jpeg/nsa_not_gz_inverted')
     print '==============='
@@ -2,12 +2,12 @@
 
 from astropy.io import fits
 from astropy.table import Table,Column
-from astropy.cosmology import WMAP9
-from astropy import units as u
 import numpy as np
 import warnings
 import os
 
+from cosmology_table import cosmology_table
+
 warnings.simplefilter("ignore",RuntimeWarning)
 
 gzpath = '/Users/willettk/Astronomy/Research/GalaxyZoo'
@@ -24,7 +24,7 @@ t['coords.1'] = nsa_decals['DEC']
 
 # Calculate absolute size in kpc
 
-size = [WMAP9.kpc_proper_per_arcmin(z).to(u.kpc/u.arcsec) * (r * u.arcsec) if z > 0 else -99. * u.kpc for z,r in zip(nsa_decals['Z'],nsa_decals['PETROTHETA'])]
+sizearr = np.where(nsa_decals['Z'] > 0,cosmology_table().kpc_per_arcsec(nsa_decals['Z']) * nsa_decals['PETROTHETA'],-99.)
 
 # Calculate absolute and apparent magnitude 
 
@@ -37,8 +37,6 @@ mag_r = [22.5 - 2.5*np.log10(x[4]) for x in nsa_decals['NMGY']]
 mag_i = [22.5 - 2.5*np.log10(x[5]) for x in nsa_decals['NMGY']]
 mag_z = [22.5 - 2.5*np.log10(x[6]) for x in nsa_decals['NMGY']]
 
-sizearr = [s.value for s in size]
-
 fluxarr = [x[4] for x in nsa_decals['PETROFLUX']]
 
 url_stub = "http://www.galaxyzoo.org.s3.amazonaws.com/subjects/decals"
@@ -2,12 +2,12 @@
 
 from astropy.io import fits
 from astropy.table import Table,Column
-from astropy.cosmology import WMAP9
-from astropy import units as u
 import numpy as np
 import warnings
 import os
 
+from cosmology_table import cosmology_table
+
 warnings.simplefilter("ignore",RuntimeWarning)
 
 version = '1_0_0'
@@ -22,8 +22,8 @@ t['coords.1'] = nsa_decals['DEC']
 
 # Calculate absolute size in kpc
 
-size = WMAP9.kpc_proper_per_arcmin(nsa_decals['Z']).to(u.kpc/u.arcsec)*(nsa_decals['PETROTHETA']*u.arcsec)
-size[nsa_decals['Z']<0] = -99.*u.kpc
+size = cosmology_table().kpc_per_arcsec(nsa_decals['Z'])*nsa_decals['PETROTHETA']
+size[nsa_decals['Z']<0] = -99.
 
 # Calculate absolute and apparent magnitude
 
@@ -41,7 +41,7 @@ for imgtype in ('standard','inverted','thumbnail'):
 
 t['nsa_id'] = np.char.add('NSA_',nsa_decals['NSAID'].astype(str))
 
-t['metadata.absolute_size'] = size.value
+t['metadata.absolute_size'] = size
 t['metadata.counters.feature'] = np.zeros(N,dtype=int)
 t['metadata.counters.smooth'] = np.zeros(N,dtype=int)
 t['metadata.counters.star'] = np.zeros(N,dtype=int)
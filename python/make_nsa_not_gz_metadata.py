@@ -2,12 +2,12 @@
 
 from astropy.io import fits
 from astropy.table import Table,Column
-from astropy.cosmology import WMAP9
-from astropy import units as u
 import numpy as np
 import warnings
 import os
 
+from cosmology_table import cosmology_table
+
 warnings.simplefilter("ignore",RuntimeWarning)
 
 version = '0_1_2'
@@ -22,8 +22,8 @@ t['coords.1'] = nsa_not_gz['DEC']
 
 # Calculate absolute size in kpc
 
-size = WMAP9.kpc_proper_per_arcmin(nsa_not_gz['Z']).to(u.kpc/u.arcsec)*(nsa_not_gz['PETROTHETA']*u.arcsec)
-size[nsa_not_gz['Z']<0] = -99.*u.kpc
+size = cosmology_table().kpc_per_arcsec(nsa_not_gz['Z'])*nsa_not_gz['PETROTHETA']
+size[nsa_not_gz['Z']<0] = -99.
 
 # Calculate absolute and apparent magnitude
 
@@ -41,7 +41,7 @@ for imgtype in ('standard','inverted','thumbnail'):
 
 t['nsa_id'] = np.char.add('NSA_',nsa_not_gz['NSAID'].astype(str))
 
-t['metadata.absolute_size'] = size.value
+t['metadata.absolute_size'] = size
 t['metadata.counters.feature'] = np.zeros(N,dtype=int)
 t['metadata.counters.smooth'] = np.zeros(N,dtype=int)
 t['metadata.counters.star'] = np.zeros(N,dtype=int)
@@ -0,0 +1,474 @@
+# Render multi-band cutouts to RGB with Dustin Lang's technique
+
+'''
+This module owns the arcsinh stretch, the per-band scale tables and the desaturation
+step, for single images (dstn_rgb) and for stacks of same-size cutouts (BatchRenderer).
+dstn_rgb keeps a renderer per thread, so a loop over cutouts of the same size reuses its buffers.
+
+Everything is computed in float32 with in-place ufuncs on preallocated buffers, in the same
+order as the original dstn_rgb, so the output is bitwise identical to it. Every step is
+per-pixel, so rows can also be rendered in chunks on several threads (numpy releases the
+GIL inside ufuncs) without changing the result.
+
+For 8-bit output the stretch can instead go through per-band lookup tables (lut=True),
+which trades a bounded error of at most one byte level for skipping the arcsinh.
+'''
+
+from __future__ import division
+import threading
+import numpy as np
+from multiprocessing.dummy import Pool as ThreadPool
+from PIL import Image, ImageOps
+
+# Plane in the RGB image and scale (nanomaggies per unit) for each band
+
+grzscales = dict(g = (2, 0.0066),
+                 r = (1, 0.01385),
+                 z = (0, 0.025),
+                 )
+
+urzscales = dict(u = (2, 0.0066),
+                 r = (1, 0.01),
+                 z = (0, 0.025),
+                 )
+
+griscales = dict(g = (2, 0.002),
+                 r = (1, 0.004),
+                 i = (0, 0.005),
+                 )
+
+# Settings used for the DR2 NSA images
+
+dr2_scales = dict(g = (2, 0.008), r = (1, 0.014), z = (0, 0.019))
+dr2_mnmx = (-0.5,300)
+
+def default_scales(bands):
+
+    # Scale table used for a set of bands when none is given
+
+    if bands == 'urz':
+        return urzscales
+    elif bands == 'gri':
+        return griscales
+    else:
+        return grzscales
+
+_row_pools = {}
+
+def row_pool(nthreads):
+
+    # Thread pool shared by every renderer that splits its rows over nthreads
+
+    if nthreads not in _row_pools:
+        _row_pools[nthreads] = ThreadPool(nthreads)
+
+    return _row_pools[nthreads]
+
+def to_bytes(rgb, out=None):
+
+    # Quantize RGB values between 0 and 1 to 0-255 the same way as matplotlib's imsave (truncating x*255)
+
+    if out is None:
+        out = np.empty(rgb.shape, np.uint8)
+    np.multiply(rgb, 255, out=out, casting='unsafe')
+
+    return out
+
+# Bounding box of the thumbnails written by save_jpegs
+thumbnail_size = (100,100)
+
+def save_jpeg(filename, rgb, quality=95, origin='lower', dpi=100):
+
+    # Encode an (H,W,3) image, float between 0 and 1 or uint8, straight to JPEG with PIL
+
+    '''
+    Writes the same file as plt.imsave(filename, rgb, origin=origin), whose JPEGs are
+    saved by PIL with quality 95 at 100 dpi, without going through pyplot and a figure.
+    With origin='lower' the first row is the bottom of the image: PIL reads the rows
+    bottom-up rather than the array being flipped.
+    '''
+
+    save_jpegs(rgb, filename, quality=quality, origin=origin, dpi=dpi)
+
+    return None
+
+def save_jpegs(rgb, filename=None, inverted_filename=None, thumbnail_filename=None,
+               thumbnail_size=thumbnail_size, quality=95, origin='lower', dpi=100):
+
+    # Write the standard, inverted and thumbnail JPEGs of one image; any of the filenames can be None
+
+    '''
+    All three come from the same uncompressed image in memory. The inverted image is
+    exactly ImageOps.invert of the pixels that go into the standard JPEG, and the thumbnail
+    is shrunk to fit within thumbnail_size, so neither has to decode and re-encode the
+    standard JPEG.
+    '''
+
+    if rgb.dtype != np.uint8:
+        rgb = to_bytes(rgb)
+    rgb = np.ascontiguousarray(rgb)
+
+    h,w = rgb.shape[:2]
+    ystep = -1 if origin == 'lower' else 1
+    img = Image.frombuffer('RGB', (w,h), rgb, 'raw', 'RGB', 0, ystep)
+
+    options = dict(format='JPEG', quality=quality, dpi=(dpi,dpi))
+    if filename is not None:
+        img.save(filename, **options)
+    if inverted_filename is not None:
+        ImageOps.invert(img).save(inverted_filename, **options)
+    if thumbnail_filename is not None:
+        thumb = img.copy()
+        thumb.thumbnail(thumbnail_size, Image.ANTIALIAS)
+        thumb.save(thumbnail_filename, **options)
+
+    return None
+
+def float_bits(flux):
+
+    # Bit patterns of float32 fluxes as unsigned integers, without copying
+
+    if flux.dtype.kind != 'f' or flux.dtype.itemsize != 4:
+        flux = flux.astype(np.float32)
+
+    return flux.view(flux.dtype.byteorder + 'u4')
+
+# Fluxes are bucketed on the top 32-lut_shift bits of their float32 bit pattern:
+# the sign, the exponent and the top 9 bits of the mantissa
+lut_shift = 14
+
+class StretchLUT(object):
+
+    '''
+    Lookup table for the arcsinh stretch of one band. Replaces the divide, arcsinh and
+    normalisation on every pixel with an integer shift and a table lookup.
+
+    A float32 flux is looked up by the top 32-shift bits of its bit pattern, so each bucket
+    spans a relative flux range of 2**(shift-23). Each bucket holds the exact result for the
+    flux at its centre, both as
+        values  the stretched value before desaturation and clipping
+        bytes   the final 0-255 value when there is no desaturation
+
+    The error against the exact path is bounded and is measured over every finite bucket
+    when the table is built:
+        max_value_error  largest |value - exact value|. At most 2**(shift-24)/(sqrt(arcsinh)*(mx-mn))
+                         plus float32 rounding: about 1e-4 for the DR2 settings, or 0.04 of one byte level.
+        max_byte_error   largest |byte - exact byte|. This is 1, and only for fluxes in the buckets that
+                         straddle a byte boundary.
+    With desaturation the value error is carried through to the output, so a small fraction of
+    pixels can also end up one level away from the exact path.
+    '''
+
+    def __init__(self, scale, mnmx, arcsinh, shift=lut_shift):
+
+        assert arcsinh is not None, "Lookup tables are only made for the arcsinh stretch"
+
+        self.shift = shift
+        exact = BatchRenderer('x', mnmx=mnmx, arcsinh=arcsinh, scales={'x':(0,scale)})
+
+        def stretch(codes):
+            flux = codes.view(np.float32)
+            value = np.divide(flux, scale).astype(np.float32)
+            exact._stretch(value)
+            return value
+
+        # Every float32 bit pattern is evaluated, including NaNs and infinities
+        with np.errstate(invalid='ignore', over='ignore'):
+            codes = np.arange(2**(32-shift), dtype=np.uint32) << shift
+            lo = stretch(codes)
+            hi = stretch(codes | np.uint32(2**shift - 1))
+            mid = stretch(codes | np.uint32(2**(shift-1)))
+
+            # The bucket starting at +/-inf has NaNs above it; keep the infinity
+            np.copyto(mid, lo, where=np.isinf(lo))
+
+            self.values = mid
+            self.bytes = to_bytes(np.clip(mid, 0., 1.))
+
+            finite = np.isfinite(lo) & np.isfinite(hi)
+            self.max_value_error = max(np.abs(mid - lo)[finite].max(), np.abs(hi - mid)[finite].max())
+            lo_bytes = to_bytes(np.clip(lo, 0., 1.)).astype(int)
+            hi_bytes = to_bytes(np.clip(hi, 0., 1.)).astype(int)
+            self.max_byte_error = max(np.abs(self.bytes - lo_bytes)[finite].max(), np.abs(hi_bytes - self.bytes)[finite].max())
+
+    def lookup(self, flux, table, index, out):
+
+        # Look up every flux in table (values or bytes), using index as a uint32 work array of the same shape
+
+        np.right_shift(float_bits(flux), self.shift, out=index)
+        np.take(table, index, out=out, mode='clip')
+
+        return out
+
+_stretch_luts = {}
+
+def stretch_lut(scale, mnmx, arcsinh, shift=lut_shift):
+
+    # Lookup table for one band, built once for each (scale, mnmx, arcsinh)
+
+    key = (scale, None if mnmx is None else tuple(mnmx), arcsinh, shift)
+    if key not in _stretch_luts:
+        _stretch_luts[key] = StretchLUT(scale, mnmx, arcsinh, shift)
+
+    return _stretch_luts[key]
+
+class BatchRenderer(object):
+
+    '''
+    Render an (N,3,H,W) stack of same-size images to an (N,H,W,3) array of RGB values between 0 and 1.
+
+    Gives exactly the same values as dstn_rgb on each image, but works on the whole stack
+    with in-place ufuncs. Working buffers and the output array are allocated for the first
+    stack and reused for every later stack of the same shape, so the returned array is
+    overwritten by the next call to render.
+
+    *bands*  string of bands in the order of the second axis of the stack, eg 'grz'
+    *mnmx*   = (min,max), values that will become black/white *after* scaling.
+             Default is (-3,10)
+    *arcsinh* use nonlinear scaling as in SDSS
+    *scales* dictionary of band -> (plane,scale); defaults depend on bands
+    *desaturate* desaturate pixels dominated by a single colour
+    *nthreads* render the rows in this many chunks on a shared thread pool
+    *lut*    stretch through per-band lookup tables (see StretchLUT) instead of evaluating
+             the arcsinh on every pixel. Approximate, with a bounded error.
+    '''
+
+    def __init__(self, bands='grz', mnmx=None, arcsinh=None, scales=None, desaturate=False, nthreads=1, lut=False):
+
+        self.bands = ''.join(bands)
+        self.scales = default_scales(self.bands) if scales is None else scales
+        self.arcsinh = arcsinh
+        self.desaturate = desaturate
+        self.nthreads = nthreads
+
+        if mnmx is None:
+            mn,mx = -3, 10
+        else:
+            mn,mx = mnmx
+
+        if arcsinh is not None:
+            mn = self.nlmap(mn)
+            mx = self.nlmap(mx)
+
+        self.mn,self.mx = mn,mx
+
+        if lut:
+            self.luts = dict((band, stretch_lut(self.scales[band][1], mnmx, arcsinh)) for band in self.bands)
+        else:
+            self.luts = None
+
+        # Planes with no band are black before stretching
+        filled = [self.scales[band][0] for band in self.bands]
+        self.unfilled = [plane for plane in range(3) if plane not in filled]
+        self.zero = np.zeros(1, np.float32)
+        self._stretch(self.zero)
+
+        self.shape = None
+
+    def nlmap(self, x):
+
+        return np.arcsinh(x * self.arcsinh) / np.sqrt(self.arcsinh)
+
+    def _allocate(self, shape):
+
+        n,nb,h,w = shape
+
+        self.shape = shape
+        self.planes = np.zeros((n,3,h,w), np.float32)
+        self.out = np.zeros((n,h,w,3), np.float32)
+        # Only made once bytes are asked for
+        self.bytes_out = None
+        if self.luts is not None:
+            self.index = np.zeros((n,h,w), np.uint32)
+        if self.desaturate:
+            self.a = np.zeros((n,h,w), np.float32)
+            self.wt = np.zeros((n,h,w), np.float32)
+            self.u = np.zeros((n,h,w), np.float32)
+            self.au = np.zeros((n,h,w), np.float32)
+            self.tmp = np.zeros((n,h,w), np.float32)
+            self.mask = np.zeros((n,h,w), bool)
+
+    def render(self, stack):
+
+        # (N,H,W,3) float32 values between 0 and 1
+
+        self._run(stack, False)
+
+        return self.out
+
+    def render_bytes(self, stack):
+
+        # (N,H,W,3) uint8 values, quantized as matplotlib does when saving the float image
+
+        self._run(stack, True)
+
+        return self.bytes_out
+
+    def _run(self, stack, as_bytes):
+
+        stack = np.asarray(stack)
+        if stack.ndim == 3:
+            stack = stack[np.newaxis,:,:,:]
+        if stack.shape != self.shape:
+            self._allocate(stack.shape)
+        if as_bytes and self.bytes_out is None:
+            self.bytes_out = np.zeros(self.out.shape, np.uint8)
+
+        h = stack.shape[2]
+        if self.nthreads > 1 and h >= self.nthreads:
+            edges = np.linspace(0, h, self.nthreads + 1).astype(int)
+            chunks = [slice(r0,r1) for r0,r1 in zip(edges[:-1],edges[1:])]
+            row_pool(self.nthreads).map(lambda rows: self._render_rows(stack, rows, as_bytes), chunks)
+        else:
+            self._render_rows(stack, slice(None), as_bytes)
+
+        return None
+
+    def _render_rows(self, stack, rows, as_bytes):
+
+        rgb = self.planes[:,:,rows,:]
+
+        if self.luts is not None:
+            index = self.index[:,rows,:]
+            if as_bytes and not self.desaturate:
+                # Straight from flux to the final byte values
+                out = self.bytes_out[:,rows,:,:]
+                for idx,band in enumerate(self.bands):
+                    plane,scale = self.scales[band]
+                    self.luts[band].lookup(stack[:,idx,rows,:], self.luts[band].bytes, index, out[:,:,:,plane])
+                for plane in self.unfilled:
+                    to_bytes(np.clip(self.zero, 0., 1.), out=out[:,:,:,plane])
+                return None
+            for idx,band in enumerate(self.bands):
+                plane,scale = self.scales[band]
+                self.luts[band].lookup(stack[:,idx,rows,:], self.luts[band].values, index, rgb[:,plane,:,:])
+            for plane in self.unfilled:
+                rgb[:,plane,:,:] = self.zero
+        else:
+            # Convert to ~ sigmas
+            for idx,band in enumerate(self.bands):
+                plane,scale = self.scales[band]
+                np.divide(stack[:,idx,rows,:], scale, out=rgb[:,plane,:,:])
+            for plane in self.unfilled:
+                rgb[:,plane,:,:] = 0.
+            self._stretch(rgb)
+
+        if self.desaturate:
+            self._desaturate(rgb, rows)
+
+        np.clip(rgb.transpose(0,2,3,1), 0., 1., out=self.out[:,rows,:,:])
+
+        if as_bytes:
+            to_bytes(self.out[:,rows,:,:], out=self.bytes_out[:,rows,:,:])
+
+        return None
+
+    def _stretch(self, rgb):
+
+        # In-place arcsinh stretch and normalisation of values already divided by their scales
+
+        if self.arcsinh is not None:
+            np.multiply(rgb, self.arcsinh, out=rgb)
+            np.arcsinh(rgb, out=rgb)
+            np.divide(rgb, np.sqrt(self.arcsinh), out=rgb)
+
+        np.subtract(rgb, self.mn, out=rgb)
+        np.divide(rgb, self.mx - self.mn, out=rgb)
+
+        return None
+
+    def _desaturate(self, rgb, rows):
+
+        # Desaturate pixels that are dominated by a single colour to avoid colourful speckled sky.
+        # Same arithmetic, in the same order, as the original dstn_rgb:
+        #
+        #   a = mean of the planes (1 where it is 0)
+        #   wt = sin((1 - min(max of planes/a/2.5, 1)) * pi/2)
+        #   rgb = rgb * wt + a*(1-wt) + a*(1-wt)**2 * rgb
+
+        a,wt,u,au,tmp,mask = [buf[:,rows,:] for buf in (self.a,self.wt,self.u,self.au,self.tmp,self.mask)]
+
+        np.add(rgb[:,0,:,:], rgb[:,1,:,:], out=a)
+        np.add(a, rgb[:,2,:,:], out=a)
+        np.divide(a, 3, out=a)
+        np.equal(a, 0.0, out=mask)
+        np.putmask(a, mask, 1.0)
+
+        np.divide(rgb[:,0,:,:], a, out=wt)
+        np.divide(wt, 2.5, out=wt)
+        for plane in (1,2):
+            np.divide(rgb[:,plane,:,:], a, out=tmp)
+            np.divide(tmp, 2.5, out=tmp)
+            np.maximum(wt, tmp, out=wt)
+
+        np.greater(wt, 1.0, out=mask)
+        np.putmask(wt, mask, 1.0)
+        np.subtract(1, wt, out=wt)
+        np.multiply(wt, np.pi, out=wt)
+        np.divide(wt, 2.0, out=wt)
+        np.sin(wt, out=wt)
+
+        np.subtract(1, wt, out=u)
+        np.multiply(a, u, out=au)
+        np.square(u, out=u)
+        np.multiply(a, u, out=u)
+        for plane in range(3):
+            x = rgb[:,plane,:,:]
+            np.multiply(u, x, out=tmp)
+            np.multiply(x, wt, out=x)
+            np.add(x, au, out=x)
+            np.add(x, tmp, out=x)
+
+        return None
+
+# Renderers made by dstn_rgb, one per thread for each set of settings, so their buffers
+# and lookup tables carry over from one call to the next
+_renderers = threading.local()
+
+def shared_renderer(bands, mnmx=None, arcsinh=None, scales=None, desaturate=False, nthreads=1, lut=False):
+
+    # This thread's BatchRenderer for these settings, made on first use
+
+    if not hasattr(_renderers, 'cache'):
+        _renderers.cache = {}
+
+    key = (''.join(bands), None if mnmx is None else tuple(mnmx), arcsinh,
+           None if scales is None else tuple(sorted((band, tuple(v)) for band,v in scales.items())),
+           desaturate, nthreads, lut)
+    if key not in _renderers.cache:
+        _renderers.cache[key] = BatchRenderer(bands, mnmx=mnmx, arcsinh=arcsinh, scales=scales,
+                                              desaturate=desaturate, nthreads=nthreads, lut=lut)
+
+    return _renderers.cache[key]
+
+def dstn_rgb(imgs, bands, mnmx=None, arcsinh=None, scales=None, desaturate=False, nthreads=1, lut=False, renderer=None):
+
+    # Create an RGB jpeg from a FITS image using Dustin Lang's technique
+
+    '''
+    Given a list of images in the given bands, returns a scaled RGB
+    image.
+
+    *imgs*  a list of numpy arrays, all the same size, in nanomaggies,
+           or a (3,H,W) cube with the bands along the first axis
+    *bands* a list of strings, eg, ['g','r','z']
+    *mnmx*  = (min,max), values that will become black/white *after* scaling.
+           Default is (-3,10)
+    *arcsinh* use nonlinear scaling as in SDSS
+    *scales*
+    *nthreads* number of threads to split the rows over
+    *lut*   use the lookup-table stretch (approximate; see StretchLUT)
+    *renderer* BatchRenderer to use, in place of the settings above. By default
+           each thread keeps one for each set of settings (see shared_renderer).
+
+    Returns a (H,W,3) numpy array with values between 0 and 1. It is a copy,
+    so it isn't overwritten by the next image the renderer works on.
+    '''
+
+    if not isinstance(imgs, np.ndarray):
+        imgs = np.array(imgs[:len(bands)])
+
+    if renderer is None:
+        renderer = shared_renderer(bands, mnmx=mnmx, arcsinh=arcsinh, scales=scales, desaturate=desaturate, nthreads=nthreads, lut=lut)
+
+    return renderer.render(imgs)[0].copy()
@@ -175,6 +175,9 @@ import os, sys
 from scipy.optimize import golden
 from os.path import exists, join
 from glob import glob
+from collections import deque, OrderedDict
+import threading
+from multiprocessing import Pool, cpu_count
 
 defaultvalues = {
     'indir':'',
@@ -192,6 +195,7 @@ defaultvalues = {
     'sampledx':0,  # offset
     'sampledy':0,  # offset
     'stampsize': 1000,  # for making final color image (just a memory issue)
+    'nprocesses': 1,  # stamps rendered at once for the final color image (0 = all cores)
     'testfirst':1,
     'show':1,
     'showstamps':0,
@@ -307,6 +311,72 @@ class meanstd_robust:
         self.mean = mean(xrem)
         self.std  = rms(xrem - self.mean)
 
+class meanstd_select:
+    #Same statistics as meanstd_robust, without sorting x
+    #Each iteration needs one order statistic (the median of the clipped
+    #sample) and the counts below / above the clipping limits.
+    #x is partitioned in place, once, around the middle ranks (and any
+    #other ranks asked for in keep) and only that window is sorted, so
+    #x[k] is the k-th smallest value for those ranks and most medians are
+    #lookups. Everything else is linear time. x is not reordered again
+    #until the very end of run(), since the clipping masks index into it
+    def __init__(self,x,n_sigma=3,n=5,window=0.03,keep=[]):
+        self.x=x
+        self.n_sigma=n_sigma
+        self.n=n
+        nx = len(x)
+        self.wlo = int(nx * (0.5 - window))
+        self.whi = max(self.wlo, min(int(nx * (0.5 + window)), nx-1))
+        x.partition([self.wlo, self.whi] + list(keep))
+        x[self.wlo:self.whi+1].sort()
+
+    def median(self, xs, ilo, imed):
+        # xsort[ilo+imed], where xs holds the values of xsort[ilo:ihi]: a lookup if
+        # that rank is in the sorted window of x, otherwise selected within xs
+        k = ilo + imed
+        if self.wlo <= k <= self.whi:
+            return self.x[k]
+        if xs is self.x:
+            return partition(xs, imed)[imed]
+        xs.partition(imed)  # xs is a copy made for this iteration
+        return xs[imed]
+
+    def run(self):
+        ihi = nx = len(self.x)
+        ilo = 0
+        inrange = None  # which of x are in xsort[ilo:ihi] of meanstd_robust (None: all)
+        for i in range(self.n):
+            if i > 0:
+                # xsort[ilo:ihi] is exactly the values between lo and hi
+                inrange = lesshi & ~lesslo
+                xs = compress(inrange, self.x)
+            else:
+                xs = self.x
+            imed = (ilo+ihi) / 2
+            if imed >= len(xs):
+                raise IndexError('index out of bounds')  # as xs[imed] in meanstd_robust
+            aver = self.median(xs, ilo, imed)  # xs[imed] of the sorted slice
+            d = xs - aver
+            std1 = sqrt(dot(d, d) / len(d))  # rms(xs - aver)
+            del d
+            lo = aver - self.n_sigma * std1
+            hi = aver + self.n_sigma * std1
+            lesslo = self.x < lo
+            lesshi = self.x <= hi
+            ilo = count_nonzero(lesslo)  # searchsorted(xsort, lo)
+            ihi = count_nonzero(lesshi)  # searchsorted(xsort, hi, side='right')
+            nnx = ihi - ilo
+            if nnx==nx: break
+            else: nx=nnx
+
+        # xs[ilo:ihi] of the sorted slice, as in meanstd_robust
+        ihi = min(ihi, len(xs))
+        if ilo < ihi:
+            xs.partition([ilo, ihi-1])
+        self.remaining = xrem = xs[ilo:max(ilo, ihi)]
+        self.mean = mean(xrem)
+        d = xrem - self.mean
+        self.std  = sqrt(dot(d, d) / len(d))
 
 def strend(str, phr):
     return str[-len(phr):] == phr
@@ -426,6 +496,30 @@ def params_cl(converttonumbers=True):
 # TRILOGY-specific tools
 
 def determinescaling(data, unsatpercent):
+    """Determines data values (x0,x1,x2) which will be scaled to (0,noiselum,1)
+    Only a few order statistics are needed, so the sample is never fully sorted"""
+    datacopy = array(data, float).ravel()
+    if isnan(datacopy).any():
+        # The sorted version zeroes NaNs after sorting, leaving those zeros at the end, out of order;
+        # its levels depend on that, so samples with NaNs still go through it
+        return determinescaling_sorted(data, unsatpercent)
+    if datacopy.min() == datacopy.max():
+        levels = 0, 1, 100  # whatever
+    else:
+        # setlevels(datasorted, [unsatpercent]) takes this order statistic, clipped at 0
+        isat = clip(int(unsatpercent * len(datacopy)), 0, len(datacopy)-1)
+        s = meanstd_select(datacopy, keep=[isat])  # partitions datacopy in place
+        x2 = max(datacopy[isat], 0)
+        s.run()
+        m = s.mean
+        r = s.std
+
+        x0 = 0
+        x1 = m+r
+        levels = x0, x1, x2
+    return levels
+
+def determinescaling_sorted(data, unsatpercent):
     """Determines data values (x0,x1,x2) which will be scaled to (0,noiselum,1)"""
     datasorted = sort(data.flat)
     datasorted[isnan(datasorted)]=0  # set all nan values to zero
@@ -478,7 +572,7 @@ def imscale1(data, levels):
     z = z.astype(int)
     return z
 
-def da(k):
+def da(k, n, x0, x1, x2):
     a1 = k * (x1 - x0) + 1
     a2 = k * (x2 - x0) + 1
     a1n = a1**n
@@ -486,7 +580,7 @@ def da(k):
     da1 = a1n - a2
     k = abs(k)
     if k == 0:
-        return da(1e-10)
+        return da(1e-10, n, x0, x1, x2)
     else:
         da1 = da1 / k  # To avoid solution k = 0!
     return abs(da1)
@@ -495,26 +589,57 @@ def da(k):
 # For some reason, setting noiselum = 0.2 (exactly) was making an all yellow image
 # it alters k for some of the channels
 # levels stay the same
+class logstretch:
+    """Log scaling taking data values x0, x1, x2 to 0, y1, 1 (then to bytes 0 - 255).
+    k is solved for once here; calling the stretch maps an array of data,
+    and it holds no state beyond k, so stamps can be scaled concurrently."""
+    def __init__(self, levels, y1):
+        x0, x1, x2 = levels
+        if y1 == 0.5:
+            k = (x2 - 2 * x1 + x0) / float(x1 - x0) ** 2
+        else:
+            n = 1 / y1
+            k = abs(golden(da, args=(n, x0, x1, x2)))
+        self.x0 = x0
+        self.k = k
+        self.r1 = log10( k * (x2 - x0) + 1)
+    
+    def __call__(self, data):
+        # Same steps as before, in place on one working copy.
+        # Float data stays in its own precision (float32 stamps were scaled in float32)
+        data = asarray(data)
+        z = array(data, data.dtype if issubdtype(data.dtype, floating) else float)
+        maximum(z, 0, z)
+        z -= self.x0
+        z *= self.k
+        z += 1
+        maximum(z, 1e-30, z)
+        log10(z, z)
+        z /= self.r1
+        clip(z, 0, 1, z)
+        z *= 255
+        return z.astype(uint8)
+
+stretches = OrderedDict()  # least recently used first
+maxstretches = 64
+stretchlock = threading.Lock()
+
+def getstretch(levels, y1):
+    """k depends only on the levels and noiselum, so each stretch is solved once.
+    Only the maxstretches most recently used are kept"""
+    key = tuple(map(float, levels)) + (float(y1),)
+    with stretchlock:
+        stretch = stretches.pop(key, None)
+        if stretch is None:
+            stretch = logstretch(levels, y1)
+        stretches[key] = stretch
+        if len(stretches) > maxstretches:
+            stretches.popitem(last=False)
+    return stretch
+
 def imscale2(data, levels, y1):
     # x0, x1, x2  YIELD  0, y1, 1,  RESPECTIVELY
-    global n, x0, x1, x2  # So that golden can use them
-    x0, x1, x2 = levels  
-    if y1 == 0.5:
-        k = (x2 - 2 * x1 + x0) / float(x1 - x0) ** 2
-    else:
-        n = 1 / y1
-        k = abs(golden(da))
-    r1 = log10( k * (x2 - x0) + 1)
-    v = ravel(data)
-    v = clip2(v, 0, None)
-    d = k * (v - x0) + 1
-    d = clip2(d, 1e-30, None)
-    z = log10(d) / r1
-    z = clip(z, 0, 1)
-    z.shape = data.shape
-    z = z * 255
-    z = z.astype(uint8)
-    return z
+    return getstretch(levels, y1)(data)
 
 #########
 
@@ -598,7 +723,6 @@ def grayimage(scaled):
     return im
 
 def grayscaledimage(stamp, levels, noiselum):
-    global scaled
     scaled = imscale2(stamp, levels, noiselum)
     im = grayimage(scaled)
     return im
@@ -701,7 +825,8 @@ def extractfilter(header):
                 filt = filt1
     return filt
 
-def loadfitsimagedata(image, indir='', silent=1):
+def openfitsimage(image, indir='', silent=1):
+    """Opens a FITS image, memory-mapped; returns the HDU list (to close later) and the data"""
     global imfilt, imfilts
     if image[-1] == ']':
         iext = int(image[-2])
@@ -723,6 +848,10 @@ def loadfitsimagedata(image, indir='', silent=1):
     if not silent:
         print image+'[%d]' % iext, data.shape
     
+    return hdulist, data
+
+def loadfitsimagedata(image, indir='', silent=1):
+    hdulist, data = openfitsimage(image, indir, silent)
     return data
 
 imfilts = {}
@@ -744,6 +873,33 @@ def processimagename(image):
     image = image + ext
     return image
 
+#################################
+# Rendering stamps in worker processes
+
+renderer = None  # Trilogy instance, in each worker process
+
+def setrenderer(trilogy):
+    global renderer
+    renderer = trilogy
+
+def renderstamp(limits):
+    """Renders one stamp in a worker process.
+    Returned as raw bytes, which (unlike an Image) can be sent back"""
+    im = renderer.renderstamp(limits)
+    return im.mode, im.size, im.tobytes()
+
+def inorder(func, tasks, pool, inflight):
+    """Yields func(task) for each task, in order, computed in the pool.
+    At most inflight tasks are running or waiting to be collected at any time,
+    so memory doesn't grow with the number of tasks."""
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= inflight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
 class Trilogy:
     def __init__(self, infile=None, images=None, imagesorder='BGR', **inparams):
         self.nx = None  # image size
@@ -756,6 +912,8 @@ class Trilogy:
         self.inkeys = []
         self.mode = 'L'  # reset below if color
         self.weightext = None  # No weighting unless weight images are declared
+        self.openimages = {}  # image -> (HDU list, data), kept open for the run
+        self.weightimages = {}  # image -> its weight image, or None if there isn't one
         # Can use either:
         # weightext drz wht
         # weightext drz -> wht
@@ -902,8 +1060,13 @@ class Trilogy:
             for image in self.imagesRGB[channel]:
                 if self.verbose:
                     print channel,
-                data = loadfitsimagedata(image, self.indir, silent=logical_not(self.verbose))
+                data = self.imagedata(image, silent=logical_not(self.verbose))
                 filters[channel].append(imfilt)
+                # Weight images are opened now too, before any stamp workers are forked
+                if self.weightext <> None:
+                    weightimage = self.weightimage(image)
+                    if weightimage:
+                        self.imagedata(weightimage)
                 ny, nx = data.shape
                 if self.ny == None:
                     self.ny = ny
@@ -968,21 +1131,18 @@ class Trilogy:
             for image in self.imagesRGB[channel]:
                 if self.verbose:
                     print channel,
-                data = loadfitsimagedata(image, self.indir, silent=silent)
+                data = self.imagedata(image, silent=silent)
                 stamp = data[ylo:yhi,xlo:xhi]
 
                 # weight image?
                 if self.weightext <> None:
-                    weightimage = image.replace(self.imext, self.weightext)
-                    weightfile = join(self.indir, weightimage)
-                    if exists(weightfile):
-                        weight = loadfitsimagedata(weightimage, self.indir, silent=silent)
+                    weightimage = self.weightimage(image)
+                    if weightimage:
+                        weight = self.imagedata(weightimage, silent=silent)
                         weightstamp = weight[ylo:yhi,xlo:xhi]
                         weightstamp = greater(weightstamp, 0)  # FLAG IMAGE!!  EITHER 1 or 0
                         weightstampRGB[ichannel] = weightstampRGB[ichannel] + weightstamp
                         stamp = stamp * weightstamp
-                    else:
-                        print weightfile, 'DOES NOT EXIST'
 
                 stampRGB[ichannel] = stampRGB[ichannel] + stamp
 
@@ -993,6 +1153,34 @@ class Trilogy:
 
         return stampRGB
 
+    def imagedata(self, image, silent=1):
+        """Data of an input image. Each file is opened (memory-mapped) once,
+        and stays open until closeimages, so stamps are just slices of it."""
+        if image not in self.openimages:
+            self.openimages[image] = openfitsimage(image, self.indir, silent=silent)
+        return self.openimages[image][1]
+
+    def weightimage(self, image):
+        """Name of the weight image for an input image, or None if it doesn't exist"""
+        if image not in self.weightimages:
+            weightimage = image.replace(self.imext, self.weightext)
+            weightfile = join(self.indir, weightimage)
+            if exists(weightfile):
+                self.weightimages[image] = weightimage
+            else:
+                print weightfile, 'DOES NOT EXIST'
+                self.weightimages[image] = None
+        return self.weightimages[image]
+
+    def closeimages(self):
+        for hdulist, data in self.openimages.values():
+            hdulist.close()
+        self.openimages = {}
+
+    def renderstamp(self, limits):
+        stamps = self.loadstamps(limits)
+        return RGBscale2im(stamps, self.levdict, self.noiselums, self.colorsatfac, self.mode)
+
     def determinescalings(self):
         """Determine data scalings
         will sample a (samplesize x samplesize) region of the (centered) core
@@ -1125,19 +1313,39 @@ class Trilogy:
         elif self.mode == 'L':
             if self.verbose:
                 print 'Making full grayscale image, one stamp (section) at a time...'
+        tiles = []
         for yo in range(self.ylo,self.yhi,dy):
             dy1 = min([dy, self.yhi-yo])
             for xo in range(self.xlo,self.xhi,dx):
                 dx1 = min([dx, self.xhi-xo])
+                tiles.append((xo, yo, dx1, dy1))
+        limits = [(yo, yo+dy, xo, xo+dx) for xo, yo, dx1, dy1 in tiles]
+
+        # Stamps are independent once the levels are set, so they can be rendered in parallel
+        # Workers are forked with a copy of this Trilogy; stamps come back in order to be pasted
+        nprocesses = min(self.nprocesses or cpu_count(), len(tiles))
+        if nprocesses > 1:
+            if self.verbose:
+                print 'Rendering stamps on %d processes' % nprocesses
+            pool = Pool(nprocesses, setrenderer, (self,))
+            ims = (Image.frombytes(*stamp) for stamp in inorder(renderstamp, limits, pool, 2*nprocesses))
+        else:
+            pool = None
+            ims = (self.renderstamp(stamplimits) for stamplimits in limits)
+
+        try:
+            for i, im in enumerate(ims):
+                xo, yo, dx1, dy1 = tiles[i]
                 if self.verbose:
                     print '%5d, %5d  /  (%d x %d)' % (xo, yo, self.nx, self.ny)
-                limits = yo, yo+dy, xo, xo+dx
-                stamps = self.loadstamps(limits)
-                im = RGBscale2im(stamps, self.levdict, self.noiselums, self.colorsatfac, self.mode)
                 if self.show and self.showstamps:
                     im.show()
 
                 imfull.paste(im, (xo,self.ny-yo-dy1,xo+dx1,self.ny-yo))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
         outfile = join(self.outdir, self.outfile)
         if self.legend:
@@ -1219,32 +1427,8 @@ class Trilogy:
             if self.verbose:
                 print 'Adding legend...'
         
-        nx, ny = im.size
-        draw = ImageDraw.Draw(im)
-
-        x = 20
-        y0 = 20
-        dy = 15
-
         txt = loadfile(self.outfilterfile(), silent=1)
-        
-        if self.mode == 'L':
-            white = 255
-            line = txt[0][4:]  # get rid of leading "L = "
-            draw.text((x, y0), line, fill=white)
-        else:
-            blue   = tuple(255 * array([0,0.5,1]))
-            green  = tuple(255 * array([0,1,0]))
-            red    = tuple(255 * array([1,0,0]))
-
-            colors = blue, green, red
-            colors = array(colors).astype(int)
-
-            #print 'ImageDraw will complain about float color but handles it fine:'
-            for i, line in enumerate(txt):
-                y = y0 + dy*i
-                color = tuple(colors[i])
-                draw.text((x, y), ''.join(line.split("=")[1:]).strip(), fill=color)
+        drawlegend(im, txt, self.mode)
 
         if outfile == None:
             outfile = join(self.outdir, self.outfile)
@@ -1277,31 +1461,149 @@ class Trilogy:
         fout.close()
 
     def run(self):
-        self.setimages()  # not needed from command line
-        self.setoutfile()  # adds .png if necessary to outname
-        self.loadimagesize()
-        self.addtofilterlog()
-        if 'justaddlegend' in self.inkeys:
-            self.addlegend()
-            quit()
-
-        if self.noiselums == {}:
-            self.setnoiselums()
-        if self.scaling == None:
-            self.determinescalings()
-        else:
-            if self.verbose:
-                print 'Loading scaling saved in', self.scaling
-            self.levdict = loaddict(self.scaling)
-            self.showsample(self.outname+'_'+self.scaling[:-4]+'.png')
-        if self.verbose:
-            print "Scalings:"
-        for channel in self.mode:
+        try:
+            self.setimages()  # not needed from command line
+            self.setoutfile()  # adds .png if necessary to outname
+            self.loadimagesize()
+            self.addtofilterlog()
+            if 'justaddlegend' in self.inkeys:
+                self.addlegend()
+                quit()
+
+            if self.noiselums == {}:
+                self.setnoiselums()
+            if self.scaling == None:
+                self.determinescalings()
+            else:
+                if self.verbose:
+                    print 'Loading scaling saved in', self.scaling
+                self.levdict = loaddict(self.scaling)
+                self.showsample(self.outname+'_'+self.scaling[:-4]+'.png')
             if self.verbose:
-                print channel, self.levdict[channel]
-        self.makecolorimage()
+                print "Scalings:"
+            for channel in self.mode:
+                if self.verbose:
+                    print channel, self.levdict[channel]
+            self.makecolorimage()
         
-        self.makethumbnail()
+            self.makethumbnail()
+        finally:
+            # Release the input files (and their memory maps) however the run ends
+            self.closeimages()
+
+def drawlegend(im, txt, mode):
+    """Writes the filters of each channel in the top-left corner of im
+    txt: lines as in trilogy_filters.txt ("B = F435W"), ordered BGR"""
+    nx, ny = im.size
+    draw = ImageDraw.Draw(im)
+
+    x = 20
+    y0 = 20
+    dy = 15
+
+    if mode == 'L':
+        white = 255
+        line = txt[0][4:]  # get rid of leading "L = "
+        draw.text((x, y0), line, fill=white)
+    else:
+        blue   = tuple(255 * array([0,0.5,1]))
+        green  = tuple(255 * array([0,1,0]))
+        red    = tuple(255 * array([1,0,0]))
+
+        colors = blue, green, red
+        colors = array(colors).astype(int)
+
+        #print 'ImageDraw will complain about float color but handles it fine:'
+        for i, line in enumerate(txt):
+            y = y0 + dy*i
+            color = tuple(colors[i])
+            draw.text((x, y), ''.join(line.split("=")[1:]).strip(), fill=color)
+
+#################################
+# Batch rendering: arrays in, image out
+# No input file, prompts, or files written, so many images can be made in one session
+#
+# im = renderimage(cube, renderparams(noiselum=0.15, samplesize=200), filters='grz')
+# im.save('galaxy.png')
+
+class renderparams:
+    """Parameters for renderimage: defaultvalues, with any of them overridden by keyword.
+    Only the scaling and rendering ones are used (noiselum, noiselums, satpercent,
+    colorsatfac, samplesize, sampledx, sampledy, stampsize, maxstampsize, legend)."""
+    def __init__(self, **params):
+        for key in params.keys():
+            if key not in defaultvalues:
+                raise KeyError('Unknown Trilogy parameter: %s' % key)
+        for key in defaultvalues.keys():
+            setattr(self, key, params.get(key, defaultvalues[key]))
+        self.noiselums = dict(self.noiselums)
+
+def stackchannels(data, imagesorder='BGR'):
+    """Channel data as used by RGBscale2im, and the mode ('RGB' or 'L')
+    data: (ny, nx) image, or (3, ny, nx) cube with its planes in imagesorder"""
+    data = array(data, float)
+    if data.ndim == 2:
+        return data[newaxis], 'L'
+    mode = 'RGB'
+    stampRGB = zeros(data.shape, float)
+    for i in range(3):
+        stampRGB[mode.index(imagesorder[i])] = data[i]
+    return stampRGB, mode
+
+def samplelevels(stampRGB, mode, params):
+    """Levels of each channel, from the (samplesize x samplesize) core sample, as in determinescalings"""
+    three, ny, nx = stampRGB.shape
+    dx = dy = params.samplesize
+    if dx * dy == 0:
+        dx = dy = params.maxstampsize  # Maximum size possible
+    yc = ny / 2
+    xc = nx / 2
+
+    ylo = clip(yc-dy/2 + params.sampledy, 0, ny)
+    yhi = clip(yc+dy/2 + params.sampledy, 0, ny)
+    xlo = clip(xc-dx/2 + params.sampledx, 0, nx)
+    xhi = clip(xc+dx/2 + params.sampledx, 0, nx)
+
+    unsatpercent = 1 - 0.01 * params.satpercent
+    levdict = {}
+    for ichannel, channel in enumerate(mode):
+        levdict[channel] = determinescaling(stampRGB[ichannel,ylo:yhi,xlo:xhi], unsatpercent)
+    return levdict
+
+def renderimage(data, params=None, imagesorder='BGR', filters=None, levdict=None):
+    """Color (or grayscale) image of data, in one call
+    data: (ny, nx) image, or (3, ny, nx) cube with its planes in imagesorder
+    params: renderparams (defaults if None)
+    filters: name of each plane, for the legend (none is drawn without them)
+    levdict: levels of each channel, to reuse a scaling; determined from the data if None"""
+    params = params or renderparams()
+    stampRGB, mode = stackchannels(data, imagesorder)
+    three, ny, nx = stampRGB.shape
+
+    levdict = levdict or samplelevels(stampRGB, mode, params)
+    noiselums = params.noiselums or dict((channel, params.noiselum) for channel in mode)
+
+    dx = dy = params.stampsize
+    if dx * dy == 0:
+        dx = dy = params.maxstampsize
+
+    imfull = Image.new(mode, (nx, ny))
+    for yo in range(0,ny,dy):
+        dy1 = min([dy, ny-yo])
+        for xo in range(0,nx,dx):
+            dx1 = min([dx, nx-xo])
+            stamps = stampRGB[:,yo:yo+dy1,xo:xo+dx1]
+            im = RGBscale2im(stamps, levdict, noiselums, params.colorsatfac, mode)
+            imfull.paste(im, (xo,ny-yo-dy1,xo+dx1,ny-yo))
+
+    if params.legend and filters:
+        if mode == 'L':
+            txt = ['L = %s' % filters[0]]
+        else:
+            txt = ['%s = %s' % (channel, filters[imagesorder.index(channel)]) for channel in 'BGR']
+        drawlegend(imfull, txt, mode)
+
+    return imfull
 
 def pause(text=''):
     inp = raw_input(text)